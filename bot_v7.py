@@ -1,25 +1,56 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import heapq
+import json
 import logging
+import math
+import os
+import random
+import re
+import signal
+import sqlite3
 from logging import StreamHandler
 import gspread
+import time
 import traceback
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
 from uuid import uuid4
 import sys
 
 # --- External Libraries Imports ---
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from aiohttp import ClientSession, web
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    InlineQueryHandler,
     ConversationHandler,
+    PersistenceInput,
     filters,
 )
-from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
 from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
 
 # --- 1. CONFIGURATION AND INITIAL SETUP ---
 
@@ -29,8 +60,129 @@ ADMIN_ID = 6718122711
 SPREADSHEET_ID = "180UVbuZb__TynCosXHnGWD48uREmnPwdWDVcUh1Wr0c" 
 CREDENTIALS_FILE = "credentials.json" 
 
+# Google Sheets access tuning
+SHEETS_MAX_WORKERS = 4          # Threads available for blocking gspread calls (shared by all worksheets)
+SHEETS_PER_SHEET_CONCURRENCY = 1  # Calls allowed in flight per worksheet; 1 keeps each worksheet's calls in FIFO order
+SHEETS_SLOW_CALL_MS = 2000      # Sheets calls slower than this are logged as warnings
+SHEETS_QUEUE_WARN_DEPTH = 10    # Log a warning when this many calls are waiting on one worksheet
+
+# Sheets quotas and resilience
+SHEETS_READS_PER_MINUTE = 60    # Google's default per-user quota for Sheets read requests
+SHEETS_WRITES_PER_MINUTE = 60   # Google's default per-user quota for Sheets write requests
+SHEETS_MAX_RETRIES = 5          # Retries of a call failing with 429, 5xx or a connection error
+SHEETS_BACKOFF_BASE = 1.0       # Seconds; retry n waits a random time of up to base * 2**n
+SHEETS_BACKOFF_MAX = 32.0       # Cap for a single backoff wait
+SHEETS_BREAKER_THRESHOLD = 5    # Consecutive failed calls (retries exhausted) that open the circuit
+SHEETS_BREAKER_COOLDOWN = 30    # Seconds the circuit stays open before a single trial call is let through
+SHEETS_STALE_CACHE_SIZE = 256   # Last good results of read calls kept to answer while the circuit is open
+
+# Product catalog cache
+CATALOG_TTL_SECONDS = 30        # Catalog older than this is served stale while a refresh runs in the background
+CATALOG_REFRESH_INTERVAL = 60   # Seconds between proactive background refreshes of the catalog
+
+# Product browsing
+PRODUCTS_PAGE_SIZE = 10            # Products per page when browsing a category
+DEFAULT_CATEGORY = "Other"         # Category for products with an empty (or no) Category column
+
+# Inline search (inline mode must also be enabled for the bot in @BotFather)
+INLINE_MAX_RESULTS = 50         # Results per inline answer (Telegram's maximum)
+INLINE_CACHE_SECONDS = 10       # How long Telegram may reuse an inline answer; kept short since stock moves
+INLINE_QUERY_CACHE_SIZE = 5000  # Distinct queries whose matches are kept between catalog changes
+
+# Inventory reservations
+RESERVATION_TTL_SECONDS = 30 * 60  # Units held for an unpaid checkout return to stock after this long
+RESERVATION_SWEEP_INTERVAL = 60    # Seconds between sweeps that release expired reservations
+INVENTORY_RESCAN_MIN_SECONDS = 30  # A stock shortfall rescans the Products sheet at most this often
+
+# Pending order expiry
+PENDING_ORDER_TTL_SECONDS = RESERVATION_TTL_SECONDS  # Unpaid orders with no proof become 'Expired' after this long
+ORDER_EXPIRY_INTERVAL = 60       # Seconds between expiry runs
+ORDER_EXPIRY_BATCH_SIZE = 200    # Orders expired per storage write
+
+# Write-behind buffering for Orders/Users appends
+WRITE_BEHIND_MAX_ROWS = 50      # Flush a buffer as soon as it holds this many rows
+WRITE_BEHIND_FLUSH_MS = 2000    # ...or once its oldest row has waited this long
+ORDERS_SPILL_FILE = "orders_spill.jsonl"  # Local copy of buffered Orders rows, replayed after a crash
+USERS_SPILL_FILE = "users_spill.jsonl"    # Local copy of buffered Users rows, replayed after a crash
+
+# Products sheet sync
+PRODUCT_SYNC_INTERVAL = 30         # Seconds between checks of the Products sheet for manual edits
+PRODUCT_SYNC_ECHO_TIMEOUT = 600    # Seconds a bot write may take to show up in the sheet before the sheet wins again
+
+# Archival of sold units and settled orders
+ARCHIVE_INTERVAL = 6 * 60 * 60     # Seconds between compaction runs
+ARCHIVE_MIN_ROWS = 20              # Skip a sheet until it has at least this many rows to archive
+ARCHIVE_BATCH_SIZE = 500           # Rows moved per sheet per run
+ARCHIVE_ORDER_MIN_AGE_DAYS = 7     # Settled orders stay in Orders (and verifiable) for this long
+ARCHIVE_GATE_TIMEOUT = 30          # Seconds to wait for in-flight deliveries before postponing a run
+PRODUCTS_ARCHIVE_SHEET = "Products Archive"  # Created on first use, with the Products header
+ORDERS_ARCHIVE_SHEET = "Orders Archive"      # Created on first use, with the Orders header
+PRODUCTS_ARCHIVE_SPILL_FILE = "products_archive_spill.jsonl"  # Archived rows not yet appended, replayed after a crash
+ORDERS_ARCHIVE_SPILL_FILE = "orders_archive_spill.jsonl"
+
+# Storage backend
+STORAGE_BACKEND = "sqlite"         # "sqlite" (local primary store mirrored to Sheets) or "sheets" (Sheets only)
+STORAGE_DB_FILE = "bot_store.db"   # SQLite database used by the "sqlite" backend
+REPLICATION_INTERVAL_SECONDS = 2   # Longest a local change waits before it is mirrored to Sheets
+REPLICATION_RETRY_SECONDS = 10     # Pause after a failed mirror attempt
+REPLICATION_BATCH_SIZE = 500       # Outbox entries read per mirror pass
+
+# Users sheet tracking
+USERS_TRACK_LAST_SEEN = False         # Also keep a 'LastSeen' column in Users up to date (needs that header)
+USERS_LAST_SEEN_FLUSH_INTERVAL = 300  # Seconds between batched LastSeen writes
+
+# Update delivery
+BOT_MODE = "polling"                # "polling" (long polling) or "webhook" (Telegram POSTs updates to us)
+WEBHOOK_URL = ""                    # Public HTTPS URL registered with Telegram, e.g. "https://bot.example.com/telegram"
+WEBHOOK_LISTEN = "0.0.0.0"          # Interface the local webhook server binds to
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET_TOKEN = ""           # Required in webhook mode; Telegram echoes it in X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = 40        # Concurrent connections Telegram may open to the webhook (1-100)
+WEBHOOK_MAX_INFLIGHT = 100          # Accepted updates not yet fully handled before the server answers 503
+# Only the update types the handlers below actually use
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# Update processing
+MAX_CONCURRENT_UPDATES = 16     # Updates handled in parallel (always from different users)
+MAX_UPDATE_BACKLOG = 1000       # Updates accepted for processing at once; the rest wait in the update queue
+UPDATE_BACKLOG_WARN = 200       # Log a warning when this many updates are waiting for a worker or their user
+
+# Session persistence
+SESSION_DB_FILE = "bot_sessions.db"  # user_data and conversation states, restored after a restart
+SESSION_FLUSH_INTERVAL = 5           # Seconds between batched writes of changed sessions
+SESSION_TTL_SECONDS = 24 * 60 * 60   # Sessions idle for this long are evicted
+SESSION_EVICT_INTERVAL = 60 * 60     # Seconds between eviction sweeps
+
+# Broadcasts
+BROADCAST_RATE_PER_SECOND = 25  # Messages per second across all chats (Telegram's global limit is about 30)
+BROADCAST_BURST = 5             # Messages that may go out back-to-back after an idle moment
+BROADCAST_WORKERS = 8           # Sends in flight at once
+BROADCAST_MAX_RETRIES = 3       # Attempts per recipient on network errors (flood waits are always retried)
+BROADCAST_PROGRESS_INTERVAL = 5 # Seconds between progress updates on the admin's status message
+BROADCAST_STATE_FILE = "broadcast_state.json"  # Progress of the current broadcast, used to resume after a restart
+BLOCKED_USERS_FILE = "blocked_users.json"      # Users who blocked the bot; skipped until they /start again
+
+# Order delivery
+DELIVERY_QUEUE_FILE = "delivery_queue.json"  # Deliveries not fully sent yet, resumed after a restart
+DELIVERY_WORKERS = 4            # Deliveries sent in parallel (the parts of one delivery go out in order)
+DELIVERY_CHUNK_CHARS = 3500     # Content per message, leaving room for the header within Telegram's 4096 limit
+DELIVERY_MAX_MESSAGES = 5       # Content needing more messages than this is sent as a .txt document
+DELIVERY_MAX_ATTEMPTS = 8       # Attempts on network/server errors before the admin is asked to /redeliver
+DELIVERY_BACKOFF_BASE = 5       # Seconds; the wait after failed attempt n is base * 2**(n-1)...
+DELIVERY_BACKOFF_MAX = 15 * 60  # ...capped at this
+
+# Admin views
+PENDING_PAGE_SIZE = 8   # Pending orders shown per page of the admin's pending list
+
+# Instrumentation
+METRICS_LISTEN = "127.0.0.1"    # Interface for the local Prometheus endpoint (GET /metrics)
+METRICS_PORT = 9108             # 0 disables the endpoint; /stats keeps working
+STATS_TOP_N = 15                # Rows per table in the /stats report
+
 # Define Conversation States
-(SELECT_PRODUCT, AWAITING_PROOF, CONFIRM_ORDER, ADMIN_MENU, ADMIN_SET_PRICE, ADMIN_SET_STOCK) = range(6)
+(SELECT_PRODUCT, AWAITING_PROOF, CONFIRM_ORDER, ADMIN_MENU, ADMIN_SET_PRICE, ADMIN_SET_STOCK,
+ ADMIN_BROADCAST, ADMIN_BROADCAST_CONFIRM) = range(8)
 
 # Configure Logging (Logs to console and file)
 logging.basicConfig(
@@ -43,17 +195,579 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- Instrumentation ---
+# Every registered handler and every Sheets call is timed into log-linear (HDR-style)
+# histograms, and Sheets calls are counted per worksheet and per handler that caused them.
+# The admin sees a summary with /stats; METRICS_PORT serves it all in Prometheus text format.
+
+current_handler = contextvars.ContextVar('current_handler', default='background')
+
+class LatencyHistogram:
+    """
+    Durations in microseconds, bucketed log-linearly: every power of two is split into
+    2**SUB_BITS buckets, so reported percentiles are within 1/2**SUB_BITS of the real value.
+    """
+
+    SUB_BITS = 3
+
+    def __init__(self):
+        self._buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    @classmethod
+    def _index(cls, us: int) -> int:
+        if us < (1 << cls.SUB_BITS):
+            return us  # Small values are recorded exactly
+        shift = us.bit_length() - 1 - cls.SUB_BITS
+        return ((shift + 1) << cls.SUB_BITS) + (us >> shift) - (1 << cls.SUB_BITS)
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> int:
+        if index < (1 << cls.SUB_BITS):
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        mantissa = (1 << cls.SUB_BITS) + (index & ((1 << cls.SUB_BITS) - 1))
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds: float) -> None:
+        us = int(seconds * 1_000_000)
+        index = self._index(us)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total_us += us
+        self.max_us = max(self.max_us, us)
+
+    def percentile(self, q: float) -> float:
+        """Approximate q-quantile (0..1) in seconds."""
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= target:
+                return min(self._upper_bound(index), self.max_us) / 1_000_000
+        return self.max_us / 1_000_000
+
+
+class Metrics:
+    """Process-wide latency histograms, call counters, cache hit ratios and gauges."""
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.handler_latency = {}  # handler name -> LatencyHistogram
+        self.handler_errors = {}   # handler name -> count
+        self.sheets_latency = {}   # worksheet -> LatencyHistogram
+        self.sheets_calls = {}     # (worksheet, method, handler) -> count
+        self._caches = {}          # name -> object with `hits` and `misses`
+        self._gauges = {}          # name -> (help text, zero-argument callable)
+        self._runner = None
+
+    def instrument(self, name: str, callback):
+        """Wraps a handler callback so its duration and failures are recorded under `name`."""
+        @functools.wraps(callback)
+        async def timed(update, context, *args, **kwargs):
+            token = current_handler.set(name)
+            started = time.perf_counter()
+            try:
+                return await callback(update, context, *args, **kwargs)
+            except ApplicationHandlerStop:
+                raise  # Flow control, not a failure
+            except Exception:
+                self.handler_errors[name] = self.handler_errors.get(name, 0) + 1
+                raise
+            finally:
+                self.handler_latency.setdefault(name, LatencyHistogram()).record(time.perf_counter() - started)
+                current_handler.reset(token)
+        return timed
+
+    def record_sheets_call(self, worksheet: str, method: str, seconds: float) -> None:
+        self.sheets_latency.setdefault(worksheet, LatencyHistogram()).record(seconds)
+        key = (worksheet, method, current_handler.get())
+        self.sheets_calls[key] = self.sheets_calls.get(key, 0) + 1
+
+    def register_cache(self, name: str, cache) -> None:
+        self._caches[name] = cache
+
+    def register_gauge(self, name: str, help_text: str, read) -> None:
+        self._gauges[name] = (help_text, read)
+
+    @staticmethod
+    def _label(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _summary_lines(self, metric: str, label: str, histograms: dict) -> list:
+        lines = [f"# TYPE {metric} summary"]
+        for key, histogram in sorted(histograms.items()):
+            labels = f'{label}="{self._label(key)}"'
+            for q in self.QUANTILES:
+                lines.append(f'{metric}{{{labels},quantile="{q}"}} {histogram.percentile(q):.6f}')
+            lines.append(f"{metric}_sum{{{labels}}} {histogram.total_us / 1_000_000:.6f}")
+            lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        return lines
+
+    def prometheus_text(self) -> str:
+        lines = ["# TYPE bot_uptime_seconds gauge", f"bot_uptime_seconds {time.time() - self.started_at:.0f}"]
+        lines += self._summary_lines("bot_handler_latency_seconds", "handler", self.handler_latency)
+        lines.append("# TYPE bot_handler_errors_total counter")
+        for name, count in sorted(self.handler_errors.items()):
+            lines.append(f'bot_handler_errors_total{{handler="{self._label(name)}"}} {count}')
+        lines += self._summary_lines("bot_sheets_latency_seconds", "worksheet", self.sheets_latency)
+        lines.append("# TYPE bot_sheets_calls_total counter")
+        for (worksheet, method, handler), count in sorted(self.sheets_calls.items()):
+            lines.append(
+                f'bot_sheets_calls_total{{worksheet="{self._label(worksheet)}",method="{self._label(method)}",'
+                f'handler="{self._label(handler)}"}} {count}'
+            )
+        lines += ["# TYPE bot_cache_hits_total counter", "# TYPE bot_cache_misses_total counter"]
+        for name, cache in sorted(self._caches.items()):
+            lines.append(f'bot_cache_hits_total{{cache="{self._label(name)}"}} {cache.hits}')
+            lines.append(f'bot_cache_misses_total{{cache="{self._label(name)}"}} {cache.misses}')
+        for name, (help_text, read) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {read()}"]
+        return "\n".join(lines) + "\n"
+
+    def summary_text(self) -> str:
+        """Plain-text report for the /stats admin command."""
+        uptime_hours = (time.time() - self.started_at) / 3600
+        lines = [f"Uptime {uptime_hours:.1f} h", "", "Handlers: calls  p50/p99/max ms  errors"]
+        busiest = sorted(self.handler_latency.items(), key=lambda item: -item[1].count)[:STATS_TOP_N]
+        for name, h in busiest:
+            lines.append(
+                f"  {name[:24]:<24} {h.count:>6}  {h.percentile(0.5) * 1000:.1f}/{h.percentile(0.99) * 1000:.1f}"
+                f"/{h.max_us / 1000:.1f}  {self.handler_errors.get(name, 0)}"
+            )
+        lines += ["", "Sheets per worksheet: calls  p50/p99 ms"]
+        for worksheet, h in sorted(self.sheets_latency.items()):
+            lines.append(f"  {worksheet[:24]:<24} {h.count:>6}  {h.percentile(0.5) * 1000:.0f}/{h.percentile(0.99) * 1000:.0f}")
+        per_handler = {}
+        for (_, _, handler), count in self.sheets_calls.items():
+            per_handler[handler] = per_handler.get(handler, 0) + count
+        lines += ["", "Sheets calls per handler:"]
+        for handler, count in sorted(per_handler.items(), key=lambda item: -item[1])[:STATS_TOP_N]:
+            lines.append(f"  {handler[:24]:<24} {count:>6}")
+        lines += ["", "Caches: hit ratio (hits/lookups)"]
+        for name, cache in sorted(self._caches.items()):
+            lookups = cache.hits + cache.misses
+            ratio = cache.hits / lookups * 100 if lookups else 0.0
+            lines.append(f"  {name[:24]:<24} {ratio:5.1f}% ({cache.hits}/{lookups})")
+        if self._gauges:
+            lines += ["", "Gauges:"]
+            for name, (_, read) in sorted(self._gauges.items()):
+                lines.append(f"  {name[:32]:<32} {read()}")
+        return "\n".join(lines)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.prometheus_text(), content_type="text/plain", charset="utf-8")
+
+    async def start_server(self, host: str, port: int) -> None:
+        web_app = web.Application()
+        web_app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(web_app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+
+    async def stop_server(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
+
+def instrument_handlers(application: Application) -> None:
+    """Wraps the callback of every registered handler (inside conversations too) with timing."""
+    seen = set()
+
+    def wrap(handler) -> None:
+        if id(handler) in seen:
+            return
+        seen.add(id(handler))
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + [h for hs in handler.states.values() for h in hs] + handler.fallbacks:
+                wrap(inner)
+        else:
+            handler.callback = metrics.instrument(getattr(handler.callback, '__name__', 'handler'), handler.callback)
+
+    for group in application.handlers.values():
+        for handler in group:
+            wrap(handler)
+
 # --- 2. GOOGLE SHEETS INTEGRATION ---
 
-# Global variables for Sheets access
+# --- Sheets Quotas and Circuit Breaker ---
+# Google limits each user to a fixed number of read and write requests per minute and answers
+# anything above that with 429. The governor paces calls under those limits instead of letting
+# them fail, and the breaker stops hammering the API once calls keep failing after their retries;
+# while it is open, reads are answered from the last good result (see SheetsExecutor.run).
+
+class SheetsUnavailable(Exception):
+    """Raised instead of calling Google Sheets while the circuit breaker is open."""
+
+
+class QuotaGovernor:
+    """Sliding one-minute windows of Sheets read and write requests."""
+
+    WINDOW_SECONDS = 60
+
+    def __init__(self, reads_per_minute: int, writes_per_minute: int):
+        self._limits = {'read': reads_per_minute, 'write': writes_per_minute}
+        self._windows = {'read': deque(), 'write': deque()}  # kind -> monotonic timestamps of recent calls
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    async def acquire(self, kind: str) -> None:
+        """Waits until one more `kind` request fits in the last minute's quota, then claims it."""
+        window, limit = self._windows[kind], self._limits[kind]
+        while True:
+            now = time.monotonic()
+            while window and now - window[0] >= self.WINDOW_SECONDS:
+                window.popleft()
+            if len(window) < limit:
+                window.append(now)
+                return
+            delay = self.WINDOW_SECONDS - (now - window[0])
+            self.waits += 1
+            self.wait_seconds += delay
+            logger.info(f"Sheets {kind} quota used up, waiting {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; after `cooldown` seconds one trial call is allowed."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self._opened_at >= self._cooldown else 'open'
+
+    def allow(self) -> bool:
+        """True if a call may go out now. Half-open lets exactly one trial call through."""
+        if self._opened_at is None:
+            return True
+        if time.monotonic() - self._opened_at < self._cooldown or self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("Google Sheets is reachable again, circuit closed.")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def abandon_trial(self) -> None:
+        """The trial call was cancelled before Google answered; lets the next call be the trial instead."""
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._opened_at is not None:
+            self._opened_at = time.monotonic()  # Failed trial call: stay open for another cooldown
+        elif self._failures >= self._threshold:
+            self._opened_at = time.monotonic()
+            self.opens += 1
+            logger.error(
+                f"Google Sheets failed {self._failures} calls in a row, circuit open for {self._cooldown}s. "
+                f"Serving cached data where possible."
+            )
+
+
+# --- Read Coalescing ---
+# A burst of users browsing at once used to fire one identical get_all_records() each. Reads
+# with the same worksheet, method and arguments now share whichever request is already in
+# flight, so N simultaneous callers cost one API call. A write to a worksheet detaches its
+# in-flight reads so later reads still see the write. Results are shared, not copied: callers
+# must treat what a Sheets read returns as read-only.
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers asking for the same key."""
+
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task of the in-flight call
+        self.hits = 0     # Callers that joined a call already in flight
+        self.misses = 0   # Callers that had to start the call
+
+    async def do(self, key, factory):
+        """Awaits the in-flight call for `key`, starting `factory()` if there is none."""
+        task = self._calls.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.hits += 1
+        # Shielded so one caller being cancelled does not cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def forget(self, match) -> None:
+        """Stops new callers from joining in-flight calls whose key satisfies `match(key)`."""
+        for key in [key for key in self._calls if match(key)]:
+            del self._calls[key]
+
+    def _done(self, key, task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Marks the error as retrieved even if every caller went away
+
+
+# --- Sheets Executor ---
+# gspread is fully blocking (one HTTP round trip per call). Running it directly inside a
+# handler stalls the whole event loop, so every call is pushed onto a small thread pool.
+# Each worksheet gets its own FIFO queue so a slow Products read never delays Orders writes.
+
+class SheetsExecutor:
+    """Runs blocking gspread calls on a bounded thread pool with one queue per worksheet."""
+
+    # Method names that only read (`worksheet` looks a worksheet up by title); everything else counts as a write
+    READ_METHODS = ('get', 'batch_get', 'row_values', 'col_values', 'find', 'findall', 'acell', 'cell', 'range', 'worksheet')
+    # Writes that would duplicate or shift rows (or sheets) if a request that actually landed were repeated
+    NON_IDEMPOTENT_METHODS = {
+        'append_row', 'append_rows', 'insert_row', 'insert_rows', 'add_rows', 'delete_rows', 'delete_dimension_rows',
+        'add_cols', 'insert_cols', 'delete_columns', 'add_worksheet', 'duplicate_sheet',
+    }
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_workers: int, per_sheet_concurrency: int):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self._per_sheet_concurrency = per_sheet_concurrency
+        self._queues = {}  # worksheet title -> asyncio.Semaphore
+        self._stats = {}   # worksheet title -> counters (see _stats_for)
+        self.quota = QuotaGovernor(SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE)
+        self.breaker = CircuitBreaker(SHEETS_BREAKER_THRESHOLD, SHEETS_BREAKER_COOLDOWN)
+        self._last_good = {}  # (worksheet, method, args) -> last successful read result
+        self.reads = SingleFlight()
+        self.retries = 0
+        self.stale_served = 0
+
+    def _stats_for(self, sheet_name: str) -> dict:
+        if sheet_name not in self._stats:
+            self._stats[sheet_name] = {
+                'queued': 0, 'max_queued': 0, 'in_flight': 0,
+                'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            }
+        return self._stats[sheet_name]
+
+    @classmethod
+    def _retryable(cls, error: Exception, method: str) -> bool:
+        """Quota (429), server errors and dropped connections are transient; anything else is not."""
+        if isinstance(error, APIError):
+            status = error.response.status_code
+            if method in cls.NON_IDEMPOTENT_METHODS:
+                return status == 429  # Rejected before it was applied, so safe to send again
+            return status in cls.RETRYABLE_STATUS
+        return isinstance(error, (RequestsConnectionError, RequestsTimeout)) and method not in cls.NON_IDEMPOTENT_METHODS
+
+    @staticmethod
+    def _outage(error: Exception) -> bool:
+        """True if the error says Google is unreachable or over quota, as opposed to a bad request."""
+        if isinstance(error, APIError):
+            return error.response.status_code in SheetsExecutor.RETRYABLE_STATUS
+        return isinstance(error, (RequestsConnectionError, RequestsTimeout))
+
+    def _serve_stale(self, cache_key, sheet_name: str, method: str, error: Exception):
+        if cache_key is None or cache_key not in self._last_good:
+            raise error
+        self.stale_served += 1
+        logger.warning(f"Degraded mode: serving cached {sheet_name}.{method} result ({error}).")
+        return self._last_good[cache_key]
+
+    def _remember(self, cache_key, result) -> None:
+        self._last_good.pop(cache_key, None)
+        if len(self._last_good) >= SHEETS_STALE_CACHE_SIZE:
+            self._last_good.pop(next(iter(self._last_good)))
+        self._last_good[cache_key] = result
+
+    async def run(self, sheet_name: str, func, *args, **kwargs):
+        """Queues `func(*args, **kwargs)` behind the worksheet's earlier calls and awaits its result."""
+        method = getattr(func, '__name__', 'call')
+        kind = 'read' if method.startswith(self.READ_METHODS) else 'write'
+        if kind == 'write':
+            # Reads issued after this write must see it, so they may not join a read queued before it
+            self.reads.forget(lambda key: key[0] == sheet_name)
+            return await self._run(sheet_name, method, kind, None, func, args, kwargs)
+        cache_key = (sheet_name, method, repr(args), repr(sorted(kwargs.items())))
+        return await self.reads.do(cache_key, lambda: self._run(sheet_name, method, kind, cache_key, func, args, kwargs))
+
+    async def _run(self, sheet_name: str, method: str, kind: str, cache_key, func, args, kwargs):
+        if sheet_name not in self._queues:
+            self._queues[sheet_name] = asyncio.Semaphore(self._per_sheet_concurrency)
+        stats = self._stats_for(sheet_name)
+
+        stats['queued'] += 1
+        stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        if stats['queued'] >= SHEETS_QUEUE_WARN_DEPTH:
+            logger.warning(f"Sheets queue for '{sheet_name}' is {stats['queued']} calls deep.")
+
+        # The queue is held for one attempt at a time, never across a backoff sleep: a failing call
+        # must not stall every other read and write to its worksheet while it waits to retry
+        attempt = 0
+        while True:
+            async with self._queues[sheet_name]:
+                if attempt == 0:
+                    stats['queued'] -= 1
+                trial = self.breaker.state == 'half-open'
+                if not self.breaker.allow():
+                    return self._serve_stale(cache_key, sheet_name, method, SheetsUnavailable(
+                        f"Google Sheets circuit is open, {sheet_name}.{method} not attempted."))
+                try:
+                    await self.quota.acquire(kind)
+                    result = await self._call(sheet_name, method, func, args, kwargs)
+                except asyncio.CancelledError:
+                    if trial:
+                        self.breaker.abandon_trial()  # Else the circuit would stay half-open and refuse every call
+                    raise
+                except Exception as e:
+                    if not (self._retryable(e, method) and attempt < SHEETS_MAX_RETRIES and self.breaker.state == 'closed'):
+                        if not self._outage(e):
+                            self.breaker.record_success()  # Google answered; the request itself was bad
+                            raise
+                        self.breaker.record_failure()
+                        return self._serve_stale(cache_key, sheet_name, method, e)
+                    delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+                    attempt += 1
+                    self.retries += 1
+                    logger.warning(f"Sheets {sheet_name}.{method} failed ({e}), retry {attempt} in {delay:.1f}s.")
+                else:
+                    self.breaker.record_success()
+                    if cache_key is not None:
+                        self._remember(cache_key, result)
+                    return result
+            await asyncio.sleep(delay)
+
+    async def _call(self, sheet_name: str, method: str, func, args, kwargs):
+        """Runs one attempt of a call on the thread pool and records its latency."""
+        stats = self._stats_for(sheet_name)
+        stats['in_flight'] += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, functools.partial(func, *args, **kwargs))
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stats['in_flight'] -= 1
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            metrics.record_sheets_call(sheet_name, method, elapsed_ms / 1000)
+            if elapsed_ms >= SHEETS_SLOW_CALL_MS:
+                logger.warning(f"Slow Sheets call {sheet_name}.{method} took {elapsed_ms:.0f} ms.")
+
+    def stats(self) -> dict:
+        """Returns a snapshot of queue depth and latency per worksheet."""
+        snapshot = {}
+        for sheet_name, stats in self._stats.items():
+            entry = dict(stats)
+            entry['avg_ms'] = stats['total_ms'] / stats['calls'] if stats['calls'] else 0.0
+            snapshot[sheet_name] = entry
+        return snapshot
+
+    def shutdown(self) -> None:
+        for sheet_name, stats in self.stats().items():
+            logger.info(
+                f"Sheets '{sheet_name}': {stats['calls']} calls, {stats['errors']} errors, "
+                f"avg {stats['avg_ms']:.0f} ms, max {stats['max_ms']:.0f} ms, max queue {stats['max_queued']}."
+            )
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncWorksheet:
+    """
+    Awaitable view of a gspread Worksheet: every method call is routed through the
+    Sheets executor, e.g. `await products_sheet.get_all_records()`.
+    """
+
+    def __init__(self, worksheet, executor: SheetsExecutor):
+        self.worksheet = worksheet
+        self.title = worksheet.title
+        self._executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self.worksheet, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self._executor.run(self.title, attr, *args, **kwargs)
+        return call
+
+
+# --- Products Column Map ---
+# Column positions are resolved from the Products header once at startup (and again whenever the
+# header changes), so reads can ask for just the columns they need with one batch_get and writes
+# address cells by header name instead of assuming Stock is D and Delivery Content is E.
+
+class ColumnMap:
+    """Header name -> 1-based column number for a worksheet, resolved from its header row."""
+
+    REQUIRED = ('SKU', 'Name', 'Stock', 'Delivery Content')
+
+    def __init__(self, header: list):
+        self.header = [str(name) for name in header]
+        self._cols = {name: col for col, name in enumerate(self.header, start=1) if name}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._cols
+
+    def missing(self) -> list:
+        return [name for name in self.REQUIRED if name not in self._cols]
+
+    def letter(self, name: str) -> str:
+        return gspread.utils.rowcol_to_a1(1, self._cols[name])[:-1]
+
+    def cell(self, name: str, row_num: int) -> str:
+        return gspread.utils.rowcol_to_a1(row_num, self._cols[name])
+
+    def column_range(self, name: str) -> str:
+        """A1 range of a column's values below the header, e.g. 'D2:D'."""
+        letter = self.letter(name)
+        return f"{letter}2:{letter}"
+
+    def without(self, *names) -> list:
+        """Header names other than `names`, e.g. every column but the Delivery Content blobs."""
+        return [name for name in self.header if name and name not in names]
+
+
+sheets_executor = SheetsExecutor(SHEETS_MAX_WORKERS, SHEETS_PER_SHEET_CONCURRENCY)
+metrics.register_cache('sheets_reads', sheets_executor.reads)
+metrics.register_gauge('bot_sheets_retries_total', "Sheets calls retried after a transient error", lambda: sheets_executor.retries)
+metrics.register_gauge('bot_sheets_stale_served_total', "Sheets reads answered from cache during an outage", lambda: sheets_executor.stale_served)
+metrics.register_gauge('bot_sheets_quota_waits_total', "Sheets calls held back by the per-minute quota", lambda: sheets_executor.quota.waits)
+metrics.register_gauge('bot_sheets_breaker_opens_total', "Times the Sheets circuit breaker opened", lambda: sheets_executor.breaker.opens)
+metrics.register_gauge('bot_sheets_breaker_open', "1 while the Sheets circuit breaker is open", lambda: int(sheets_executor.breaker.state != 'closed'))
+
+# Global variables for Sheets access (AsyncWorksheet wrappers, set by init_sheets)
 gc = None
+spreadsheet = None
 products_sheet = None
 orders_sheet = None
 users_sheet = None
+products_columns = None  # ColumnMap of the Products header
 
 def init_sheets():
     """Initializes gspread client and loads all required worksheets."""
-    global gc, products_sheet, orders_sheet, users_sheet
+    global gc, spreadsheet, products_sheet, orders_sheet, users_sheet, products_columns
     try:
         logger.info(f"Attempting to authenticate with '{CREDENTIALS_FILE}'...")
         gc = gspread.service_account(filename=CREDENTIALS_FILE)
@@ -62,11 +776,25 @@ def init_sheets():
         spreadsheet = gc.open_by_key(SPREADSHEET_ID)
         
         # Load the specific worksheets (requires exact names: Products, Orders, Users)
-        products_sheet = spreadsheet.worksheet("Products")
-        orders_sheet = spreadsheet.worksheet("Orders")
-        users_sheet = spreadsheet.worksheet("Users")
+        products_sheet = AsyncWorksheet(spreadsheet.worksheet("Products"), sheets_executor)
+        orders_sheet = AsyncWorksheet(spreadsheet.worksheet("Orders"), sheets_executor)
+        users_sheet = AsyncWorksheet(spreadsheet.worksheet("Users"), sheets_executor)
+
+        products_columns = ColumnMap(products_sheet.worksheet.row_values(1))
+        if products_columns.missing():
+            logger.critical(f"FATAL: Products header is missing columns: {', '.join(products_columns.missing())}.")
+            raise RuntimeError("Sheets Initialization Failed (Missing column)")
+
+        # Known users are loaded once so /start only writes first-seen users
+        try:
+            user_registry.load(users_sheet.worksheet.get_all_values())
+            logger.info(f"Loaded {len(user_registry)} known users.")
+        except APIError as e:
+            logger.warning(f"Could not load known users, /start will re-learn them: {e}")
         
         logger.info("Google Sheets initialized successfully. Bot is ready.")
+    except RuntimeError:
+        raise
     except FileNotFoundError:
         logger.critical(f"FATAL: Credentials file '{CREDENTIALS_FILE}' not found. Check file path.")
         raise RuntimeError("Sheets Initialization Failed (Credentials missing)")
@@ -80,120 +808,1648 @@ def init_sheets():
         logger.critical(f"FATAL: Google Sheets initialization failed (Check API/Sharing): {e}")
         raise RuntimeError("Sheets Initialization Failed (General Error)")
 
-def get_product_data() -> dict:
+# --- Sheet Row Deletion ---
+# Archival deletes rows from Products and Orders, which renumbers every row below them. Work
+# that holds row numbers across awaits (delivery, order updates, appends, the Products sync)
+# runs inside sheet_rows_gate.shared(); the archive job takes the gate exclusively, so it
+# only deletes and renumbers while none of that work is in flight.
+
+class SheetRowsMoved(Exception):
+    """Raised when rows about to be deleted no longer hold the values they were chosen for."""
+
+
+class RowRenumberGate:
+    """Shared/exclusive gate: many tasks may use row numbers at once, or one task may renumber."""
+
+    def __init__(self):
+        self._active = 0
+        self._owner = None           # Task holding the gate exclusively
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._released = asyncio.Event()
+        self._released.set()
+
+    @asynccontextmanager
+    async def shared(self):
+        if self._owner is not None and self._owner is asyncio.current_task():
+            yield  # The renumbering task itself
+            return
+        while self._owner is not None:
+            await self._released.wait()
+        self._active += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._active -= 1
+            if not self._active:
+                self._idle.set()
+
+    @asynccontextmanager
+    async def exclusive(self, timeout: float):
+        """Waits up to `timeout` seconds for shared users to finish (asyncio.TimeoutError otherwise)."""
+        deadline = time.monotonic() + timeout
+        while self._owner is not None or self._active:
+            event = self._released if self._owner is not None else self._idle
+            await asyncio.wait_for(event.wait(), max(0.0, deadline - time.monotonic()))
+        self._owner = asyncio.current_task()
+        self._released.clear()
+        try:
+            yield
+        finally:
+            self._owner = None
+            self._released.set()
+
+
+sheet_rows_gate = RowRenumberGate()
+
+def delete_dimension_rows(spreadsheet, body: dict):
+    """Blocking: sends deleteDimension requests (kept apart so the executor never retries it on 5xx)."""
+    return spreadsheet.batch_update(body)
+
+async def delete_sheet_rows(worksheet: AsyncWorksheet, rows: dict) -> None:
+    """
+    Deletes {row number: expected first-cell value} from a worksheet in one request, after
+    checking that every row still holds that value (a hand edit may have moved rows since).
+    """
+    row_nums = sorted(rows)
+    found = await worksheet.batch_get([f"A{row_num}" for row_num in row_nums])
+    moved = [
+        row_num for row_num, cells in zip(row_nums, found)
+        if (cells[0][0] if cells and cells[0] else '') != str(rows[row_num])
+    ]
+    if moved:
+        raise SheetRowsMoved(f"'{worksheet.title}' rows {moved[:5]} no longer hold the rows chosen for deletion")
+
+    runs = []
+    for row_num in row_nums:
+        if runs and runs[-1][1] == row_num - 1:
+            runs[-1][1] = row_num
+        else:
+            runs.append([row_num, row_num])
+    # Bottom-up, so earlier deletions in the request do not shift the later ones
+    requests = [
+        {'deleteDimension': {'range': {'sheetId': worksheet.id, 'dimension': 'ROWS', 'startIndex': first - 1, 'endIndex': last}}}
+        for first, last in reversed(runs)
+    ]
+    await sheets_executor.run(worksheet.title, delete_dimension_rows, worksheet.spreadsheet, {'requests': requests})
+
+def renumber_after(removed: list):
+    """Returns old row number -> new row number once the sorted `removed` rows are gone."""
+    return lambda row_num: row_num - bisect.bisect_left(removed, row_num)
+
+# --- Storage Backends ---
+# The catalog, inventory and order functions read and write through `storage`. SheetsStorage
+# talks to the worksheets directly. SQLiteStorage keeps a local copy of the Products and Orders
+# grids (same row numbers as the sheet) as the primary store, and SheetsReplicator mirrors every
+# local change back to the worksheets in the background so the spreadsheet stays a usable dashboard.
+
+class Storage(ABC):
+    """Interface used by get_product_data, process_delivery_and_update_stock and log_order."""
+
+    async def start(self) -> None:
+        """Called once from post_init, before the caches are warmed."""
+
+    async def stop(self) -> None:
+        """Called once from post_shutdown."""
+
+    @abstractmethod
+    async def product_rows(self, columns: list = None) -> list:
+        """
+        Products grid as a `get_all_values()`-style list, header row included. With `columns`,
+        only those columns (in that order, unknown names skipped) are read; row numbers are unchanged.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delivery_content(self, row_nums: list) -> dict:
+        """Returns {row number: Delivery Content} for the given Products rows."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def mark_units_delivered(self, row_nums: list) -> None:
+        """Sets Stock=0 and Delivery Content=DELIVERED on the given Products rows, all or nothing."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def order_rows(self) -> list:
+        """Orders grid as a `get_all_values()`-style list, header row included."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def append_order(self, row: list) -> int | None:
+        """Stores a new order row. Returns its row number if already known."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_order(self, order_id: str) -> tuple[int, list]:
+        """Returns (row number, row values) for an OrderID."""
+        raise NotImplementedError
+
+    async def update_order_status(self, row_num: int, status: str) -> None:
+        await self.update_orders({row_num: {'Status': status}})
+
+    @abstractmethod
+    async def update_orders(self, changes: dict) -> None:
+        """Writes {row number: {column name: value}} to the Orders grid as one batch."""
+        raise NotImplementedError
+
+    async def apply_sheet_changes(self, sheet: str, changes: dict, replace: bool = False) -> None:
+        """Takes edits made directly in a sheet ({row_num: values or None}). No-op when Sheets is the store."""
+
+    @abstractmethod
+    async def delete_rows(self, sheet: str, rows: dict) -> None:
+        """Deletes {row number: first-cell value} from the Products or Orders grid; later rows move up."""
+        raise NotImplementedError
+
+    def writes_pending(self, sheet: str) -> bool:
+        """True while changes made locally (updates, appends, row deletions) have not reached the sheet yet."""
+        return False
+
+
+class SheetsStorage(Storage):
+    """Uses the Google Sheets worksheets as the system of record."""
+
+    async def product_rows(self, columns: list = None) -> list:
+        if columns is None:
+            return await products_sheet.get_all_values()
+        columns = [name for name in columns if name in products_columns]
+        value_ranges = await products_sheet.batch_get(
+            [products_columns.column_range(name) for name in columns], major_dimension=gspread.utils.Dimension.cols
+        )
+        # Each range comes back as one column with its trailing empty cells dropped
+        values = [value_range[0] if value_range else [] for value_range in value_ranges]
+        height = max((len(column) for column in values), default=0)
+        return [columns] + [[column[i] if i < len(column) else '' for column in values] for i in range(height)]
+
+    async def delivery_content(self, row_nums: list) -> dict:
+        # Consecutive rows are read as one range, e.g. E12:E15
+        runs = []
+        for row_num in sorted(set(row_nums)):
+            if runs and runs[-1][1] == row_num - 1:
+                runs[-1][1] = row_num
+            else:
+                runs.append([row_num, row_num])
+        letter = products_columns.letter('Delivery Content')
+        value_ranges = await products_sheet.batch_get([f"{letter}{first}:{letter}{last}" for first, last in runs])
+        contents = {}
+        for (first, last), value_range in zip(runs, value_ranges):
+            for offset in range(last - first + 1):
+                cells = value_range[offset] if offset < len(value_range) else []
+                contents[first + offset] = cells[0] if cells else ''
+        return contents
+
+    async def mark_units_delivered(self, row_nums: list) -> None:
+        update_range = []
+        for row_num in row_nums:
+            update_range.append({'range': products_columns.cell('Stock', row_num), 'values': [[0]]})
+            update_range.append({'range': products_columns.cell('Delivery Content', row_num), 'values': [[DELIVERED_MARKER]]})
+        await products_sheet.batch_update(update_range)
+
+    async def order_rows(self) -> list:
+        await orders_writer.flush()
+        return await orders_sheet.get_all_values()
+
+    async def append_order(self, row: list) -> int | None:
+        # Row number is learned when the write-behind buffer flushes (see _on_orders_flushed)
+        await orders_writer.append(row)
+        return None
+
+    async def find_order(self, order_id: str) -> tuple[int, list]:
+        # The order row may still be sitting in the write-behind buffer
+        await orders_writer.flush()
+        cell = await orders_sheet.find(order_id, in_column=1)
+        return cell.row, await orders_sheet.row_values(cell.row)
+
+    async def update_orders(self, changes: dict) -> None:
+        update_range = [
+            {'range': gspread.utils.rowcol_to_a1(row_num, ORDER_COLUMNS.index(column) + 1), 'values': [[value]]}
+            for row_num, fields in changes.items()
+            for column, value in fields.items()
+        ]
+        if update_range:
+            await orders_sheet.batch_update(update_range)
+
+    async def delete_rows(self, sheet: str, rows: dict) -> None:
+        await delete_sheet_rows({"Products": products_sheet, "Orders": orders_sheet}[sheet], rows)
+
+
+class SQLiteStorage(Storage):
+    """
+    Local SQLite (WAL mode) copy of the Products and Orders grids used as the primary store.
+    Every change is also queued in an outbox table that SheetsReplicator drains to the sheets.
+    """
+
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS sheet_rows (
+                sheet TEXT NOT NULL,
+                row_num INTEGER NOT NULL,
+                key TEXT,
+                vals TEXT NOT NULL,
+                PRIMARY KEY (sheet, row_num)
+            );
+            CREATE INDEX IF NOT EXISTS sheet_rows_key ON sheet_rows (sheet, key);
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sheet TEXT NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL
+            );
+        """)
+        self.replicator = None
+
+    # Low-level helpers (synchronous; each call is a local transaction taking microseconds)
+
+    def _rows(self, sheet: str) -> list:
+        grid = []
+        for row_num, vals in self._db.execute(
+            "SELECT row_num, vals FROM sheet_rows WHERE sheet = ? ORDER BY row_num", (sheet,)
+        ):
+            while len(grid) < row_num - 1:
+                grid.append([])
+            grid.append(json.loads(vals))
+        return grid
+
+    def _row(self, sheet: str, row_num: int) -> list | None:
+        found = self._db.execute(
+            "SELECT vals FROM sheet_rows WHERE sheet = ? AND row_num = ?", (sheet, row_num)
+        ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def _put_row(self, sheet: str, row_num: int, vals: list) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO sheet_rows (sheet, row_num, key, vals) VALUES (?, ?, ?, ?)",
+            (sheet, row_num, str(vals[0]) if vals else None, json.dumps(vals)),
+        )
+
+    def _queue(self, sheet: str, op: str, payload) -> None:
+        self._db.execute("INSERT INTO outbox (sheet, op, payload) VALUES (?, ?, ?)", (sheet, op, json.dumps(payload)))
+
+    def _has_pending(self, sheet: str) -> bool:
+        return self._db.execute("SELECT 1 FROM outbox WHERE sheet = ? LIMIT 1", (sheet,)).fetchone() is not None
+
+    def writes_pending(self, sheet: str) -> bool:
+        return self._has_pending(sheet)
+
+    def import_grid(self, sheet: str, all_values: list) -> None:
+        """Replaces the local copy of a sheet with a `get_all_values()` snapshot."""
+        self._db.execute("BEGIN")
+        try:
+            self._db.execute("DELETE FROM sheet_rows WHERE sheet = ?", (sheet,))
+            for row_index, vals in enumerate(all_values):
+                self._put_row(sheet, row_index + 1, vals)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def pending_ops(self, limit: int, skip_sheets=()) -> list:
+        skip_sheets = list(skip_sheets)
+        placeholders = ", ".join("?" * len(skip_sheets))
+        return [
+            (op_id, sheet, op, json.loads(payload))
+            for op_id, sheet, op, payload in self._db.execute(
+                f"SELECT id, sheet, op, payload FROM outbox WHERE sheet NOT IN ({placeholders}) ORDER BY id LIMIT ?",
+                (*skip_sheets, limit),
+            )
+        ]
+
+    def ack_ops(self, op_ids: list) -> None:
+        self._db.executemany("DELETE FROM outbox WHERE id = ?", [(op_id,) for op_id in op_ids])
+
+    def snapshot_for_resync(self, sheet: str) -> list:
+        """The local grid of a sheet, with its queued changes dropped (the grid already contains them)."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            grid = self._rows(sheet)
+            self._db.execute("DELETE FROM outbox WHERE sheet = ?", (sheet,))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return grid
+
+    # Storage interface
+
+    async def start(self) -> None:
+        # Products are edited by humans in the sheet, so re-import them unless local changes
+        # are still waiting to be mirrored. Orders are only imported into an empty store.
+        if not self._has_pending("Products"):
+            self.import_grid("Products", await products_sheet.get_all_values())
+        if not self._rows("Orders"):
+            self.import_grid("Orders", await orders_sheet.get_all_values())
+        self.replicator = SheetsReplicator(self, {"Products": lambda: products_sheet, "Orders": lambda: orders_sheet})
+        self.replicator.start()
+
+    async def stop(self) -> None:
+        if self.replicator:
+            await self.replicator.stop()
+        self._db.close()
+
+    async def product_rows(self, columns: list = None) -> list:
+        grid = self._rows("Products")
+        if columns is None or not grid:
+            return grid
+        header = grid[0]
+        indexes = [header.index(name) for name in columns if name in header]
+        return [[header[i] for i in indexes]] + [[row[i] if i < len(row) else '' for i in indexes] for row in grid[1:]]
+
+    async def delivery_content(self, row_nums: list) -> dict:
+        delivery_col_index = self._row("Products", 1).index('Delivery Content')
+        contents = {}
+        for row_num in row_nums:
+            vals = self._row("Products", row_num) or []
+            contents[row_num] = vals[delivery_col_index] if len(vals) > delivery_col_index else ''
+        return contents
+
+    async def mark_units_delivered(self, row_nums: list) -> None:
+        header = self._row("Products", 1)
+        stock_col_index = header.index('Stock')
+        delivery_col_index = header.index('Delivery Content')
+
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            update_range = []
+            for row_num in row_nums:
+                vals = self._row("Products", row_num)
+                if vals is None or len(vals) <= delivery_col_index or vals[delivery_col_index].strip() in ('', DELIVERED_MARKER):
+                    raise RuntimeError(f"Products row {row_num} is no longer available")
+                vals[stock_col_index] = "0"
+                vals[delivery_col_index] = DELIVERED_MARKER
+                self._put_row("Products", row_num, vals)
+                update_range.append({'range': gspread.utils.rowcol_to_a1(row_num, stock_col_index + 1), 'values': [[0]]})
+                update_range.append({'range': gspread.utils.rowcol_to_a1(row_num, delivery_col_index + 1), 'values': [[DELIVERED_MARKER]]})
+            self._queue("Products", "update", update_range)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self.replicator.notify()
+
+    async def order_rows(self) -> list:
+        return self._rows("Orders")
+
+    async def apply_sheet_changes(self, sheet: str, changes: dict, replace: bool = False) -> None:
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            if replace:
+                self._db.execute("DELETE FROM sheet_rows WHERE sheet = ?", (sheet,))
+            for row_num, vals in changes.items():
+                if vals is None:
+                    self._db.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row_num = ?", (sheet, row_num))
+                else:
+                    self._put_row(sheet, row_num, vals)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    async def delete_rows(self, sheet: str, rows: dict) -> None:
+        removed = sorted(rows)
+        new_row_num = renumber_after(removed)
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            for row_num in removed:
+                self._db.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row_num = ?", (sheet, row_num))
+            moved = self._db.execute(
+                "SELECT row_num, vals FROM sheet_rows WHERE sheet = ? AND row_num > ? ORDER BY row_num", (sheet, removed[0])
+            ).fetchall()
+            self._db.execute("DELETE FROM sheet_rows WHERE sheet = ? AND row_num > ?", (sheet, removed[0]))
+            for row_num, vals in moved:
+                self._put_row(sheet, new_row_num(row_num), json.loads(vals))
+            # Queued behind the updates still addressed to the old row numbers
+            self._queue(sheet, "delete", {str(row_num): key for row_num, key in rows.items()})
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self.replicator.notify()
+
+    async def append_order(self, row: list) -> int | None:
+        vals = ["" if v is None else str(v) for v in row]
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row_num = self._db.execute(
+                "SELECT COALESCE(MAX(row_num), 1) + 1 FROM sheet_rows WHERE sheet = 'Orders'"
+            ).fetchone()[0]
+            self._put_row("Orders", row_num, vals)
+            self._queue("Orders", "append", {'row_num': row_num, 'rows': [vals]})
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self.replicator.notify()
+        return row_num
+
+    async def find_order(self, order_id: str) -> tuple[int, list]:
+        found = self._db.execute(
+            "SELECT row_num, vals FROM sheet_rows WHERE sheet = 'Orders' AND key = ?", (order_id,)
+        ).fetchone()
+        if not found:
+            raise KeyError(f"Order {order_id} not found")
+        return found[0], json.loads(found[1])
+
+    async def update_orders(self, changes: dict) -> None:
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            update_range = []
+            for row_num, fields in changes.items():
+                vals = self._row("Orders", row_num)
+                if vals is None:
+                    # e.g. a stale order index entry for a row archival has moved or removed
+                    raise KeyError(f"Orders row {row_num} not found")
+                for column, value in fields.items():
+                    col_index = ORDER_COLUMNS.index(column)
+                    while len(vals) <= col_index:
+                        vals.append("")
+                    vals[col_index] = value
+                    update_range.append({'range': gspread.utils.rowcol_to_a1(row_num, col_index + 1), 'values': [[value]]})
+                self._put_row("Orders", row_num, vals)
+            self._queue("Orders", "update", update_range)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self.replicator.notify()
+
+
+class SheetsReplicator:
+    """
+    Background task that drains the SQLite outbox to the worksheets. Consecutive operations
+    on the same sheet are merged into a single `batch_update` or `append_rows` call.
+
+    If an archival delete finds the sheet's rows moved (hand edits), the local rows have been
+    renumbered but the sheet's have not, so every later row-addressed write would land on the
+    wrong row. Replication of that sheet is halted, its outbox is kept, and `on_halted` alerts
+    the admin, who overwrites the sheet from the local copy with /resync.
+    """
+
+    def __init__(self, store: SQLiteStorage, sheets: dict):
+        self._store = store
+        self._sheets = sheets  # sheet name -> callable returning its AsyncWorksheet
+        self._wake = asyncio.Event()
+        self._task = None
+        self.halted = {}       # sheet name -> reason replication of it stopped
+        self.on_halted = None  # callback(sheet, reason), set by post_init
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.drain()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=REPLICATION_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if not await self.drain():
+                await asyncio.sleep(REPLICATION_RETRY_SECONDS)
+
+    def halt(self, sheet: str, reason: str) -> None:
+        logger.critical(f"Replication to '{sheet}' halted, the sheet no longer matches the local rows: {reason}")
+        self.halted[sheet] = reason
+        if self.on_halted:
+            self.on_halted(sheet, reason)
+
+    async def resync(self, sheet: str) -> int:
+        """Overwrites a worksheet with the local copy and resumes its replication. Returns rows written."""
+        worksheet = self._sheets[sheet]()
+        # Later local changes are queued against the snapshot's row numbers, so they replay on top
+        grid = self._store.snapshot_for_resync(sheet)
+        await worksheet.clear()
+        if grid:
+            await worksheet.update(values=grid, range_name="A1")
+        self.halted.pop(sheet, None)
+        logger.info(f"Rewrote '{sheet}' from the local copy ({len(grid)} rows); replication resumed.")
+        self.notify()
+        return len(grid)
+
+    async def drain(self) -> bool:
+        """Mirrors queued changes to the sheets (except halted ones). Returns False if a sheet call failed."""
+        while True:
+            ops = self._store.pending_ops(REPLICATION_BATCH_SIZE, skip_sheets=self.halted)
+            if not ops:
+                return True
+            # Take the leading run of operations with the same sheet and kind
+            _, sheet, op, _ = ops[0]
+            batch = []
+            for entry in ops:
+                if entry[1] != sheet or entry[2] != op:
+                    break
+                batch.append(entry)
+
+            worksheet = self._sheets[sheet]()
+            try:
+                if op == "delete":
+                    # Every delete renumbers the rows after it, so deletes are sent one at a time
+                    batch = batch[:1]
+                    try:
+                        await delete_sheet_rows(worksheet, {int(row_num): key for row_num, key in batch[0][3].items()})
+                    except SheetRowsMoved as e:
+                        # Not acked: the delete and everything after it wait for /resync
+                        self.halt(sheet, str(e))
+                        continue
+                elif op == "append":
+                    rows = [row for entry in batch for row in entry[3]['rows']]
+                    response = await worksheet.append_rows(rows)
+                    first_row = _first_appended_row(response)
+                    if first_row and first_row != batch[0][3]['row_num']:
+                        logger.warning(
+                            f"{sheet} rows were appended at row {first_row}, expected {batch[0][3]['row_num']}. "
+                            "Was the sheet edited by hand?"
+                        )
+                else:
+                    await worksheet.batch_update([item for entry in batch for item in entry[3]])
+            except Exception as e:
+                logger.error(f"Replicating {len(batch)} {op} operations to '{sheet}' failed, will retry: {e}")
+                return False
+            self._store.ack_ops([entry[0] for entry in batch])
+
+
+storage = None
+
+def init_storage() -> None:
+    """Creates the configured storage backend (see STORAGE_BACKEND)."""
+    global storage
+    if STORAGE_BACKEND == "sqlite":
+        try:
+            storage = SQLiteStorage(STORAGE_DB_FILE)
+        except sqlite3.Error as e:
+            logger.critical(f"FATAL: Could not open local database '{STORAGE_DB_FILE}': {e}")
+            raise RuntimeError("Storage Initialization Failed (SQLite)")
+        logger.info(f"Using local SQLite storage '{STORAGE_DB_FILE}' with Sheets as a mirror.")
+    else:
+        storage = SheetsStorage()
+        logger.info("Using Google Sheets storage.")
+
+async def fetch_product_data() -> dict:
     """
     Reads all product data and consolidates by Product Name, summing the stock, 
     to ensure only one entry per unique product is displayed.
+    Always reads storage; handlers should use get_product_data() instead.
     """
     try:
-        # Get all records for consolidation logic
-        data = products_sheet.get_all_records()
-        consolidated_products = {}
+        # Every column but the Delivery Content blobs, which the catalog never shows
+        all_values = await storage.product_rows(products_columns.without('Delivery Content'))
+        return consolidate_products(all_values[0], all_values[1:])
+    except Exception as e:
+        logger.error(f"Error reading product data: {e}")
+        return {}
+
+def consolidate_products(header: list, rows: list) -> dict:
+    """Builds the SKU -> product map from Products rows, one entry per product name with summed Stock."""
+    data = [dict(zip(header, row)) for row in rows]
+    consolidated_products = {}
+    
+    for row in data:
+        name = row.get('Name')
+        sku = row.get('SKU')
         
-        for row in data:
-            name = row.get('Name')
-            sku = row.get('SKU')
+        if not name or not sku:
+            continue
+
+        try:
+            # Stock should be 1 for items ready for sale, 0 for items sold
+            current_stock = int(row.get('Stock', 0)) 
+        except (ValueError, TypeError):
+            current_stock = 0
+        
+        # Use Product Name as the primary consolidation key
+        consolidation_key = name.strip().upper()
+
+        if consolidation_key in consolidated_products:
+            # Sum the stock from all duplicate rows
+            existing_entry = consolidated_products[consolidation_key]
+            existing_entry['Stock'] += current_stock
+        else:
+            # First time seeing this product name
+            row['Stock'] = current_stock
+            consolidated_products[consolidation_key] = row
             
-            if not name or not sku:
-                continue
+    # The key for the final dict is the SKU of the first entry found for that product name
+    final_products = {p['SKU']: p for p in consolidated_products.values()}
+        
+    return final_products
+
+# --- Product Catalog Cache ---
+
+class CatalogCache:
+    """
+    Holds the consolidated SKU -> product map in memory. Reads never wait on the sheet
+    once it is loaded: stale data is served while a single background refresh runs.
+    `version` increases every time the catalog content changes.
+    """
+
+    def __init__(self, loader, ttl_seconds: float):
+        self._loader = loader
+        self._ttl = ttl_seconds
+        self._products = {}
+        self._loaded_at = None  # time.monotonic() of the last successful load
+        self._refresh_task = None
+        self.version = 0
+        self.category_names = []  # Sorted category names
+        self._category_skus = []  # SKUs per category (same order), sorted by product name
+        self.hits = 0
+        self.misses = 0
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self._ttl
+
+    async def get(self) -> dict:
+        """Returns the cached catalog, loading it synchronously only on a cold cache."""
+        if self._loaded_at is None:
+            self.misses += 1
+            await self.refresh()
+        else:
+            self.hits += 1
+            if self.is_stale():
+                self._schedule_refresh()
+        return self._products
+
+    async def refresh(self) -> dict:
+        """Reloads the catalog from the sheet. Concurrent callers share one in-flight load."""
+        await asyncio.shield(self._schedule_refresh())
+        return self._products
+
+    def invalidate(self) -> None:
+        """Marks the catalog stale after a write and starts a background reload."""
+        if self._loaded_at is not None:
+            self._loaded_at -= self._ttl
+        self._schedule_refresh()
+
+    def apply_products(self, affected_keys: set, products: dict) -> None:
+        """Replaces the entries of the given normalized product names (used by the sheet sync)."""
+        updated = {
+            sku: p for sku, p in self._products.items()
+            if str(p.get('Name', '')).strip().upper() not in affected_keys
+        }
+        updated.update(products)
+        if updated != self._products:
+            self._set_products(updated)
+
+    def _set_products(self, products: dict) -> None:
+        """Swaps in a new catalog and rebuilds the per-category browse index."""
+        by_category = {}
+        for sku, product in products.items():
+            category = str(product.get('Category') or '').strip() or DEFAULT_CATEGORY
+            by_category.setdefault(category, []).append(sku)
+        for skus in by_category.values():
+            skus.sort(key=lambda sku: str(products[sku].get('Name', '')).lower())
+        self._products = products
+        self.category_names = sorted(by_category)
+        self._category_skus = [by_category[name] for name in self.category_names]
+        self.version += 1
+
+    def category_size(self, category_index: int) -> int:
+        return len(self._category_skus[category_index])
+
+    def category_page(self, category_index: int, page: int, page_size: int) -> tuple[list, int, int]:
+        """(SKUs on the page, clamped page number, page count) for one category."""
+        skus = self._category_skus[category_index]
+        page_count = max(1, -(-len(skus) // page_size))
+        page = min(max(page, 0), page_count - 1)
+        return skus[page * page_size:(page + 1) * page_size], page, page_count
+
+    def _schedule_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._do_refresh())
+        return self._refresh_task
+
+    async def _do_refresh(self) -> None:
+        products = await self._loader()
+        if not products:
+            # Loader already logged the failure; keep serving the last good catalog.
+            return
+        if products != self._products:
+            self._set_products(products)
+        self._loaded_at = time.monotonic()
+
+
+catalog_cache = CatalogCache(fetch_product_data, CATALOG_TTL_SECONDS)
+metrics.register_cache('catalog', catalog_cache)
+
+async def get_product_data() -> dict:
+    """Returns the consolidated product catalog from the in-memory cache."""
+    return await catalog_cache.get()
+
+async def refresh_catalog_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that keeps the catalog warm between browses."""
+    await catalog_cache.refresh()
+
+# --- Product Search Index ---
+# Inline mode (`@bot keyword`) searches product Name and SKU. The index is rebuilt whenever the
+# catalog version changes and answers from memory: queries of one or two characters match word
+# prefixes, longer ones are substring matches found through trigram postings.
+
+class ProductSearchIndex:
+    """Prefix/trigram index over "name sku" of every catalog product, with a per-query result cache."""
+
+    def __init__(self, cache_size: int):
+        self._cache_size = cache_size
+        self._version = None
+        self._text = {}      # sku -> lowercase "name sku", in sorted order
+        self._prefixes = {}  # one/two character word prefix -> set of skus
+        self._trigrams = {}  # three character substring -> set of skus
+        self._results = {}   # normalized query -> matching skus, sorted by name
+        self.hits = 0
+        self.misses = 0
+
+    def _build(self, products: dict) -> None:
+        self._text, self._prefixes, self._trigrams, self._results = {}, {}, {}, {}
+        texts = {sku: f"{product.get('Name', '')} {sku}".lower() for sku, product in products.items()}
+        for sku, text in sorted(texts.items(), key=lambda item: item[1]):
+            self._text[sku] = text
+            for word in text.split():
+                self._prefixes.setdefault(word[:1], set()).add(sku)
+                if len(word) > 1:
+                    self._prefixes.setdefault(word[:2], set()).add(sku)
+            for i in range(len(text) - 2):
+                self._trigrams.setdefault(text[i:i + 3], set()).add(sku)
+        self._version = catalog_cache.version
+
+    def search(self, query: str, products: dict) -> list:
+        """SKUs matching `query`, sorted by name (all products for an empty query)."""
+        if self._version != catalog_cache.version:
+            self._build(products)
+        query = " ".join(query.lower().split())
+        if not query:
+            return list(self._text)
 
+        matches = self._results.get(query)
+        if matches is not None:
+            self.hits += 1
+            return matches
+        self.misses += 1
+
+        # A cached shorter substring query already holds every candidate; just narrow it down
+        for end in range(len(query) - 1, 2, -1):
+            base = self._results.get(query[:end])
+            if base is not None:
+                matches = [sku for sku in base if query in self._text[sku]]
+                break
+        else:
+            matches = self._lookup(query)
+
+        if len(self._results) >= self._cache_size:
+            self._results.clear()
+        self._results[query] = matches
+        return matches
+
+    def _lookup(self, query: str) -> list:
+        if len(query) < 3:
+            found = self._prefixes.get(query, set())
+        else:
+            postings = [self._trigrams.get(query[i:i + 3]) for i in range(len(query) - 2)]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            found = set.intersection(*postings)
+            if len(query) > 3:
+                found = {sku for sku in found if query in self._text[sku]}
+        return sorted(found, key=self._text.__getitem__)
+
+
+product_search = ProductSearchIndex(INLINE_QUERY_CACHE_SIZE)
+metrics.register_cache('inline_search', product_search)
+
+# --- Inventory Index ---
+# Each sellable unit is one Products row (Stock=1 plus its Delivery Content). The index keeps,
+# per normalized product name, a deque of the rows still on sale so fulfilment can pop units
+# directly instead of downloading and scanning the whole sheet for every order.
+
+DELIVERED_MARKER = "DELIVERED"
+
+class InventoryIndex:
+    """Normalized product name -> deque of (row number, Delivery Content) for units on sale."""
+
+    def __init__(self):
+        self._pools = {}        # normalized name -> deque[(row_num, content)]
+        self._indexed = {}      # row_num -> normalized name, for rows currently in a pool
+        self._taken = set()     # rows popped for an order whose sheet write is still pending
+        self._delivered = set() # rows written as DELIVERED; never re-enter the index
+        self.loaded = False
+        self.built_at = 0.0     # time.monotonic() of the last full build
+        self.version = 0        # Bumped whenever any product's available count may have changed
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return str(name).strip().upper()
+
+    def build(self, all_values: list) -> None:
+        """
+        (Re)builds the index from a `get_all_values()` snapshot, header row included. The snapshot
+        may be just the COLUMNS below; units are then indexed without their content, which
+        with_delivery_content() fetches for the rows an order actually gets.
+        """
+        header = all_values[0]
+        name_col_index = header.index('Name')
+        stock_col_index = header.index('Stock')
+        delivery_col_index = header.index('Delivery Content') if 'Delivery Content' in header else None
+
+        self._pools = {}
+        self._indexed = {}
+        for row_index, row in enumerate(all_values[1:]):
             try:
-                # Stock should be 1 for items ready for sale, 0 for items sold
-                current_stock = int(row.get('Stock', 0)) 
-            except (ValueError, TypeError):
-                current_stock = 0
-            
-            # Use Product Name as the primary consolidation key
-            consolidation_key = name.strip().upper()
+                name = row[name_col_index]
+                stock = row[stock_col_index]
+                content = row[delivery_col_index] if delivery_col_index is not None else None
+            except IndexError:
+                continue
+            self.add_row(row_index + 2, name, stock, content)
+        self.loaded = True
+        self.built_at = time.monotonic()
+        self.version += 1
+
+    def add_row(self, row_num: int, name: str, stock, content: str | None) -> bool:
+        """Indexes one sheet row if it is a sellable unit (content None = not read yet). Returns True if it was added."""
+        if row_num in self._indexed or row_num in self._taken or row_num in self._delivered:
+            return False
+        try:
+            current_stock = int(stock)
+        except (ValueError, TypeError):
+            current_stock = 0 # Treat non-numeric/missing stock as 0
+        if not str(name).strip() or current_stock < 1:
+            return False
+        if content is not None:
+            content = str(content).strip()
+            if not content or content == DELIVERED_MARKER:
+                return False
+
+        key = self.normalize(name)
+        self._pools.setdefault(key, deque()).append((row_num, content))
+        self._indexed[row_num] = key
+        self.version += 1
+        return True
+
+    def discard_row(self, row_num: int) -> None:
+        """Removes a row that is no longer sellable (e.g. edited or deleted in the sheet)."""
+        key = self._indexed.pop(row_num, None)
+        if key is None:
+            return
+        pool = self._pools[key]
+        for unit in pool:
+            if unit[0] == row_num:
+                pool.remove(unit)
+                break
+        self.version += 1
+
+    def apply_row(self, row_num: int, name: str, stock, content: str) -> None:
+        """Re-indexes a row after it was edited in the sheet. Rows held by open orders are left alone."""
+        if row_num in self._taken:
+            return
+        self.discard_row(row_num)
+        self._delivered.discard(row_num)
+        self.add_row(row_num, name, stock, content)
+
+    def available(self, product_name: str) -> int:
+        return len(self._pools.get(self.normalize(product_name), ()))
+
+    def take(self, product_name: str, quantity: int) -> list | None:
+        """Pops `quantity` units for a product, or returns None (and pops nothing) if short."""
+        pool = self._pools.get(self.normalize(product_name))
+        if quantity <= 0 or not pool or len(pool) < quantity:
+            return None
+        units = [pool.popleft() for _ in range(quantity)]
+        for row_num, _ in units:
+            del self._indexed[row_num]
+            self._taken.add(row_num)
+        self.version += 1
+        return units
+
+    def put_back(self, product_name: str, units: list) -> None:
+        """Returns units that could not be delivered to the front of their pool."""
+        key = self.normalize(product_name)
+        pool = self._pools.setdefault(key, deque())
+        for row_num, content in reversed(units):
+            self._taken.discard(row_num)
+            pool.appendleft((row_num, content))
+            self._indexed[row_num] = key
+        self.version += 1
+
+    def take_back(self, product_name: str, units: list) -> list | None:
+        """Pops exactly these units out of their pool again (undoing put_back), or pops nothing if one is gone."""
+        key = self.normalize(product_name)
+        row_nums = {row_num for row_num, _ in units}
+        if any(self._indexed.get(row_num) != key for row_num in row_nums):
+            return None
+        pool = self._pools[key]
+        taken = [unit for unit in pool if unit[0] in row_nums]
+        self._pools[key] = deque(unit for unit in pool if unit[0] not in row_nums)
+        for row_num in row_nums:
+            del self._indexed[row_num]
+            self._taken.add(row_num)
+        self.version += 1
+        return taken
+
+    def renumber(self, removed: list, new_row_num) -> None:
+        """Forgets the archived (delivered) rows and moves every other tracked row to `new_row_num(row)`."""
+        gone = set(removed)
+        self._pools = {
+            key: deque((new_row_num(row_num), content) for row_num, content in pool) for key, pool in self._pools.items()
+        }
+        self._indexed = {new_row_num(row_num): key for row_num, key in self._indexed.items()}
+        self._taken = {new_row_num(row_num) for row_num in self._taken}
+        self._delivered = {new_row_num(row_num) for row_num in self._delivered if row_num not in gone}
+
+    def drop_taken(self, row_nums: list) -> None:
+        """Forgets taken rows that turned out to have no deliverable content (a later sync may re-add them)."""
+        for row_num in row_nums:
+            self._taken.discard(row_num)
+
+    def confirm_delivered(self, units: list) -> None:
+        """Marks units as permanently gone once their DELIVERED write has succeeded."""
+        for row_num, _ in units:
+            self._taken.discard(row_num)
+            self._delivered.add(row_num)
+
+
+inventory_index = InventoryIndex()
+
+async def load_inventory_index() -> None:
+    """Reads the Name and Stock columns once and rebuilds the inventory index from them."""
+    all_data = await storage.product_rows(['Name', 'Stock'])
+    inventory_index.build(all_data)
+    logger.info(f"Inventory index built from {len(all_data) - 1} product rows.")
+
+async def take_order_units(product_name: str, quantity: int, order_id: str = None, with_content: bool = True) -> list | None:
+    """Units for an order: its checkout reservation if it matches, otherwise fresh units from the index."""
+    reservation = reservations.claim(order_id) if order_id else None
+    if reservation and len(reservation['units']) == quantity:
+        units = reservation['units']
+    else:
+        if reservation:
+            inventory_index.put_back(reservation['name'], reservation['units'])
+        units = await reservations.take_units(product_name, quantity)
+    if units is None or not with_content:
+        return units
+    try:
+        return (await with_delivery_content([(product_name, units)]))[0]
+    except Exception:
+        # with_delivery_content put the units back in stock, but reserved ones still belong to the order
+        if reservation is not None and units is reservation['units']:
+            reservations.reclaim(order_id, product_name, units, pinned=reservation['expires_at'] is None)
+        raise
+
+async def with_delivery_content(orders: list) -> list:
+    """
+    Fills in the Delivery Content of taken units, for several orders ([(product name, units)])
+    with one storage read. Rows found empty or already DELIVERED are dropped and replaced from
+    stock. Returns the completed units per order, or None for an order that can no longer be
+    filled (its units are put back). If storage fails, every unit is put back and it re-raises.
+    """
+    results = [list(units) for _, units in orders]
+    pending = list(range(len(orders)))
+    while pending:
+        missing = [row_num for i in pending for row_num, content in results[i] if content is None]
+        try:
+            contents = await storage.delivery_content(missing) if missing else {}
+        except Exception:
+            for (product_name, _), units in zip(orders, results):
+                if units:
+                    inventory_index.put_back(product_name, units)
+            raise
+
+        still_pending = []
+        for i in pending:
+            product_name = orders[i][0]
+            ready, dead = [], []
+            for row_num, content in results[i]:
+                content = str(contents.get(row_num, '')).strip() if content is None else content
+                if content and content != DELIVERED_MARKER:
+                    ready.append((row_num, content))
+                else:
+                    dead.append(row_num)
+            results[i] = ready
+            if not dead:
+                continue
+            logger.warning(f"Products rows {dead} for '{product_name}' have no deliverable content; taking replacements.")
+            inventory_index.drop_taken(dead)
+            replacements = await reservations.take_units(product_name, len(dead))
+            if replacements is None:
+                inventory_index.put_back(product_name, ready)
+                results[i] = None
+                continue
+            results[i] = ready + replacements
+            still_pending.append(i)
+        pending = still_pending
+    return results
+
+async def process_delivery_and_update_stock(product_name: str, quantity: int, order_id: str = None) -> tuple[str, bool]:
+    """
+    Takes the exact number of units (equal to quantity) for the product name, using the
+    units reserved for `order_id` at checkout when there are any, and marks their rows
+    as sold (Stock=0, Content=DELIVERED).
+    Returns the concatenated delivery content and success status.
+    
+    NOTE: This assumes each row with Stock=1 and Delivery Content represents 1 unit.
+    """
+    try:
+        # 1. Use the checkout reservation, or take available units from the index
+        units = await take_order_units(product_name, quantity, order_id)
+
+        # 2. Check availability
+        if units is None:
+            found = inventory_index.available(product_name)
+            logger.warning(f"Insufficient stock found for delivery of {quantity} units of {product_name}. Found: {found}.")
+            return "⚠️ Insufficient stock available in the sheet for delivery.", False
+
+        # 3. Perform Stock Update / Mark as Delivered; units go back to the pool if the write fails
+        try:
+            await storage.mark_units_delivered([row_num for row_num, _ in units])
+        except Exception:
+            inventory_index.put_back(product_name, units)
+            raise
+        inventory_index.confirm_delivered(units)
+        product_sync.note_delivered([row_num for row_num, _ in units])
+        catalog_cache.invalidate()
+        
+        # Concatenate content for delivery (separated by newlines)
+        final_content = "\n\n---\n\n".join(content for _, content in units)
+        return final_content, True
+        
+    except Exception as e:
+        logger.error(f"Error during bulk delivery and stock update for {product_name}: {e}")
+        return f"⚠️ Critical Error during fulfillment: {e}", False
+
+
+# --- Inventory Reservations ---
+
+class ReservationManager:
+    """
+    Holds inventory units for orders between checkout and verification. Units are taken
+    from the inventory index under a per-product lock, and settled OrderIDs are remembered
+    so a repeated or concurrent verification of the same order is a no-op. Reservations of
+    orders with a submitted proof are pinned: they never expire and wait for the admin.
+    """
+
+    def __init__(self, inventory: InventoryIndex, ttl_seconds: float):
+        self._inventory = inventory
+        self._ttl = ttl_seconds
+        self._product_locks = {}  # normalized name -> asyncio.Lock
+        self._order_locks = {}    # order_id -> [asyncio.Lock, number of holders/waiters]
+        self._reservations = {}   # order_id -> {'name', 'units', 'expires_at'}; expires_at is None once pinned
+        self._settled = set()     # order_ids already verified or declined
+
+    def product_lock(self, product_name: str) -> asyncio.Lock:
+        key = self._inventory.normalize(product_name)
+        if key not in self._product_locks:
+            self._product_locks[key] = asyncio.Lock()
+        return self._product_locks[key]
+
+    @asynccontextmanager
+    async def order_lock(self, order_id: str):
+        """Serializes all work on one OrderID (e.g. a double-tapped verify button)."""
+        entry = self._order_locks.setdefault(order_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._order_locks[order_id]
+
+    async def take_units(self, product_name: str, quantity: int) -> list | None:
+        """Takes units straight from the index, rescanning the sheet once if it looks short."""
+        async with self.product_lock(product_name), sheet_rows_gate.shared():
+            if not self._inventory.loaded:
+                await load_inventory_index()
+            units = self._inventory.take(product_name, quantity)
+            if units is None and time.monotonic() - self._inventory.built_at >= INVENTORY_RESCAN_MIN_SECONDS:
+                # Admins may have added stock rows since the index was built.
+                await load_inventory_index()
+                units = self._inventory.take(product_name, quantity)
+            return units
+
+    async def reserve(self, order_id: str, product_name: str, quantity: int, pinned: bool = False) -> bool:
+        """Holds `quantity` units for an order. Returns False if they are not available."""
+        self.expire_stale()
+        if order_id in self._reservations:
+            if pinned:
+                self.pin(order_id)
+            return True
+        units = await self.take_units(product_name, quantity)
+        if units is None:
+            return False
+        self.hold(order_id, product_name, units, pinned)
+        return True
+
+    def hold(self, order_id: str, product_name: str, units: list, pinned: bool = False) -> None:
+        """Puts units the caller already took from the index under an order's reservation."""
+        self._reservations[order_id] = {
+            'name': product_name,
+            'units': units,
+            'expires_at': None if pinned else time.monotonic() + self._ttl,
+        }
+
+    def reclaim(self, order_id: str, product_name: str, units: list, pinned: bool = False) -> bool:
+        """Holds units that a failed step put back into stock for their order again. False if one was taken since."""
+        units = self._inventory.take_back(product_name, units)
+        if units is None:
+            return False
+        self.hold(order_id, product_name, units, pinned)
+        return True
+
+    def pin(self, order_id: str) -> bool:
+        """Keeps an order's units until it is verified or declined (its proof was submitted)."""
+        reservation = self._reservations.get(order_id)
+        if reservation is None:
+            return False
+        reservation['expires_at'] = None
+        return True
+
+    def renumber(self, new_row_num) -> None:
+        """Moves reserved units to their new Products rows after archival."""
+        for reservation in self._reservations.values():
+            reservation['units'] = [(new_row_num(row_num), content) for row_num, content in reservation['units']]
+
+    def claim(self, order_id: str) -> dict | None:
+        """Hands an order's reserved units over to fulfilment."""
+        return self._reservations.pop(order_id, None)
+
+    def release(self, order_id: str) -> None:
+        """Returns an order's reserved units to stock (cancel, decline or expiry)."""
+        reservation = self._reservations.pop(order_id, None)
+        if reservation:
+            self._inventory.put_back(reservation['name'], reservation['units'])
+
+    def expire_stale(self) -> int:
+        """Releases reservations past their deadline, except pinned ones and orders carrying a proof."""
+        now = time.monotonic()
+        expired = []
+        for order_id, r in self._reservations.items():
+            if r['expires_at'] is None or r['expires_at'] > now:
+                continue
+            record = order_index.get(order_id)
+            if record and record.get('ProofID'):
+                r['expires_at'] = None
+                continue
+            expired.append(order_id)
+        for order_id in expired:
+            self.release(order_id)
+        if expired:
+            logger.info(f"Released stock held by {len(expired)} expired reservations.")
+        return len(expired)
+
+    def reserved_count(self, product_name: str) -> int:
+        key = self._inventory.normalize(product_name)
+        return sum(len(r['units']) for r in self._reservations.values() if self._inventory.normalize(r['name']) == key)
+
+    def is_pinned(self, order_id: str) -> bool:
+        reservation = self._reservations.get(order_id)
+        return reservation is not None and reservation['expires_at'] is None
+
+    def reserved_name(self, order_id: str) -> str | None:
+        reservation = self._reservations.get(order_id)
+        return reservation['name'] if reservation else None
+
+    def is_settled(self, order_id: str) -> bool:
+        return order_id in self._settled
+
+    def mark_settled(self, order_id: str) -> None:
+        self._settled.add(order_id)
+
+    def unmark_settled(self, order_id: str) -> None:
+        self._settled.discard(order_id)
+
+
+reservations = ReservationManager(inventory_index, RESERVATION_TTL_SECONDS)
+
+def available_stock(product_data: dict) -> int:
+    """Units of a catalog product that can still be bought (excludes units held by open orders)."""
+    if inventory_index.loaded:
+        return inventory_index.available(product_data.get('Name', ''))
+    try:
+        return int(product_data.get('Stock', 0))
+    except (ValueError, TypeError):
+        return 0
+
+async def expire_reservations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that returns stock held by abandoned checkouts."""
+    reservations.expire_stale()
+
+
+# --- Products Sheet Sync ---
+# Admins edit prices and add stock rows directly in the Products sheet. Each poll reads the
+# header and every column but the Delivery Content blobs (one small batch_get) and compares them
+# with what the last snapshot, including the bot's own writes, says they should hold. Only when
+# they differ is the whole sheet downloaded and diffed row by row. The spreadsheet's modified time
+# is no use here: every bot write to Orders, Users or Products moves it. Only added, changed and
+# deleted rows are applied to storage, the catalog and the inventory index. Rows the bot itself
+# wrote are recorded as expected "echoes" so they are not mistaken for admin edits while the
+# write is still on its way to the sheet. An edit to Delivery Content alone is not noticed until
+# some other column of the sheet changes.
+
+def _normalize_sheet_row(row: list) -> tuple:
+    """Row values as a tuple without trailing empty cells, so padding differences compare equal."""
+    values = [str(v) for v in row]
+    while values and values[-1] == '':
+        values.pop()
+    return tuple(values)
+
+class ProductSheetSync:
+    """Incremental, row-level sync of manual Products sheet edits into the bot's state."""
+
+    def __init__(self):
+        self._header = None
+        self._snapshot = {}       # row_num -> normalized row values as last seen/written
+        self._names = {}          # normalized product name -> set of row_nums
+        self._echoes = {}         # row_num -> deadline for a bot write to show up in the sheet
+        self.stats = {'polls': 0, 'unchanged': 0, 'added': 0, 'changed': 0, 'deleted': 0}
+
+    def _row_name(self, values: tuple) -> str:
+        name_col_index = self._header.index('Name')
+        return InventoryIndex.normalize(values[name_col_index]) if len(values) > name_col_index else ''
+
+    def _set_row(self, row_num: int, values: tuple | None) -> None:
+        old = self._snapshot.pop(row_num, None)
+        if old is not None:
+            self._names.get(self._row_name(old), set()).discard(row_num)
+        if values is not None:
+            self._snapshot[row_num] = values
+            self._names.setdefault(self._row_name(values), set()).add(row_num)
+
+    def prime(self, all_values: list) -> None:
+        """Takes the starting snapshot (the same data the catalog and inventory were built from)."""
+        self._header = list(all_values[0])
+        self._snapshot = {}
+        self._names = {}
+        for row_index, row in enumerate(all_values[1:]):
+            self._set_row(row_index + 2, _normalize_sheet_row(row))
+
+    def renumber(self, removed: list, new_row_num) -> None:
+        """Drops archived rows from the snapshot and moves the rest up, matching the sheet."""
+        gone = set(removed)
+        self._snapshot = {new_row_num(row_num): values for row_num, values in self._snapshot.items() if row_num not in gone}
+        self._names = {
+            name: {new_row_num(row_num) for row_num in row_nums if row_num not in gone} for name, row_nums in self._names.items()
+        }
+        self._echoes = {new_row_num(row_num): deadline for row_num, deadline in self._echoes.items() if row_num not in gone}
+
+    def note_delivered(self, row_nums: list) -> None:
+        """Records the bot's own Stock=0 / DELIVERED writes so they do not read as admin edits."""
+        if self._header is None:
+            return
+        stock_col_index = self._header.index('Stock')
+        delivery_col_index = self._header.index('Delivery Content')
+        deadline = time.monotonic() + PRODUCT_SYNC_ECHO_TIMEOUT
+        for row_num in row_nums:
+            values = list(self._snapshot.get(row_num, ()))
+            values += [''] * (max(stock_col_index, delivery_col_index) + 1 - len(values))
+            values[stock_col_index] = '0'
+            values[delivery_col_index] = DELIVERED_MARKER
+            self._set_row(row_num, _normalize_sheet_row(values))
+            self._echoes[row_num] = deadline
 
-            if consolidation_key in consolidated_products:
-                # Sum the stock from all duplicate rows
-                existing_entry = consolidated_products[consolidation_key]
-                existing_entry['Stock'] += current_stock
+    def diff(self, all_values: list) -> dict:
+        """Returns {row_num: new values, or None if deleted} for rows that differ from the snapshot."""
+        now = time.monotonic()
+        changes = {}
+        current = {}
+        for row_index, row in enumerate(all_values[1:]):
+            current[row_index + 2] = _normalize_sheet_row(row)
+
+        for row_num, values in current.items():
+            if self._snapshot.get(row_num) == values:
+                self._echoes.pop(row_num, None)
+                continue
+            if self._echoes.get(row_num, 0) > now:
+                continue # Our own write has not reached the sheet yet
+            self._echoes.pop(row_num, None)
+            changes[row_num] = values
+        for row_num in self._snapshot.keys() - current.keys():
+            if self._echoes.get(row_num, 0) <= now:
+                changes[row_num] = None
+        return changes
+
+    def _light_columns(self) -> list:
+        """Header names the change check reads: all but the Delivery Content blobs."""
+        return [name for name in self._header if name and name != 'Delivery Content']
+
+    def _expected_columns(self, names: list) -> list:
+        """Columns `names` as the snapshot says the sheet holds them, header included."""
+        indexes = [self._header.index(name) for name in names]
+        last_row = max(self._snapshot, default=1)
+        rows = [self._snapshot.get(row_num, ()) for row_num in range(2, last_row + 1)]
+        return [
+            _normalize_sheet_row([self._header[i]] + [row[i] if i < len(row) else '' for row in rows])
+            for i in indexes
+        ]
+
+    async def _looks_unchanged(self) -> bool:
+        """True if the header and the light columns match the snapshot (one small read)."""
+        if self._header is None:
+            return False
+        names = self._light_columns()
+        ranges = ["1:1"] + [f"{products_columns.letter(name)}1:{products_columns.letter(name)}" for name in names]
+        try:
+            found = await products_sheet.batch_get(ranges, major_dimension=gspread.utils.Dimension.cols)
+        except Exception as e:
+            logger.warning(f"Could not read the Products change check, diffing anyway: {e}")
+            return False
+        header = _normalize_sheet_row([column[0] if column else '' for column in found[0]])
+        if header != _normalize_sheet_row(self._header):
+            return False
+        columns = [_normalize_sheet_row(value_range[0] if value_range else []) for value_range in found[1:]]
+        return columns == self._expected_columns(names)
+
+    async def poll(self) -> None:
+        self.stats['polls'] += 1
+        if storage.writes_pending("Products"):
+            # The sheet does not show the bot's latest writes yet (and after archival its rows are still
+            # numbered the old way); the next poll compares it once replication has caught up
+            return
+        if await self._looks_unchanged():
+            self.stats['unchanged'] += 1
+            return
+
+        # The diff is by row number, so archival must not renumber rows between the read and the apply
+        async with sheet_rows_gate.shared():
+            all_values = await products_sheet.get_all_values()
+            if self._header is None or list(all_values[0]) != self._header:
+                logger.info("Products header changed; rebuilding product state from the sheet.")
+                await self._rebuild(all_values)
             else:
-                # First time seeing this product name
-                row['Stock'] = current_stock
-                consolidated_products[consolidation_key] = row
-                
-        # The key for the final dict is the SKU of the first entry found for that product name
-        final_products = {p['SKU']: p for p in consolidated_products.values()}
-            
-        return final_products
+                changes = self.diff(all_values)
+                if changes:
+                    await self._apply(changes)
+
+    async def _rebuild(self, all_values: list) -> None:
+        global products_columns
+        products_columns = ColumnMap(all_values[0])
+        await storage.apply_sheet_changes("Products", {row_index + 1: row for row_index, row in enumerate(all_values)}, replace=True)
+        self.prime(all_values)
+        inventory_index.build(all_values)
+        await catalog_cache.refresh()
+
+    async def _apply(self, changes: dict) -> None:
+        affected_names = set()
+        for row_num, values in changes.items():
+            old = self._snapshot.get(row_num)
+            if old is None:
+                self.stats['added'] += 1
+            elif values is None:
+                self.stats['deleted'] += 1
+            else:
+                self.stats['changed'] += 1
+            if old is not None:
+                affected_names.add(self._row_name(old))
+            if values is not None:
+                affected_names.add(self._row_name(values))
+            self._set_row(row_num, values)
+
+            # Inventory: drop the old unit for this row and index the new one if sellable
+            if values is None:
+                inventory_index.discard_row(row_num)
+            else:
+                row = dict(zip(self._header, values))
+                inventory_index.apply_row(row_num, row.get('Name', ''), row.get('Stock', 0), row.get('Delivery Content', ''))
+
+        await storage.apply_sheet_changes("Products", {row_num: list(v) if v else None for row_num, v in changes.items()})
+
+        # Catalog: re-consolidate only the products whose rows changed
+        affected_names.discard('')
+        rows = [list(self._snapshot[row_num]) for name in affected_names for row_num in sorted(self._names.get(name, ()))]
+        catalog_cache.apply_products(affected_names, consolidate_products(self._header, rows))
+        logger.info(f"Products sync applied {len(changes)} row changes affecting {len(affected_names)} products.")
+
+
+product_sync = ProductSheetSync()
+
+async def product_sync_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that pulls manual Products sheet edits."""
+    try:
+        await product_sync.poll()
     except Exception as e:
-        logger.error(f"Error reading product data: {e}")
-        return {}
+        logger.error(f"Products sheet sync failed: {e}")
+
+# --- Write-Behind Append Buffers ---
+
+class WriteBehindBuffer:
+    """
+    Collects rows for one worksheet and appends them with a single `append_rows` call once
+    `max_rows` are buffered or the oldest row has waited `flush_ms`. Each row is copied to a
+    local spill file before it is buffered, so rows that were never flushed survive a crash
+    and are replayed on the next start.
+    """
+
+    def __init__(self, name: str, get_sheet, spill_path: str, max_rows: int, flush_ms: int):
+        self.name = name
+        self._get_sheet = get_sheet  # callable, since worksheets only exist after init_sheets()
+        self._spill_path = spill_path
+        self._max_rows = max_rows
+        self._flush_ms = flush_ms
+        self._rows = []
+        self._flush_lock = asyncio.Lock()
+        self._timer_task = None
+        self._flush_task = None
+        self.on_flushed = None  # optional callback(rows, first_row_num) after a successful flush
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def load_spill(self) -> int:
+        """Re-buffers rows left in the spill file by a previous run. Returns how many."""
+        if not os.path.exists(self._spill_path):
+            return 0
+        with open(self._spill_path, encoding='utf-8') as f:
+            spilled = [json.loads(line) for line in f if line.strip()]
+        self._rows = spilled + self._rows
+        if spilled:
+            logger.info(f"Replaying {len(spilled)} unflushed rows from '{self._spill_path}'.")
+        return len(spilled)
+
+    async def append(self, row: list) -> None:
+        with open(self._spill_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(row) + "\n")
+        self._rows.append(row)
+
+        if len(self._rows) >= self._max_rows:
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self.flush())
+        elif self._timer_task is None or self._timer_task.done():
+            self._timer_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._flush_ms / 1000)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Appends every buffered row in one API call. Failed rows stay buffered and spilled."""
+        async with self._flush_lock, sheet_rows_gate.shared():
+            if not self._rows:
+                return
+            rows = self._rows
+            self._rows = []
+            try:
+                response = await self._get_sheet().append_rows(rows)
+            except Exception as e:
+                logger.error(f"Write-behind flush of {len(rows)} rows to '{self.name}' failed: {e}")
+                self._rows = rows + self._rows
+                if self._timer_task is None or self._timer_task.done():
+                    self._timer_task = asyncio.create_task(self._flush_later())
+                return
+            self._rewrite_spill()
+
+            first_row = _first_appended_row(response)
+            if self.on_flushed and first_row:
+                self.on_flushed(rows, first_row)
+
+    def _rewrite_spill(self) -> None:
+        """Leaves only the rows that are still buffered in the spill file."""
+        tmp_path = self._spill_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in self._rows:
+                f.write(json.dumps(row) + "\n")
+        os.replace(tmp_path, self._spill_path)
+
+
+def _first_appended_row(response) -> int | None:
+    """Row number of the first row an append call wrote, from its updatedRange (e.g. "Users!A12:D14")."""
+    try:
+        start_cell = response['updates']['updatedRange'].split('!')[-1].split(':')[0]
+        return gspread.utils.a1_to_rowcol(start_cell)[0]
+    except (KeyError, TypeError, IndexError, AttributeError, gspread.exceptions.IncorrectCellLabel):
+        return None
+
+
+orders_writer = WriteBehindBuffer("Orders", lambda: orders_sheet, ORDERS_SPILL_FILE, WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_FLUSH_MS)
+users_writer = WriteBehindBuffer("Users", lambda: users_sheet, USERS_SPILL_FILE, WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_FLUSH_MS)
+
+# --- Order Index ---
+# Orders are read once at startup and then kept in step with the bot's own writes, so
+# verification does not need orders_sheet.find and the pending list needs no API calls.
+
+# Orders sheet columns, in order (A..I)
+ORDER_COLUMNS = ['OrderID', 'Timestamp', 'UserID', 'Username', 'SKU', 'Price', 'Quantity', 'Status', 'ProofID']
+
+class OrderIndex:
+    """OrderID -> order record and sheet row, plus Status -> OrderIDs (in creation order)."""
+
+    def __init__(self):
+        self._orders = {}     # order_id -> record dict keyed by ORDER_COLUMNS
+        self._rows = {}       # order_id -> sheet row number, None while the append is buffered
+        self._by_status = {}  # status -> dict of order_ids (used as an insertion-ordered set)
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def load(self, all_values: list) -> None:
+        """Indexes a `get_all_values()` snapshot of the Orders sheet, header row included."""
+        header = all_values[0] if all_values else ORDER_COLUMNS
+        for row_index, row in enumerate(all_values[1:]):
+            record = dict(zip(header, row))
+            if record.get('OrderID'):
+                self.add(record, row_index + 2)
+        self.loaded = True
+
+    def add(self, record: dict, row_num: int = None) -> None:
+        order_id = str(record['OrderID'])
+        if order_id in self._orders:
+            self._by_status.get(self._orders[order_id].get('Status'), {}).pop(order_id, None)
+        self._orders[order_id] = dict(record)
+        self._rows[order_id] = row_num
+        self._by_status.setdefault(record.get('Status'), {})[order_id] = None
+
+    def get(self, order_id: str) -> dict | None:
+        return self._orders.get(order_id)
+
+    def row_of(self, order_id: str) -> int | None:
+        return self._rows.get(order_id)
+
+    def set_row(self, order_id: str, row_num: int) -> None:
+        if order_id in self._orders:
+            self._rows[order_id] = row_num
+
+    def set_status(self, order_id: str, status: str) -> None:
+        record = self._orders.get(order_id)
+        if record is None:
+            return
+        self._by_status.get(record.get('Status'), {}).pop(order_id, None)
+        record['Status'] = status
+        self._by_status.setdefault(status, {})[order_id] = None
+
+    def update(self, order_id: str, fields: dict) -> None:
+        """Applies {column: value} changes to an indexed order (Status moves it between status sets)."""
+        if 'Status' in fields:
+            self.set_status(order_id, fields['Status'])
+        record = self._orders.get(order_id)
+        if record is not None:
+            record.update(fields)
+
+    def remove(self, order_ids: list) -> None:
+        for order_id in order_ids:
+            record = self._orders.pop(order_id, None)
+            self._rows.pop(order_id, None)
+            if record is not None:
+                self._by_status.get(record.get('Status'), {}).pop(order_id, None)
 
-def process_delivery_and_update_stock(product_name: str, quantity: int) -> tuple[str, bool]:
-    """
-    Finds the exact number of rows (equal to quantity) matching the product name, 
-    extracts the Delivery Content, and marks them as sold (Stock=0, Content cleared).
-    Returns the concatenated delivery content and success status.
-    
-    NOTE: This assumes each row with Stock=1 and Delivery Content represents 1 unit.
-    """
-    try:
-        # Get all sheet data to process rows, including header row
-        all_data = products_sheet.get_all_values()
-        header = all_data[0]
-        data_rows = all_data[1:] 
-        
-        # Determine column indices from header
-        name_col_index = header.index('Name')
-        stock_col_index = header.index('Stock')
-        delivery_col_index = header.index('Delivery Content')
-        
-        target_name = product_name.strip()
-        delivery_content_list = []
-        rows_to_update = []
-        
-        # 1. Find available units
-        for row_index, row in enumerate(data_rows):
-            # Check if we have enough items
-            if len(delivery_content_list) >= quantity:
-                break
+    def renumber(self, new_row_num) -> None:
+        """Moves indexed orders to their new sheet rows after archival (buffered rows keep None)."""
+        self._rows = {order_id: new_row_num(row_num) if row_num else row_num for order_id, row_num in self._rows.items()}
 
-            try:
-                current_stock = int(row[stock_col_index])
-            except (ValueError, IndexError):
-                current_stock = 0 # Treat non-numeric/missing stock as 0
-            
-            # Match Name, check if Stock is 1 (available), and check if Delivery Content exists
-            if row[name_col_index].strip() == target_name and \
-               current_stock >= 1 and \
-               row[delivery_col_index].strip():
-                
-                delivery_content_list.append(row[delivery_col_index].strip())
-                # Store row number (1-indexed for gspread)
-                rows_to_update.append(row_index + 2) 
+    def with_status(self, status: str) -> list:
+        """Order records with the given status, oldest first."""
+        return [self._orders[order_id] for order_id in self._by_status.get(status, {})]
 
-        # 2. Check availability
-        if len(delivery_content_list) < quantity:
-            logger.warning(f"Insufficient stock found for delivery of {quantity} units of {product_name}. Found: {len(delivery_content_list)}.")
-            return "⚠️ Insufficient stock available in the sheet for delivery.", False
 
-        # 3. Perform Stock Update / Mark as Delivered
-        update_range = []
-        for row_num in rows_to_update:
-            # Mark Stock as 0 (Column D / index 4)
-            update_range.append({'range': f'D{row_num}', 'values': [[0]]}) 
-            # Clear Delivery Content (Column E / index 5)
-            update_range.append({'range': f'E{row_num}', 'values': [['DELIVERED']]}) # Use "DELIVERED" placeholder
+order_index = OrderIndex()
 
-        # Perform the batch update
-        if update_range:
-            products_sheet.batch_update(update_range)
-        
-        # Concatenate content for delivery (separated by newlines)
-        final_content = "\n\n---\n\n".join(delivery_content_list)
-        return final_content, True
-        
-    except Exception as e:
-        logger.error(f"Error during bulk delivery and stock update for {product_name}: {e}")
-        return f"⚠️ Critical Error during fulfillment: {e}", False
+def _on_orders_flushed(rows: list, first_row: int) -> None:
+    for offset, row in enumerate(rows):
+        order_index.set_row(str(row[0]), first_row + offset)
+
+orders_writer.on_flushed = _on_orders_flushed
 
+async def find_order(order_id: str) -> tuple[int, dict]:
+    """Returns (sheet row, raw order record), using the order index and reading storage only as a fallback."""
+    if order_index.get(order_id) is not None and order_index.row_of(order_id) is None:
+        # The row is still in the write-behind buffer; flushing assigns its row number
+        await orders_writer.flush()
 
-def log_order(order_data: dict) -> None:
-    """Logs a new order to the 'Orders' sheet."""
+    row_num = order_index.row_of(order_id)
+    record = order_index.get(order_id)
+    if row_num is None or record is None:
+        row_num, row = await storage.find_order(order_id)
+        record = dict(zip(ORDER_COLUMNS, row))
+        order_index.add(record, row_num)
+    return row_num, record
+
+async def set_order_status(order_id: str, row_num: int, status: str) -> None:
+    """Writes an order's Status cell (column H) and updates the order index."""
+    await storage.update_order_status(row_num, status)
+    order_index.set_status(order_id, status)
+
+async def update_order_fields(changes: dict) -> None:
+    """Writes {order_id: {column: value}} to storage in one batch and updates the order index."""
+    async with sheet_rows_gate.shared():
+        by_row = {}
+        for order_id, fields in changes.items():
+            row_num, _ = await find_order(order_id)
+            by_row[row_num] = fields
+        await storage.update_orders(by_row)
+    for order_id, fields in changes.items():
+        order_index.update(order_id, fields)
+
+async def log_order(order_data: dict) -> None:
+    """Stores a new order row (Orders sheet, or local storage mirrored to it)."""
     try:
         # Assuming the Orders sheet has these columns:
         # A: OrderID, B: Timestamp, C: UserID, D: Username, E: SKU, F: Price (Total), G: Quantity, H: Status, I: ProofID
@@ -208,24 +2464,636 @@ def log_order(order_data: dict) -> None:
             order_data.get('Status', 'Pending'), # H
             order_data.get('ProofID', '')    # I
         ]
-        orders_sheet.append_row(row)
-        logger.info(f"Order {order_data['OrderID']} logged in Orders sheet with quantity {order_data['Quantity']}.")
+        row_num = await storage.append_order(row)
+        order_index.add(dict(zip(ORDER_COLUMNS, row)), row_num)
+        order_expiry.schedule(order_data['OrderID'], time.time())
+        logger.info(f"Order {order_data['OrderID']} logged with quantity {order_data['Quantity']}.")
     except Exception as e:
         logger.error(f"Error logging order {order_data.get('OrderID')}: {e}")
 
+# --- Pending Order Expiry ---
+# Every quantity selection logs a Pending order, and buyers who walk away leave it Pending
+# forever. OrderExpiryScheduler keeps a min-heap of (deadline, OrderID) and a JobQueue job pops
+# the due entries, moving orders still Pending without a ProofID to 'Expired' in batched writes
+# and releasing their reserved stock. Orders with a submitted proof always wait for the admin.
+
+class OrderExpiryScheduler:
+    """Min-heap of Pending order deadlines. Entries for orders that moved on are skipped when popped."""
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._heap = []  # (deadline as time.time(), order_id)
+        self.expired_total = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, order_id: str, created_at: float) -> None:
+        heapq.heappush(self._heap, (created_at + self._ttl, str(order_id)))
+
+    def load(self) -> None:
+        """Schedules every indexed Pending order, using its Timestamp as the creation time."""
+        self._heap = []
+        for record in order_index.with_status('Pending'):
+            try:
+                created_at = datetime.strptime(str(record.get('Timestamp')), "%Y-%m-%d %H:%M:%S").timestamp()
+            except ValueError:
+                created_at = time.time() # Unknown age: give it a full TTL from now
+            self._heap.append((created_at + self._ttl, str(record['OrderID'])))
+        heapq.heapify(self._heap)
+
+    def pop_due(self, now: float, limit: int) -> list:
+        """OrderIDs whose deadline has passed and that are still expirable (at most `limit`)."""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            _, order_id = heapq.heappop(self._heap)
+            record = order_index.get(order_id)
+            if record and record.get('Status') == 'Pending' and not record.get('ProofID'):
+                due.append(order_id)
+        return due
+
+    async def expire_due(self) -> int:
+        """Expires due orders in batches of ORDER_EXPIRY_BATCH_SIZE. Returns how many were expired."""
+        expired = 0
+        while True:
+            batch = []
+            for order_id in self.pop_due(time.time(), ORDER_EXPIRY_BATCH_SIZE):
+                # Settling under the order lock makes a later Verify tap report "already processed"
+                async with reservations.order_lock(order_id):
+                    record = order_index.get(order_id)
+                    if reservations.is_settled(order_id) or record.get('Status') != 'Pending' or record.get('ProofID'):
+                        continue
+                    reservations.mark_settled(order_id)
+                    batch.append(order_id)
+            if not batch:
+                break
+            try:
+                await update_order_fields({order_id: {'Status': 'Expired'} for order_id in batch})
+            except Exception as e:
+                logger.error(f"Could not expire {len(batch)} pending orders, will retry: {e}")
+                for order_id in batch:
+                    reservations.unmark_settled(order_id)
+                    self.schedule(order_id, time.time() - self._ttl + ORDER_EXPIRY_INTERVAL)
+                break
+            for order_id in batch:
+                reservations.release(order_id)
+            expired += len(batch)
+        if expired:
+            self.expired_total += expired
+            logger.info(f"Expired {expired} unpaid pending orders.")
+        return expired
+
+
+order_expiry = OrderExpiryScheduler(PENDING_ORDER_TTL_SECONDS)
+
+async def expire_orders_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that expires unpaid pending orders past their deadline."""
+    await order_expiry.expire_due()
+
+# --- User Registry ---
+# The Users sheet is read once at startup so /start only writes a row for first-seen users.
+
+class UserRegistry:
+    """Known user IDs (with their Users sheet row once known), blocked users and pending LastSeen updates."""
+
+    def __init__(self, blocked_path: str):
+        self._rows = {}       # user_id -> sheet row number, None while the append is still buffered
+        self._last_seen = {}  # user_id -> timestamp waiting for the next LastSeen batch
+        self._blocked = set() # users who blocked the bot, persisted in blocked_path
+        self._blocked_path = blocked_path
+        self.last_seen_col = None
+        self.loaded = False
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def load(self, all_values: list) -> None:
+        """Indexes a `get_all_values()` snapshot of the Users sheet (UserID in column A)."""
+        if all_values and 'LastSeen' in all_values[0]:
+            self.last_seen_col = all_values[0].index('LastSeen') + 1
+        for row_index, row in enumerate(all_values):
+            try:
+                user_id = int(row[0])
+            except (ValueError, IndexError):
+                continue # Header or malformed row
+            # Older versions appended a row per /start; the first one is the user's row
+            self._rows.setdefault(user_id, row_index + 1)
+        try:
+            with open(self._blocked_path) as f:
+                self._blocked = set(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read blocked users from {self._blocked_path}: {e}")
+        self.loaded = True
+
+    def add(self, user_id: int) -> bool:
+        """Registers a user. Returns True only the first time the user is seen."""
+        if user_id in self._rows:
+            return False
+        self._rows[user_id] = None
+        return True
+
+    def set_row(self, user_id: int, row_num: int) -> None:
+        if self._rows.get(user_id) is None:
+            self._rows[user_id] = row_num
+
+    def user_ids(self) -> list:
+        """Users that can currently be messaged (blocked users are left out)."""
+        return [uid for uid in self._rows if uid not in self._blocked]
+
+    def block(self, user_id: int) -> None:
+        """Records that the user blocked the bot so broadcasts skip them."""
+        if user_id not in self._blocked:
+            self._blocked.add(user_id)
+            self._save_blocked()
+
+    def unblock(self, user_id: int) -> None:
+        if user_id in self._blocked:
+            self._blocked.discard(user_id)
+            self._save_blocked()
+
+    def _save_blocked(self) -> None:
+        try:
+            with open(self._blocked_path, 'w') as f:
+                json.dump(sorted(self._blocked), f)
+        except OSError as e:
+            logger.error(f"Could not save blocked users to {self._blocked_path}: {e}")
+
+    def touch(self, user_id: int, timestamp: str) -> None:
+        if USERS_TRACK_LAST_SEEN and self.last_seen_col:
+            self._last_seen[user_id] = timestamp
+
+    async def flush_last_seen(self) -> None:
+        """Writes all pending LastSeen values in one batch_update."""
+        ready = {uid: ts for uid, ts in self._last_seen.items() if self._rows.get(uid)}
+        if not ready:
+            return
+        update_range = [
+            {'range': gspread.utils.rowcol_to_a1(self._rows[uid], self.last_seen_col), 'values': [[ts]]}
+            for uid, ts in ready.items()
+        ]
+        try:
+            await users_sheet.batch_update(update_range)
+        except Exception as e:
+            logger.warning(f"Could not update LastSeen for {len(ready)} users: {e}")
+            return
+        for uid, ts in ready.items():
+            if self._last_seen.get(uid) == ts:
+                del self._last_seen[uid]
+
+
+user_registry = UserRegistry(BLOCKED_USERS_FILE)
+
+def _on_users_flushed(rows: list, first_row: int) -> None:
+    for offset, row in enumerate(rows):
+        user_registry.set_row(int(row[0]), first_row + offset)
+
+users_writer.on_flushed = _on_users_flushed
+
+async def flush_last_seen_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that writes batched LastSeen updates."""
+    await user_registry.flush_last_seen()
+
+# --- Session Persistence ---
+# Checkout state (`current_order`, `selected_sku`, ...) lives in user_data and the conversation
+# state in the ConversationHandler, both in memory. SessionPersistence keeps them in a local
+# SQLite file so a restart does not drop in-flight checkouts. The Application hands over changed
+# sessions every SESSION_FLUSH_INTERVAL seconds; they are written together in one transaction.
+
+class SessionPersistence(BasePersistence):
+    """SQLite-backed persistence for user_data and conversation states (chat/bot data are not used)."""
+
+    def __init__(self, db_path: str, update_interval: float, session_ttl: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._session_ttl = session_ttl
+        self._db = sqlite3.connect(db_path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (name, key)
+            );
+        """)
+        self._pending_users = {}   # user_id -> data, or None to delete
+        self._pending_states = {}  # (name, key JSON) -> state, or None to delete
+        self._write_scheduled = False
+        self.last_active = {}      # user_id -> time.time() of the user's last update
+        self.stats = {'writes': 0, 'rows': 0}
+
+    def _evict_expired(self) -> None:
+        cutoff = time.time() - self._session_ttl
+        self._db.execute("DELETE FROM user_data WHERE updated_at < ?", (cutoff,))
+        self._db.execute("DELETE FROM conversations WHERE updated_at < ?", (cutoff,))
+
+    async def get_user_data(self) -> dict:
+        self._evict_expired()
+        user_data = {}
+        for user_id, data, updated_at in self._db.execute("SELECT user_id, data, updated_at FROM user_data"):
+            user_data[user_id] = json.loads(data)
+            self.last_active[user_id] = updated_at
+        logger.info(f"Restored {len(user_data)} user sessions.")
+        return user_data
+
+    async def get_conversations(self, name: str) -> dict:
+        return {
+            tuple(json.loads(key)): state
+            for key, state in self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        }
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self.last_active[user_id] = time.time()
+        self._pending_users[user_id] = data
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.last_active.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._pending_states[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    def _schedule_write(self) -> None:
+        # The Application calls the update_* methods of one persistence run together; writing
+        # on the next loop iteration puts the whole run into a single transaction.
+        if not self._write_scheduled:
+            self._write_scheduled = True
+            asyncio.get_running_loop().call_soon(self._write_pending)
+
+    def _write_pending(self) -> None:
+        self._write_scheduled = False
+        users, states = self._pending_users, self._pending_states
+        if not users and not states:
+            return
+        self._pending_users, self._pending_states = {}, {}
+        now = time.time()
+        try:
+            self._db.execute("BEGIN")
+            try:
+                for user_id, data in users.items():
+                    if data is None:
+                        self._db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                            (user_id, json.dumps(data), now),
+                        )
+                for (name, key), state in states.items():
+                    if state is None:
+                        self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)",
+                            (name, key, state, now),
+                        )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            logger.error(f"Could not save {len(users) + len(states)} sessions, will retry: {e}")
+            # Keep anything newer that arrived meanwhile
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            for key, state in states.items():
+                self._pending_states.setdefault(key, state)
+            return
+        self.stats['writes'] += 1
+        self.stats['rows'] += len(users) + len(states)
+
+    def idle_users(self, cutoff: float) -> list:
+        return [uid for uid, active in self.last_active.items() if active < cutoff]
+
+    def evict_conversations(self, user_ids: list) -> None:
+        """Deletes stored conversation states of evicted users (keys are [chat_id, user_id])."""
+        for user_id in user_ids:
+            self._db.execute("DELETE FROM conversations WHERE key LIKE ?", (f"%, {int(user_id)}]",))
+
+    async def flush(self) -> None:
+        self._write_pending()
+        self._db.close()
+
+    # Data kinds this bot does not persist
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+def end_conversations(application: Application, user_ids) -> None:
+    """Ends the in-memory conversation state of the given users, so an evicted session restarts at /start."""
+    # PTB has no public way to end one key's conversation; this uses ConversationHandler internals,
+    # which is why requirements.txt pins python-telegram-bot to an exact version
+    user_ids = set(user_ids)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                continue
+            for key in [key for key in handler._conversations if key[-1] in user_ids]:
+                handler._update_state(ConversationHandler.END, key)
+
+async def evict_sessions_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that forgets sessions idle for longer than SESSION_TTL_SECONDS."""
+    persistence = context.application.persistence
+    idle = persistence.idle_users(time.time() - SESSION_TTL_SECONDS)
+    for user_id in idle:
+        order = context.application.user_data.get(user_id, {}).get('current_order')
+        if order:
+            reservations.release(order['OrderID'])
+        context.application.drop_user_data(user_id)
+    persistence.evict_conversations(idle)
+    end_conversations(context.application, idle)
+    if idle:
+        logger.info(f"Evicted {len(idle)} abandoned sessions.")
+
+async def restore_session_reservations(application: Application) -> None:
+    """Re-holds stock for restored checkouts and for pending orders whose proof awaits the admin."""
+    restored = 0
+    for record in order_index.with_status('Pending'):
+        if not record.get('ProofID'):
+            continue
+        order_id = str(record['OrderID'])
+        product_name = await order_product_name(order_id, record.get('SKU'))
+        try:
+            quantity = int(record.get('Quantity'))
+        except (ValueError, TypeError):
+            continue
+        if await reservations.reserve(order_id, product_name, quantity, pinned=True):
+            restored += 1
+        else:
+            logger.warning(f"Could not re-reserve stock for paid order {order_id} awaiting verification.")
+    for data in application.user_data.values():
+        order = data.get('current_order')
+        if not order:
+            continue
+        record = order_index.get(order['OrderID'])
+        if record and record.get('Status') != 'Pending':
+            continue
+        if await reservations.reserve(order['OrderID'], order['Name'], int(order['Quantity'])):
+            restored += 1
+        else:
+            logger.warning(f"Could not re-reserve stock for restored order {order['OrderID']}.")
+    if restored:
+        logger.info(f"Re-reserved stock for {restored} restored orders.")
+
+# --- Archival ---
+# Sold units stay in Products as Stock=0 / DELIVERED and settled orders stay in Orders, so both
+# sheets only ever grow. The archive job moves them in bulk to archive worksheets while holding
+# sheet_rows_gate exclusively: rows are deleted from the live sheet first, and every index holding
+# row numbers is renumbered in the same step. Only once the delete went through are the rows handed
+# to a write-behind buffer (spilled to a local file) that appends them to the archive after the gate
+# is released. A refused delete leaves the rows live and unarchived, so the next run picks them up
+# again without duplicating them in the archive. The first row of each product is kept so the
+# product's SKU (the catalog key used in buttons and links) does not change.
+
+class SheetArchiver:
+    """Moves DELIVERED Products rows and old settled orders to archive worksheets."""
+
+    SETTLED_STATUSES = ('Paid', 'Failed', 'Expired')
+
+    def __init__(self):
+        self._archive_sheets = {}  # title -> AsyncWorksheet
+        self._writers = {
+            title: WriteBehindBuffer(
+                title, lambda title=title: self._archive_sheets[title], spill_path,
+                ARCHIVE_BATCH_SIZE, WRITE_BEHIND_FLUSH_MS,
+            )
+            for title, spill_path in (
+                (PRODUCTS_ARCHIVE_SHEET, PRODUCTS_ARCHIVE_SPILL_FILE),
+                (ORDERS_ARCHIVE_SHEET, ORDERS_ARCHIVE_SPILL_FILE),
+            )
+        }
+        self.stats = {'runs': 0, 'postponed': 0, 'products': 0, 'orders': 0}
+
+    async def _archive_sheet(self, title: str, header: list) -> AsyncWorksheet:
+        """The archive worksheet, created with `header` the first time it is needed."""
+        if title not in self._archive_sheets:
+            try:
+                worksheet = await sheets_executor.run(title, spreadsheet.worksheet, title)
+            except WorksheetNotFound:
+                worksheet = await sheets_executor.run(title, spreadsheet.add_worksheet, title, 1, len(header))
+                await sheets_executor.run(title, worksheet.append_row, header)
+                logger.info(f"Created archive worksheet '{title}'.")
+            self._archive_sheets[title] = AsyncWorksheet(worksheet, sheets_executor)
+        return self._archive_sheets[title]
+
+    def load_spill(self) -> int:
+        """Re-buffers archived rows a previous run deleted but never appended. Returns how many."""
+        return sum(writer.load_spill() for writer in self._writers.values())
+
+    async def flush(self) -> None:
+        """Appends the buffered rows to the archive sheets (must not run inside the exclusive gate)."""
+        headers = {PRODUCTS_ARCHIVE_SHEET: products_columns.header, ORDERS_ARCHIVE_SHEET: ORDER_COLUMNS}
+        for title, writer in self._writers.items():
+            if len(writer):
+                await self._archive_sheet(title, headers[title])
+                await writer.flush()
+
+    async def run(self) -> None:
+        self.stats['runs'] += 1
+        try:
+            async with sheet_rows_gate.exclusive(ARCHIVE_GATE_TIMEOUT):
+                for archive in (self._archive_products, self._archive_orders):
+                    try:
+                        await archive()
+                    except Exception as e:
+                        logger.error(f"Archival step {archive.__name__} failed: {e}")
+        except asyncio.TimeoutError:
+            self.stats['postponed'] += 1
+            logger.info("Archival postponed: deliveries kept the sheets busy.")
+        await self.flush()
+
+    async def _buffer(self, title: str, rows: list) -> None:
+        for row in rows:
+            await self._writers[title].append(row)
+
+    async def _archive_products(self) -> None:
+        all_values = await storage.product_rows()
+        if len(all_values) < 2:
+            return
+        header = all_values[0]
+        name_col_index = header.index('Name')
+        delivery_col_index = header.index('Delivery Content')
+
+        seen_names = set()
+        rows = {}  # row_num -> row values
+        for row_num, row in enumerate(all_values[1:], start=2):
+            name = InventoryIndex.normalize(row[name_col_index]) if len(row) > name_col_index else ''
+            if name not in seen_names:
+                seen_names.add(name)
+                continue
+            if len(row) > delivery_col_index and row[delivery_col_index].strip() == DELIVERED_MARKER:
+                rows[row_num] = row
+                if len(rows) >= ARCHIVE_BATCH_SIZE:
+                    break
+        if len(rows) < ARCHIVE_MIN_ROWS:
+            return
+
+        await self._archive_sheet(PRODUCTS_ARCHIVE_SHEET, header)
+        await storage.delete_rows("Products", {row_num: row[0] if row else '' for row_num, row in rows.items()})
+        await self._buffer(PRODUCTS_ARCHIVE_SHEET, list(rows.values()))
+
+        removed = sorted(rows)
+        new_row_num = renumber_after(removed)
+        inventory_index.renumber(removed, new_row_num)
+        reservations.renumber(new_row_num)
+        product_sync.renumber(removed, new_row_num)
+        self.stats['products'] += len(removed)
+        logger.info(f"Archived {len(removed)} delivered Products rows to '{PRODUCTS_ARCHIVE_SHEET}'.")
+
+    async def _archive_orders(self) -> None:
+        if not order_index.loaded:
+            return
+        cutoff = time.time() - ARCHIVE_ORDER_MIN_AGE_DAYS * 24 * 60 * 60
+        rows = {}  # row_num -> row values
+        for status in self.SETTLED_STATUSES:
+            for record in order_index.with_status(status):
+                row_num = order_index.row_of(str(record['OrderID']))
+                try:
+                    placed_at = datetime.strptime(str(record.get('Timestamp')), "%Y-%m-%d %H:%M:%S").timestamp()
+                except ValueError:
+                    continue
+                if row_num and placed_at < cutoff:
+                    rows[row_num] = ['' if record.get(column) is None else record.get(column) for column in ORDER_COLUMNS]
+        if len(rows) < ARCHIVE_MIN_ROWS:
+            return
+        rows = dict(sorted(rows.items())[:ARCHIVE_BATCH_SIZE])
+
+        await self._archive_sheet(ORDERS_ARCHIVE_SHEET, ORDER_COLUMNS)
+        await storage.delete_rows("Orders", {row_num: row[0] for row_num, row in rows.items()})
+        await self._buffer(ORDERS_ARCHIVE_SHEET, list(rows.values()))
+
+        order_index.remove([str(row[0]) for row in rows.values()])
+        order_index.renumber(renumber_after(sorted(rows)))
+        self.stats['orders'] += len(rows)
+        logger.info(f"Archived {len(rows)} settled orders to '{ORDERS_ARCHIVE_SHEET}'.")
+
+
+archiver = SheetArchiver()
+metrics.register_gauge('bot_archived_rows_total', "Products and Orders rows moved to the archive sheets", lambda: archiver.stats['products'] + archiver.stats['orders'])
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback that compacts the Products and Orders sheets."""
+    await archiver.run()
+
 # --- 3. USER HANDLERS (E-COMMERCE FLOW) ---
 
+# --- Markdown Helpers ---
+# Product names, SKUs and usernames come from the sheet or from Telegram and may contain Markdown
+# control characters, so they are escaped before going into Markdown messages. Editing a message
+# to the text it already shows fails with "message is not modified", which is harmless; any other
+# BadRequest is a real error and goes to error_handler.
+
+def md_escape(value) -> str:
+    return escape_markdown(str(value), version=1)
+
+def is_not_modified(error: BadRequest) -> bool:
+    return "message is not modified" in str(error).lower()
+
+# --- Prebuilt Menus and Render Cache ---
+# Static keyboards are built once at import. The product list only changes when the catalog
+# or the available stock does, so its rendered text and keyboard are reused until then.
+
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 Browse Products", callback_data='shop')],
+    [InlineKeyboardButton("📜 My Order History", callback_data='history')]
+])
+CHECKOUT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ I Have Paid (Send Proof)", callback_data='paid_proof')],
+    [InlineKeyboardButton("❌ Cancel Order", callback_data='cancel_order')]
+])
+AWAITING_PROOF_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⬅️ Back to Payment Details", callback_data='back_to_checkout')],
+    [InlineKeyboardButton("❌ Cancel Order", callback_data='cancel_order')]
+])
+BACK_TO_MAIN_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Go to Main Menu", callback_data='main_menu')]])
+ADMIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Pending Orders", callback_data='admin_pending')],
+    [InlineKeyboardButton("Manage Price", callback_data='admin_set_price')],
+    [InlineKeyboardButton("Manage Stock", callback_data='admin_set_stock')],
+    [InlineKeyboardButton("Broadcast Message", callback_data='admin_broadcast')]
+])
+
+class RenderCache:
+    """
+    Rendered (text, InlineKeyboardMarkup) per view, valid while both catalog_cache.version and
+    inventory_index.version are unchanged. A hit returns the stored tuple as is.
+    """
+
+    def __init__(self):
+        self._entries = {}  # view -> (catalog version, inventory version, rendered)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, view, render, data):
+        """Returns the cached rendering of `view`, calling `render(view, data)` only when it is outdated."""
+        entry = self._entries.get(view)
+        if entry is not None and entry[0] == catalog_cache.version and entry[1] == inventory_index.version:
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        if entry is not None:
+            # The versions moved on, so every other view is outdated as well
+            self._entries.clear()
+        rendered = render(view, data)
+        self._entries[view] = (catalog_cache.version, inventory_index.version, rendered)
+        return rendered
+
+
+render_cache = RenderCache()
+metrics.register_cache('rendered_views', render_cache)
+
+
 async def go_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Helper function to reset the state and send the start message."""
     if update.callback_query:
         await update.callback_query.answer()
         
     user = update.effective_user
-    keyboard = [
-        [InlineKeyboardButton("🛒 Browse Products", callback_data='shop')],
-        [InlineKeyboardButton("📜 My Order History", callback_data='history')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = MAIN_MENU_MARKUP
 
     # Use edit_message_text if coming from a callback, otherwise send a new message
     if update.callback_query:
@@ -247,23 +3115,31 @@ async def go_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Sends the welcome message and main menu."""
-    # Simple user tracking
+    # Simple user tracking: only first-seen users get a row in the Users sheet
     try:
         user = update.effective_user
-        # Log user details
-        users_sheet.append_row([user.id, user.username, user.full_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if user_registry.add(user.id):
+            # Log user details
+            await users_writer.append([user.id, user.username, user.full_name, now])
+        user_registry.unblock(user.id) # Talking to us again means they unblocked the bot
+        delivery_queue.redeliver(chat_id=user.id)
+        user_registry.touch(user.id, now)
     except Exception as e:
         logger.warning(f"Could not log user {user.id}: {e}")
+
+    if context.args and context.args[0].startswith('buy_'):
+        return await open_product_link(update, context, context.args[0][len('buy_'):])
         
     return await go_to_main_menu(update, context)
 
 async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Displays the list of consolidated products using inline buttons."""
+    """Displays the product categories, or the first page of products when there is only one."""
     query = update.callback_query
     if query:
         await query.answer()
 
-    products = get_product_data()
+    products = await get_product_data()
     if not products:
         text = "⚠️ **Error:** Could not load products. Please try again later." # Handling error from image_edad7e.png
         if query:
@@ -272,15 +3148,65 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
             await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
         return SELECT_PRODUCT
 
+    if len(catalog_cache.category_names) > 1:
+        text, reply_markup = render_cache.get('categories', _render_category_list, products)
+    else:
+        text, reply_markup = render_cache.get((0, 0), _render_product_page, products)
+    
+    if query:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    elif update.message:
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+        
+    return SELECT_PRODUCT
+
+async def show_category_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Shows one page of a category (callback data cat_<category index>_<page>)."""
+    query = update.callback_query
+    await query.answer()
+
+    products = await get_product_data()
+    _, category_index, page = query.data.split('_')
+    category_index, page = int(category_index), int(page)
+    if not products or category_index >= len(catalog_cache.category_names):
+        # The catalog changed under an old keyboard
+        return await show_products(update, context)
+
+    _, page, _ = catalog_cache.category_page(category_index, page, PRODUCTS_PAGE_SIZE)
+    text, reply_markup = render_cache.get((category_index, page), _render_product_page, products)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as e:
+        if not is_not_modified(e):
+            raise
+        logger.debug(f"Product page not updated: {e}")
+    return SELECT_PRODUCT
+
+def _render_category_list(view, products: dict) -> tuple[str, InlineKeyboardMarkup]:
+    """Builds the category menu with the product count of each category."""
+    keyboard = [
+        [InlineKeyboardButton(f"📂 {name} ({catalog_cache.category_size(i)})", callback_data=f'cat_{i}_0')]
+        for i, name in enumerate(catalog_cache.category_names)
+    ]
+    keyboard.append([InlineKeyboardButton("⬅️ Main Menu", callback_data='main_menu')])
+    return "🔥 **Our Products:**\n\nChoose a category:", InlineKeyboardMarkup(keyboard)
+
+def _render_product_page(view: tuple, products: dict) -> tuple[str, InlineKeyboardMarkup]:
+    """Builds one page of a category's product list and its Buy buttons."""
+    category_index, page = view
+    skus, page, page_count = catalog_cache.category_page(category_index, page, PRODUCTS_PAGE_SIZE)
+    several_categories = len(catalog_cache.category_names) > 1
+
     keyboard = []
-    text = "🔥 **Our Products:**\n\n"
+    if several_categories:
+        text = f"🔥 **{md_escape(catalog_cache.category_names[category_index])}:**\n\n"
+    else:
+        text = "🔥 **Our Products:**\n\n"
 
-    for sku, data in products.items():
-        try:
-            # Note: data['Stock'] here contains the *SUMMED* stock (from get_product_data)
-            stock = int(data.get('Stock', 0)) 
-        except (ValueError, TypeError):
-            stock = 0
+    for sku in skus:
+        data = products[sku]
+        # Units on sale minus units held by other buyers' open orders
+        stock = available_stock(data)
             
         name = data.get('Name', 'N/A')
         price = data.get('Price (USD)', 'N/A')
@@ -288,7 +3214,7 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         stock_display = f"Stock: {stock}"
         
         # Display the product list (now only once per unique name)
-        text += f"*{name}* - **${price}** ({stock_display})\n"
+        text += f"*{md_escape(name)}* - **${md_escape(price)}** ({stock_display})\n"
         
         # Add only ONE button per unique SKU/Product
         if stock > 0:
@@ -296,15 +3222,19 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         else:
             keyboard.append([InlineKeyboardButton(f"Buy {name} (Sold Out)", callback_data='ignore')])
 
+    if page_count > 1:
+        text += f"\nPage {page + 1}/{page_count}"
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️ Prev", callback_data=f'cat_{category_index}_{page - 1}'))
+        if page < page_count - 1:
+            navigation.append(InlineKeyboardButton("Next ▶️", callback_data=f'cat_{category_index}_{page + 1}'))
+        keyboard.append(navigation)
+
+    if several_categories:
+        keyboard.append([InlineKeyboardButton("⬅️ Categories", callback_data='shop')])
     keyboard.append([InlineKeyboardButton("⬅️ Main Menu", callback_data='main_menu')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if query:
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-    elif update.message:
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-        
-    return SELECT_PRODUCT
+    return text, InlineKeyboardMarkup(keyboard)
 
 async def quantity_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Prompts the user to enter quantity or select from quick options."""
@@ -312,22 +3242,26 @@ async def quantity_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
     
     sku = query.data.split('_')[2]
-    products = get_product_data()
+    products = await get_product_data()
     product_data = products.get(sku)
     
     if not product_data:
         await query.edit_message_text("🚫 **Error:** Product data is missing. Please try again.")
         return await show_products(update, context)
         
-    try:
-        stock = int(product_data.get('Stock', 0))
-    except (ValueError, TypeError):
-        stock = 0
+    stock = available_stock(product_data)
         
     if stock <= 0:
         await query.edit_message_text("🚫 **Error:** Product is sold out or no longer available.")
         return await show_products(update, context)
 
+    text, reply_markup = _quantity_prompt_view(context, sku, product_data, stock)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    
+    return CONFIRM_ORDER 
+
+def _quantity_prompt_view(context: ContextTypes.DEFAULT_TYPE, sku: str, product_data: dict, stock: int) -> tuple[str, InlineKeyboardMarkup]:
+    """Selects the product for this user and builds the quantity prompt."""
     context.user_data['selected_sku'] = sku
     context.user_data['product_name'] = product_data['Name']
 
@@ -343,13 +3277,55 @@ async def quantity_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     text = (
-        f"🛒 How many *{product_data['Name']}* (Max: {stock}) would you like to buy?\n\n"
+        f"🛒 How many *{md_escape(product_data['Name'])}* (Max: {stock}) would you like to buy?\n\n"
         "Select a quantity below or **type in the exact number**."
     )
-    
-    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-    
-    return CONFIRM_ORDER 
+    return text, reply_markup
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answers `@bot keyword` inline queries with matching in-stock products."""
+    inline_query = update.inline_query
+    products = await get_product_data()
+
+    results = []
+    for sku in product_search.search(inline_query.query, products):
+        product_data = products.get(sku)
+        stock = available_stock(product_data) if product_data else 0
+        if stock <= 0:
+            continue
+        name = product_data.get('Name', 'N/A')
+        price = product_data.get('Price (USD)', 'N/A')
+        reply_markup = None
+        if DEEP_LINK_SKU.match(sku):
+            buy_url = f"https://t.me/{context.bot.username}?start=buy_{sku}"
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Buy in bot", url=buy_url)]])
+        results.append(InlineQueryResultArticle(
+            id=str(len(results)),
+            title=name,
+            description=f"${price} - Stock: {stock}",
+            input_message_content=InputTextMessageContent(f"🔥 *{md_escape(name)}* - **${md_escape(price)}**", parse_mode=ParseMode.MARKDOWN),
+            reply_markup=reply_markup,
+        ))
+        if len(results) >= INLINE_MAX_RESULTS:
+            break
+
+    await inline_query.answer(results, cache_time=INLINE_CACHE_SECONDS)
+
+# /start payloads may only use these characters (64 at most, including "buy_")
+DEEP_LINK_SKU = re.compile(r'^[A-Za-z0-9_-]{1,60}$')
+
+async def open_product_link(update: Update, context: ContextTypes.DEFAULT_TYPE, sku: str) -> int:
+    """Handles /start buy_<SKU> deep links (the Buy button of inline search results)."""
+    products = await get_product_data()
+    product_data = products.get(sku)
+    stock = available_stock(product_data) if product_data else 0
+    if stock <= 0:
+        await update.message.reply_text("🚫 **Error:** Product is sold out or no longer available.", parse_mode=ParseMode.MARKDOWN)
+        return await go_to_main_menu(update, context)
+
+    text, reply_markup = _quantity_prompt_view(context, sku, product_data, stock)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    return CONFIRM_ORDER
 
 async def quantity_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles text input for quantity or callback for quick quantity selection."""
@@ -403,7 +3379,7 @@ async def checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, quantity:
             await effective_update.reply_text("⚠️ **Error:** Order session lost. Please start over.")
         return await go_to_main_menu(update, context)
 
-    products = get_product_data()
+    products = await get_product_data()
     product_data = products.get(sku)
     
     if not product_data:
@@ -411,29 +3387,30 @@ async def checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, quantity:
             await effective_update.reply_text("⚠️ **Error:** Product data missing. Please try again.")
         return await go_to_main_menu(update, context)
 
-    try:
-        current_stock = int(product_data.get('Stock', 0))
-    except (ValueError, TypeError):
-        current_stock = 0
+    # --- Create Order ---
+    order_id = str(uuid4())[:8].upper()
+    user = update.effective_user
+    
+    # Store the Name that was displayed to the user
+    product_name = product_data['Name'] 
 
-    if current_stock < quantity or quantity <= 0:
+    # A new quantity selection replaces the buyer's previous unpaid order
+    previous_order = context.user_data.get('current_order')
+    if previous_order:
+        reservations.release(previous_order['OrderID'])
+
+    # Hold the units for this order until it is verified, canceled or expires
+    if quantity <= 0 or not await reservations.reserve(order_id, product_name, quantity):
         if effective_update:
             await effective_update.reply_text(
-                f"🚫 **Error:** Requested quantity ({quantity}) is not available (Stock: {current_stock})."
+                f"🚫 **Error:** Requested quantity ({quantity}) is not available (Stock: {available_stock(product_data)})."
             )
         return await show_products(update, context)
     
-    # --- Create Order ---
-    order_id = str(uuid4())[:8].upper()
-    user = update.effective_user
-    
     # Calculate Total Price
     unit_price = float(product_data.get('Price (USD)', 0))
     total_price = unit_price * quantity
     
-    # Store the Name that was displayed to the user
-    product_name = product_data['Name'] 
-    
     order_data = {
         'OrderID': order_id,
         'UserID': user.id,
@@ -446,14 +3423,14 @@ async def checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, quantity:
     }
     
     context.user_data['current_order'] = order_data
-    log_order(order_data)
+    await log_order(order_data)
 
     # --- Payment Instruction ---
     payment_address = "777904898"
     
     instruction = (
         f"🧾 **Order Summary**\n"
-        f"Product: *{product_name}* (x{quantity})\n"
+        f"Product: *{md_escape(product_name)}* (x{quantity})\n"
         f"Unit Price: ${unit_price:.2f}\n"
         f"Total Price: **${total_price:.2f}**\n"
         f"Unique Order ID: `{order_id}`\n\n"
@@ -466,11 +3443,7 @@ async def checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, quantity:
         "3. Once sent, click the **'I Have Paid'** button below and send us the **Transaction ID or proof screenshot**."
     )
     
-    keyboard = [
-        [InlineKeyboardButton("✅ I Have Paid (Send Proof)", callback_data='paid_proof')],
-        [InlineKeyboardButton("❌ Cancel Order", callback_data='cancel_order')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = CHECKOUT_MARKUP
 
     if update.callback_query:
         await update.callback_query.edit_message_text(
@@ -491,6 +3464,7 @@ async def cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     order_data = context.user_data.get('current_order')
     if order_data:
         context.user_data.pop('current_order')
+        reservations.release(order_data['OrderID'])
         
         await query.edit_message_text(
             f"❌ Order `{order_data.get('OrderID', 'N/A')}` has been canceled. Returning to the main menu."
@@ -509,11 +3483,7 @@ async def start_proof_submission(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("⚠️ **Error:** Your order session has expired. Please start over.")
         return await go_to_main_menu(update, context)
 
-    keyboard = [
-        [InlineKeyboardButton("⬅️ Back to Payment Details", callback_data='back_to_checkout')],
-        [InlineKeyboardButton("❌ Cancel Order", callback_data='cancel_order')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = AWAITING_PROOF_MARKUP
 
     await query.edit_message_text(
         "📸 **Awaiting Proof:**\n\n"
@@ -540,7 +3510,7 @@ async def back_to_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     order_id = order_data['OrderID']
     product_name = order_data['Name']
     
-    products = get_product_data()
+    products = await get_product_data()
     product_data = products.get(sku)
     unit_price = float(product_data.get('Price (USD)', total_price / quantity if quantity else 0)) 
     
@@ -548,7 +3518,7 @@ async def back_to_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     instruction = (
         f"🧾 **Order Summary**\n"
-        f"Product: *{product_name}* (x{quantity})\n"
+        f"Product: *{md_escape(product_name)}* (x{quantity})\n"
         f"Unit Price: ${unit_price:.2f}\n"
         f"Total Price: **${total_price:.2f}**\n"
         f"Unique Order ID: `{order_id}`\n\n"
@@ -561,11 +3531,7 @@ async def back_to_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         "3. Once sent, click the **'I Have Paid'** button below and send us the **Transaction ID or proof screenshot**."
     )
     
-    keyboard = [
-        [InlineKeyboardButton("✅ I Have Paid (Send Proof)", callback_data='paid_proof')],
-        [InlineKeyboardButton("❌ Cancel Order", callback_data='cancel_order')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = CHECKOUT_MARKUP
 
     await query.edit_message_text(instruction, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     
@@ -594,6 +3560,22 @@ async def receive_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("Please send a **Transaction ID** as text or a **screenshot** as a photo.", parse_mode=ParseMode.MARKDOWN)
         return AWAITING_PROOF
 
+    # Record the proof on the order; this also exempts it from expiry
+    order_id = order_data['OrderID']
+    async with reservations.order_lock(order_id):
+        record = order_index.get(order_id)
+        if record and record.get('Status') == 'Expired':
+            context.user_data.pop('current_order')
+            await update.message.reply_text("⚠️ **Error:** This order has expired. Please start over.", parse_mode=ParseMode.MARKDOWN)
+            return await go_to_main_menu(update, context)
+        try:
+            await update_order_fields({order_id: {'ProofID': proof_file_id or update.message.text}})
+        except Exception as e:
+            logger.error(f"Could not record proof for order {order_id}: {e}")
+        # Hold the units until the admin decides, however long that takes
+        if not await reservations.reserve(order_id, order_data['Name'], int(order_data['Quantity']), pinned=True):
+            logger.warning(f"Stock for order {order_id} ran out before its proof arrived; verification will retry.")
+
     notification = (
         f"🔔 <b>NEW PENDING PAYMENT</b> 🔔\n\n"
         f"<b>Order ID:</b> <code>{order_data['OrderID']}</code>\n"
@@ -628,8 +3610,7 @@ async def receive_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         logger.error(f"Failed to send admin notification (HTML failure): {e}")
 
 
-    keyboard_user = [[InlineKeyboardButton("🏠 Go to Main Menu", callback_data='main_menu')]]
-    reply_markup_user = InlineKeyboardMarkup(keyboard_user)
+    reply_markup_user = BACK_TO_MAIN_MENU_MARKUP
 
     await update.message.reply_text(
         "✅ **Proof Submitted!**\n\n"
@@ -646,6 +3627,7 @@ async def receive_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 def admin_only(func):
     """Decorator to ensure only the admin can run the command."""
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user_id = update.effective_user.id if update.effective_user else None
         
@@ -663,65 +3645,82 @@ def admin_only(func):
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Sends the admin dashboard and menu."""
     
-    products = get_product_data()
+    products = await get_product_data()
     low_stock_count = sum(1 for p in products.values() if int(p.get('Stock', 0)) < 10)
     
     text = (
         "👑 **ADMIN DASHBOARD** 👑\n\n"
         f"**Low Stock Alert:** {low_stock_count} items (< 10 left)\n"
-        f"Use /pending command or button to check new orders."
+        f"Use /pending command or button to check new orders.\n"
+        f"Use /bulkverify ID1 ID2 ... to verify several paid orders at once."
     )
     
-    keyboard = [
-        [InlineKeyboardButton("Pending Orders", callback_data='admin_pending')],
-        [InlineKeyboardButton("Manage Price", callback_data='admin_set_price')],
-        [InlineKeyboardButton("Manage Stock", callback_data='admin_set_stock')],
-        [InlineKeyboardButton("Broadcast Message", callback_data='admin_broadcast')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ADMIN_MENU_MARKUP
     
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     return ADMIN_MENU
 
+def render_pending_page(page: int, notice: str = None) -> tuple[str, InlineKeyboardMarkup]:
+    """Renders one page of pending orders (from the order index) as a single message with buttons."""
+    pending_orders = order_index.with_status('Pending')
+    page_count = max(1, -(-len(pending_orders) // PENDING_PAGE_SIZE))
+    page = min(max(page, 0), page_count - 1)
+    orders = pending_orders[page * PENDING_PAGE_SIZE:(page + 1) * PENDING_PAGE_SIZE]
+
+    lines = [notice, ""] if notice else []
+    if not orders:
+        lines.append("🎉 **No pending orders found!**")
+    else:
+        lines.append(f"📋 **PENDING ORDERS** ({len(pending_orders)}) - page {page + 1}/{page_count}")
+    keyboard = []
+    for order in orders:
+        proof = "✅ proof sent" if order.get('ProofID') else "no proof yet"
+        lines.append(
+            f"\n`{order['OrderID']}` - {md_escape(order.get('SKU', 'N/A'))} (x{md_escape(order.get('Quantity', 1))}) "
+            f"for ${md_escape(order.get('Price', 0))}\n"
+            f"User {md_escape(order.get('UserID', 'N/A'))} | {md_escape(order.get('Timestamp', 'N/A'))} | {proof}"
+        )
+        keyboard.append([
+            InlineKeyboardButton(f"✅ {order['OrderID']}", callback_data=f"verify_{order['OrderID']}_paid_{page}"),
+            InlineKeyboardButton(f"❌ {order['OrderID']}", callback_data=f"verify_{order['OrderID']}_failed_{page}"),
+        ])
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Prev", callback_data=f"pending_page_{page - 1}"))
+    navigation.append(InlineKeyboardButton("🔄 Refresh", callback_data=f"pending_page_{page}"))
+    if page < page_count - 1:
+        navigation.append(InlineKeyboardButton("Next ▶️", callback_data=f"pending_page_{page + 1}"))
+    keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
 @admin_only
 async def list_pending_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Lists pending orders for manual verification."""
+    """Shows pending orders for manual verification, one page per message."""
     query = update.callback_query
+    page = 0
     if query:
         await query.answer()
-    
+        if query.data.startswith('pending_page_'):
+            page = int(query.data.rsplit('_', 1)[1])
+
     try:
-        all_orders = orders_sheet.get_all_records()
-        pending_orders = [o for o in all_orders if o.get('Status') == 'Pending']
+        if not order_index.loaded:
+            order_index.load(await storage.order_rows())
     except Exception as e:
         logger.error(f"Error fetching pending orders: {e}")
-        await (query.edit_message_text if query else update.message.reply_text)("⚠️ Error fetching orders from sheet.")
-        return
-
-    if not pending_orders:
-        text = "🎉 **No pending orders found!**"
-        await (query.edit_message_text if query else update.message.reply_text)(text, parse_mode=ParseMode.MARKDOWN)
+        await (query.edit_message_text if query else update.message.reply_text)("⚠️ Error fetching orders from sheet.")
         return
 
-    for order in pending_orders:
-        text = (
-            f"--- **PENDING ORDER** ---\n"
-            f"**Order ID:** `{order['OrderID']}`\n"
-            f"**Product:** {order.get('SKU', 'N/A')} (x{order.get('Quantity', 1)}) for ${order.get('Price', 0)}\n"
-            f"**User ID:** {order.get('UserID', 'N/A')}\n"
-            f"**Time:** {order.get('Timestamp', 'N/A')}\n"
-            f"**Proof ID:** {order.get('ProofID', 'N/A')}"
+    text, reply_markup = render_pending_page(page)
+    try:
+        await (query.edit_message_text if query else update.message.reply_text)(
+            text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN
         )
-        keyboard = [
-            [InlineKeyboardButton("✅ PAID & DELIVER", callback_data=f"verify_{order['OrderID']}_paid")],
-            [InlineKeyboardButton("❌ FAILED/CANCEL", callback_data=f"verify_{order['OrderID']}_failed")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await context.bot.send_message(ADMIN_ID, text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-
-    if query:
-        await query.delete_message()
+    except BadRequest as e:
+        if not is_not_modified(e):
+            raise
+        logger.debug(f"Pending orders page not updated: {e}")
 
 
 async def verify_and_deliver(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -729,41 +3728,75 @@ async def verify_and_deliver(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
-    _, order_id, status = query.data.split('_')
+    # verify_<OrderID>_<paid|failed>, plus _<page> when tapped in the pending orders list
+    parts = query.data.split('_')
+    order_id, status = parts[1], parts[2]
+    page = int(parts[3]) if len(parts) > 3 else None
     
+    # One verification per order at a time; a second tap waits and then sees it settled
+    async with reservations.order_lock(order_id), sheet_rows_gate.shared():
+        admin_msg = await _settle_order(context, order_id, status)
+
+    if page is None:
+        await query.edit_message_text(admin_msg, parse_mode=ParseMode.MARKDOWN)
+    else:
+        text, reply_markup = render_pending_page(page, notice=admin_msg)
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
+async def order_product_name(order_id: str, sku: str) -> str:
+    """Product name to deliver for an order: the reserved name, else the catalog name for its SKU."""
+    reservation_name = reservations.reserved_name(order_id)
+    if reservation_name:
+        return reservation_name
+    # Get the product name associated with the original SKU from the initial product list.
+    products_list = await get_product_data()
+    product_info = products_list.get(sku)
+    return product_info.get('Name') if product_info else sku # Fallback to SKU
+
+def delivery_message(order_id: str, product_name: str, quantity: int, delivery_content: str) -> str:
+    return (
+        f"🎉 **Order #{order_id} Verified and Delivered!** 🎉\n\n"
+        f"Your *{product_name}* **(x{quantity})** details are:\n\n"
+        f"```\n{delivery_content}\n```\n\n"
+        f"Thank you for your purchase!"
+    )
+
+async def _settle_order(context: ContextTypes.DEFAULT_TYPE, order_id: str, status: str) -> str:
+    """Applies a verify/decline decision to one order and returns the admin report. Caller must hold the order lock."""
+    if reservations.is_settled(order_id):
+        return f"ℹ️ Order {order_id} has already been processed."
+
     try:
-        cell = orders_sheet.find(order_id, in_column=1)
-        row_num = cell.row
-        order_row = orders_sheet.row_values(row_num)
+        row_num, order_record = await find_order(order_id)
         
         # A: OrderID, B: Timestamp, C: UserID, D: Username, E: SKU, F: Price, G: Quantity, H: Status, I: ProofID
         order_data = {
-            'OrderID': order_row[0],
-            'Timestamp': order_row[1],
-            'UserID': int(order_row[2]),
-            'Username': order_row[3],
-            'SKU': order_row[4],
-            'Price': float(order_row[5]),
-            'Quantity': int(order_row[6]), # Column G (index 6) for Quantity
-            'Status': order_row[7] 
+            'OrderID': order_record['OrderID'],
+            'Timestamp': order_record['Timestamp'],
+            'UserID': int(order_record['UserID']),
+            'Username': order_record['Username'],
+            'SKU': order_record['SKU'],
+            'Price': float(order_record['Price']),
+            'Quantity': int(order_record['Quantity']), # Column G (index 6) for Quantity
+            'Status': order_record['Status'] 
         }
         
     except Exception as e:
         logger.error(f"Error finding or parsing order {order_id} for verification: {e}")
-        await query.edit_message_text(f"⚠️ **Error:** Could not find or parse order {order_id} in the sheet.")
-        return
+        return f"⚠️ **Error:** Could not find or parse order {order_id} in the sheet."
+
+    if order_data['Status'] in ('Paid', 'Failed', 'Expired'):
+        reservations.mark_settled(order_id)
+        return f"ℹ️ Order {order_id} is already marked {order_data['Status']}."
 
     # Update the status in the Orders sheet (Status is column H / index 7)
-    orders_sheet.update_cell(row_num, 8, status.capitalize())
+    await set_order_status(order_id, row_num, status.capitalize())
 
     user_id = order_data['UserID']
     product_sku = order_data['SKU']
     quantity = order_data['Quantity'] 
     
-    # Get the product name associated with the original SKU from the initial product list.
-    products_list = get_product_data()
-    product_info = products_list.get(product_sku)
-    product_name = product_info.get('Name') if product_info else order_data['SKU'] # Fallback to SKU
+    product_name = await order_product_name(order_id, product_sku)
 
     if status == 'paid':
         
@@ -772,29 +3805,22 @@ async def verify_and_deliver(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # 1. Finding enough available items (quantity).
         # 2. Extracting content for all items.
         # 3. Marking those specific rows as sold (Stock=0, Content=DELIVERED).
-        delivery_content, success = process_delivery_and_update_stock(product_name, quantity)
+        delivery_content, success = await process_delivery_and_update_stock(product_name, quantity, order_id=order_id)
 
         if success:
-            # A. Deliver to user (Deliver the full concatenated content)
-            try:
-                await context.bot.send_message(user_id, 
-                    f"🎉 **Order #{order_id} Verified and Delivered!** 🎉\n\n"
-                    f"Your *{product_name}* **(x{quantity})** details are:\n\n"
-                    f"```\n{delivery_content}\n```\n\n"
-                    f"Thank you for your purchase!",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                admin_msg = f"✅ **SUCCESS!** Order {order_id} verified, delivered to user {user_id}. **{quantity} units** of *{product_name}* were marked as delivered/sold in the Products sheet."
-            except TelegramError as te:
-                admin_msg = f"⚠️ **Delivery Failed:** User {user_id} blocked bot. Status updated. **{quantity} units** of *{product_name}* were marked as delivered/sold. Delivery must be done manually."
-                logger.warning(f"Delivery failed for user {user_id}: {te}")
+            reservations.mark_settled(order_id)
+            # A. Hand the content to the delivery queue, which splits, sends and retries it in the background
+            delivery_queue.enqueue(order_id, user_id, product_name, quantity, delivery_content)
+            admin_msg = f"✅ **SUCCESS!** Order {order_id} verified and queued for delivery to user {user_id}. **{quantity} units** of *{md_escape(product_name)}* were marked as delivered/sold in the Products sheet."
         else:
             # Delivery failed (e.g., insufficient stock found in process_delivery_and_update_stock)
-            admin_msg = f"❌ **FAILURE:** Order {order_id} verified, but automated delivery and stock update failed: {delivery_content}"
+            admin_msg = f"❌ **FAILURE:** Order {order_id} verified, but automated delivery and stock update failed: {md_escape(delivery_content)}"
             # Revert status in the Orders sheet? For safety, leave as "Paid" and notify admin for manual intervention.
-            orders_sheet.update_cell(row_num, 8, "Paid - Manual Fail")
+            await set_order_status(order_id, row_num, "Paid - Manual Fail")
 
     elif status == 'failed':
+        reservations.release(order_id)
+        reservations.mark_settled(order_id)
         admin_msg = f"❌ **FAILED:** Order {order_id} marked as Failed."
         try:
             await context.bot.send_message(user_id, 
@@ -805,7 +3831,888 @@ async def verify_and_deliver(update: Update, context: ContextTypes.DEFAULT_TYPE)
         except TelegramError:
             pass
             
-    await query.edit_message_text(admin_msg, parse_mode=ParseMode.MARKDOWN)
+    return admin_msg
+
+# --- Broadcast ---
+# "Broadcast Message" copies one admin message to every known user. Sends go through a shared
+# token bucket so we stay under Telegram's global rate limit, flood waits pause every sender,
+# and users who blocked the bot are dropped. Progress is saved to BROADCAST_STATE_FILE so a
+# restart resumes the broadcast where it stopped instead of messaging everyone twice.
+
+class TokenBucket:
+    """Async token bucket: `acquire()` allows `rate` calls per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Holds every caller for `seconds`, e.g. after Telegram answers with RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:  # Waiters are served in arrival order
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+telegram_send_limiter = TokenBucket(BROADCAST_RATE_PER_SECOND, BROADCAST_BURST)
+
+class BroadcastEngine:
+    """
+    Runs one broadcast at a time. Recipients are sent to in ascending user ID order by
+    `workers` concurrent senders. The saved `cursor` is the highest user ID up to which every
+    send has finished, and `finished` lists the IDs above it that are done too, so resuming
+    after a stop or a clean shutdown repeats no message. After a crash, only the sends made
+    since the last progress save (BROADCAST_PROGRESS_INTERVAL) can go out twice.
+    """
+
+    def __init__(self, limiter: TokenBucket, state_path: str, workers: int):
+        self._limiter = limiter
+        self._state_path = state_path
+        self._workers = workers
+        self._task = None
+        self._stop_reason = None  # 'admin' or 'shutdown' once a stop was requested
+        self._run_started = 0.0
+        self._done_at_start = 0
+        self.state = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def load_state(self):
+        try:
+            with open(self._state_path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = None
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read broadcast state from {self._state_path}: {e}")
+            self.state = None
+        return self.state
+
+    def _save_state(self) -> None:
+        tmp_path = f"{self._state_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self._state_path)
+        except OSError as e:
+            logger.error(f"Could not save broadcast progress: {e}")
+
+    def start(self, bot, from_chat_id: int, message_id: int, status_message) -> None:
+        """Starts copying message `message_id` to all users, reporting progress on `status_message`."""
+        self.state = {
+            'from_chat_id': from_chat_id,
+            'message_id': message_id,
+            'status_chat_id': status_message.chat_id,
+            'status_message_id': status_message.message_id,
+            'cursor': 0,
+            'finished': [],
+            'total': 0,
+            'sent': 0,
+            'blocked': 0,
+            'failed': 0,
+            'started_at': time.time(),
+            'status': 'running',
+        }
+        self.resume(bot)
+
+    def resume(self, bot) -> None:
+        self.state['status'] = 'running'
+        self._stop_reason = None
+        self._save_state()
+        self._task = asyncio.create_task(self._run(bot))
+
+    def stop(self) -> None:
+        """Pauses the broadcast after the sends already in flight; it can be resumed later."""
+        self._stop_reason = self._stop_reason or 'admin'
+
+    async def shutdown(self) -> None:
+        """Stops a running broadcast but leaves it marked running, so the next start resumes it."""
+        if self.running:
+            self._stop_reason = 'shutdown'
+            await self._task
+
+    def _done(self) -> int:
+        return self.state['sent'] + self.state['blocked'] + self.state['failed']
+
+    async def _run(self, bot) -> None:
+        state = self.state
+        finished = set(state.get('finished', ()))  # Done, but above the cursor
+        recipients = sorted(uid for uid in user_registry.user_ids() if uid > state['cursor'] and uid not in finished)
+        # Everything already counted plus what is left; `finished` IDs are in the counters already
+        state['total'] = self._done() + len(recipients)
+        self._run_started = time.monotonic()
+        self._done_at_start = self._done()
+        logger.info(f"Broadcast running: {len(recipients)} recipients left of {state['total']}.")
+
+        feed = iter(recipients)  # Shared by the workers, each ID is handed out once
+        unconfirmed = deque(sorted(set(recipients) | finished))  # IDs above the cursor, in order
+
+        def advance_cursor():
+            while unconfirmed and unconfirmed[0] in finished:
+                state['cursor'] = unconfirmed.popleft()
+                finished.discard(state['cursor'])
+            state['finished'] = sorted(finished)
+
+        async def worker():
+            for user_id in feed:
+                if self._stop_reason:
+                    break
+                state[await self._send(bot, user_id)] += 1
+                finished.add(user_id)
+                advance_cursor()
+
+        advance_cursor()
+
+        reporter = asyncio.create_task(self._report_progress(bot))
+        try:
+            await asyncio.gather(*(worker() for _ in range(self._workers)))
+        except Exception as e:
+            logger.error(f"Broadcast stopped by an unexpected error: {e}")
+            self._stop_reason = self._stop_reason or 'admin'
+        finally:
+            reporter.cancel()
+            if self._stop_reason == 'admin':
+                state['status'] = 'paused'
+            elif self._stop_reason is None:
+                state['status'] = 'done'
+            self._save_state()
+            await self._edit_status(bot)
+            logger.info(
+                f"Broadcast {state['status']}: {state['sent']} sent, {state['blocked']} blocked, "
+                f"{state['failed']} failed of {state['total']}."
+            )
+
+    async def _send(self, bot, user_id: int) -> str:
+        """Copies the broadcast message to one user. Returns the counter to bump."""
+        attempts = 0
+        while True:
+            await self._limiter.acquire()
+            try:
+                await bot.copy_message(
+                    chat_id=user_id, from_chat_id=self.state['from_chat_id'], message_id=self.state['message_id']
+                )
+                return 'sent'
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every sender waits
+                logger.warning(f"Broadcast hit flood control, pausing {e.retry_after}s.")
+                self._limiter.pause(e.retry_after)
+            except Forbidden:
+                user_registry.block(user_id)
+                return 'blocked'
+            except BadRequest as e:
+                # Chat not found and similar: retrying will not help
+                logger.info(f"Broadcast to {user_id} rejected: {e}")
+                return 'failed'
+            except TelegramError as e:
+                attempts += 1
+                if attempts >= BROADCAST_MAX_RETRIES:
+                    logger.warning(f"Broadcast to {user_id} failed after {attempts} attempts: {e}")
+                    return 'failed'
+                await asyncio.sleep(2 ** attempts)
+
+    async def _report_progress(self, bot) -> None:
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            self._save_state()
+            await self._edit_status(bot)
+
+    def progress_text(self) -> str:
+        state = self.state
+        done = self._done()
+        remaining = state['total'] - done
+        elapsed = time.monotonic() - self._run_started
+        rate = (done - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+        title = {
+            'running': "📣 **Broadcast in progress**",
+            'paused': "⏸ **Broadcast paused**",
+            'done': "✅ **Broadcast finished**",
+        }[state['status']]
+        text = (
+            f"{title}\n\n"
+            f"**Progress:** {done}/{state['total']}\n"
+            f"**Sent:** {state['sent']} | **Blocked:** {state['blocked']} | **Failed:** {state['failed']}\n"
+            f"**Rate:** {rate:.1f} msg/s"
+        )
+        if state['status'] == 'running':
+            eta = f"{remaining / rate / 60:.1f} min" if rate > 0 else "calculating..."
+            text += f"\n**ETA:** {eta}"
+        return text
+
+    async def _edit_status(self, bot) -> None:
+        keyboard = None
+        if self.state['status'] == 'running':
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Stop", callback_data='broadcast_stop')]])
+        elif self.state['status'] == 'paused':
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("▶️ Resume", callback_data='broadcast_resume')]])
+        try:
+            await bot.edit_message_text(
+                self.progress_text(),
+                chat_id=self.state['status_chat_id'],
+                message_id=self.state['status_message_id'],
+                reply_markup=keyboard,
+                parse_mode=ParseMode.MARKDOWN,
+            )
+        except TelegramError as e:
+            # Includes "message is not modified" when nothing changed since the last report
+            logger.debug(f"Could not update broadcast status message: {e}")
+
+
+broadcast_engine = BroadcastEngine(telegram_send_limiter, BROADCAST_STATE_FILE, BROADCAST_WORKERS)
+
+@admin_only
+async def broadcast_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Asks the admin for the message to broadcast."""
+    query = update.callback_query
+    await query.answer()
+    if broadcast_engine.running:
+        await query.edit_message_text("ℹ️ A broadcast is already running.")
+        return ConversationHandler.END
+    await query.edit_message_text(
+        "📣 **Broadcast Message**\n\nSend the message to broadcast (text, photo, file...) or /cancel.",
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return ADMIN_BROADCAST
+
+@admin_only
+async def broadcast_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Remembers the admin's message and asks for confirmation."""
+    context.user_data['broadcast_message_id'] = update.message.message_id
+    keyboard = [
+        [InlineKeyboardButton(f"✅ Send to {len(user_registry.user_ids())} users", callback_data='broadcast_send')],
+        [InlineKeyboardButton("❌ Cancel", callback_data='broadcast_cancel')]
+    ]
+    await update.message.reply_text(
+        "Send the message above to all users?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    # The message is the broadcast, not shop input: keep it from the handlers in later groups
+    raise ApplicationHandlerStop(ADMIN_BROADCAST_CONFIRM)
+
+@admin_only
+async def broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Starts the confirmed broadcast; the confirmation message becomes the progress report."""
+    query = update.callback_query
+    await query.answer()
+    message_id = context.user_data.pop('broadcast_message_id', None)
+    if query.data == 'broadcast_cancel' or message_id is None:
+        await query.edit_message_text("❌ Broadcast cancelled.")
+        return ConversationHandler.END
+    if broadcast_engine.running:
+        await query.edit_message_text("ℹ️ A broadcast is already running.")
+        return ConversationHandler.END
+
+    await query.edit_message_text("📣 **Broadcast starting...**", parse_mode=ParseMode.MARKDOWN)
+    broadcast_engine.start(context.bot, query.message.chat_id, message_id, query.message)
+    return ConversationHandler.END
+
+@admin_only
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Any command (/cancel, /start, /admin...) abandons the broadcast being prepared; the command still runs."""
+    context.user_data.pop('broadcast_message_id', None)
+    await update.message.reply_text("❌ Broadcast cancelled.")
+    return ConversationHandler.END
+
+@admin_only
+async def broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stop/Resume buttons on the broadcast progress message."""
+    query = update.callback_query
+    if query.data == 'broadcast_stop':
+        broadcast_engine.stop()
+        await query.answer("Stopping after the messages in flight...")
+        return
+
+    if broadcast_engine.running:
+        await query.answer("Already running.")
+        return
+    if not (broadcast_engine.state or broadcast_engine.load_state()) or broadcast_engine.state['status'] != 'paused':
+        await query.answer("Nothing to resume.", show_alert=True)
+        return
+    await query.answer("Resuming broadcast.")
+    broadcast_engine.resume(context.bot)
+
+# --- Delivery Queue ---
+# Verified orders are handed to the delivery queue instead of being sent inside the admin's
+# callback. Content that does not fit one message is split into parts (or sent as a .txt
+# document when it would take too many), each delivery is saved to a local file until its last
+# part is out, and failed sends are retried with backoff. Users who blocked the bot get their
+# delivery when they /start again; anything else the queue gives up on is reported to the admin
+# and can be sent again with /redeliver.
+
+def split_delivery_content(content: str, limit: int) -> list:
+    """Splits content into pieces of at most `limit` characters, between units where possible, else between lines."""
+    separator = "\n\n---\n\n"  # How process_delivery_and_update_stock joins units
+    chunks = []
+    current = ''
+    for unit in content.split(separator):
+        if len(unit) > limit:
+            # A single oversized unit: cut it at line breaks (or hard, for very long lines)
+            if current:
+                chunks.append(current)
+            current = ''
+            for line in unit.split('\n'):
+                while len(line) > limit:
+                    if current:
+                        chunks.append(current)
+                    chunks.append(line[:limit])
+                    current, line = '', line[limit:]
+                if current and len(current) + 1 + len(line) > limit:
+                    chunks.append(current)
+                    current = line
+                else:
+                    current = f"{current}\n{line}" if current else line
+            chunks.append(current)
+            current = ''
+        elif not current:
+            current = unit
+        elif len(current) + len(separator) + len(unit) <= limit:
+            current += separator + unit
+        else:
+            chunks.append(current)
+            current = unit
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+def delivery_parts(job: dict) -> list:
+    """Messages for a delivery, in order; None stands for the whole content sent as a document."""
+    order_id, product_name, quantity, content = job['order_id'], job['product_name'], job['quantity'], job['content']
+    single = delivery_message(order_id, product_name, quantity, content)
+    if len(single) <= MessageLimit.MAX_TEXT_LENGTH:
+        return [single]
+    chunks = split_delivery_content(content, DELIVERY_CHUNK_CHARS)
+    if len(chunks) > DELIVERY_MAX_MESSAGES:
+        return [None]
+    parts = []
+    for number, chunk in enumerate(chunks, start=1):
+        if number == 1:
+            header = (
+                f"🎉 **Order #{order_id} Verified and Delivered!** 🎉\n\n"
+                f"Your *{product_name}* **(x{quantity})** details are (part 1/{len(chunks)}):"
+            )
+        else:
+            header = f"📦 **Order #{order_id}** - part {number}/{len(chunks)}:"
+        footer = "\n\nThank you for your purchase!" if number == len(chunks) else ""
+        parts.append(f"{header}\n\n```\n{chunk}\n```{footer}")
+    return parts
+
+
+class DeliveryQueue:
+    """
+    Persistent queue of order deliveries, sent by `workers` tasks through the shared send limiter.
+    A job records how many of its parts were sent, so a retry or restart resumes after them.
+    """
+
+    def __init__(self, limiter: TokenBucket, path: str, workers: int):
+        self._limiter = limiter
+        self._path = path
+        self._workers = workers
+        self._jobs = {}  # order_id -> job dict (see enqueue)
+        self._in_flight = set()
+        self._wake = asyncio.Event()
+        self._tasks = []
+        self._bot = None
+        self.stats = {'delivered': 0, 'retried': 0}
+
+    def load(self) -> int:
+        """Reads deliveries left by a previous run. Returns how many."""
+        try:
+            with open(self._path) as f:
+                self._jobs = json.load(f)
+        except FileNotFoundError:
+            self._jobs = {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read the delivery queue from {self._path}: {e}")
+            self._jobs = {}
+        return len(self._jobs)
+
+    def _save(self) -> None:
+        tmp_path = f"{self._path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._jobs, f)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.error(f"Could not save the delivery queue: {e}")
+
+    def count(self, status: str) -> int:
+        return sum(1 for job in self._jobs.values() if job['status'] == status)
+
+    def undelivered(self) -> list:
+        """Jobs the queue has stopped trying ('blocked' or 'failed'), oldest first."""
+        return sorted((job for job in self._jobs.values() if job['status'] != 'queued'), key=lambda job: job['created_at'])
+
+    def enqueue(self, order_id: str, chat_id: int, product_name: str, quantity: int, content: str) -> None:
+        """Saves a delivery and wakes a sender. Returns at once; the send happens in the background."""
+        self._jobs[order_id] = {
+            'order_id': order_id,
+            'chat_id': chat_id,
+            'product_name': product_name,
+            'quantity': quantity,
+            'content': content,
+            'sent': 0,          # Parts already delivered
+            'attempts': 0,
+            'next_at': 0.0,     # time.time() before which the job is not retried
+            'status': 'queued', # 'queued', 'blocked' (user blocked the bot) or 'failed' (attempts used up)
+            'plain': False,     # Set after Telegram rejected the Markdown; later sends go without formatting
+            'error': '',
+            'created_at': time.time(),
+        }
+        self._save()
+        self._wake.set()
+
+    def redeliver(self, order_ids: list = None, chat_id: int = None) -> list:
+        """Queues stopped deliveries again, by order ID or for one user. Returns the order IDs requeued."""
+        requeued = []
+        for job in self._jobs.values():
+            if job['status'] == 'queued':
+                continue
+            if (order_ids is not None and job['order_id'] in order_ids) or (chat_id is not None and job['chat_id'] == chat_id):
+                job.update(status='queued', attempts=0, next_at=0.0, error='')
+                requeued.append(job['order_id'])
+        if requeued:
+            self._save()
+            self._wake.set()
+        return requeued
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def stop(self) -> None:
+        """Stops the senders; unsent parts stay in the file for the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._save()
+
+    def _next_due(self):
+        """Returns (due job or None, seconds until the next job is due or None)."""
+        now = time.time()
+        wait = None
+        for job in self._jobs.values():
+            if job['status'] != 'queued' or job['order_id'] in self._in_flight:
+                continue
+            if job['next_at'] <= now:
+                return job, None
+            wait = min(wait, job['next_at'] - now) if wait is not None else job['next_at'] - now
+        return None, wait
+
+    async def _worker(self) -> None:
+        while True:
+            self._wake.clear()
+            job, wait = self._next_due()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._in_flight.add(job['order_id'])
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.error(f"Delivery of order {job['order_id']} stopped by an unexpected error: {e}")
+                await self._give_up(job, 'failed', str(e))
+            finally:
+                self._in_flight.discard(job['order_id'])
+
+    async def _deliver(self, job: dict) -> None:
+        parts = delivery_parts(job)
+        while job['sent'] < len(parts):
+            await self._limiter.acquire()
+            try:
+                await self._send_part(job, parts[job['sent']])
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every sender waits
+                self._limiter.pause(e.retry_after)
+                continue
+            except Forbidden as e:
+                user_registry.block(job['chat_id'])
+                await self._give_up(job, 'blocked', str(e))
+                return
+            except BadRequest as e:
+                if not job['plain']:
+                    # Usually Markdown the content broke; try once more without formatting
+                    logger.warning(f"Delivery of order {job['order_id']} rejected ({e}), resending without Markdown.")
+                    job['plain'] = True
+                    continue
+                await self._give_up(job, 'failed', str(e))
+                return
+            except TelegramError as e:
+                job['attempts'] += 1
+                if job['attempts'] >= DELIVERY_MAX_ATTEMPTS:
+                    await self._give_up(job, 'failed', str(e))
+                    return
+                delay = min(DELIVERY_BACKOFF_MAX, DELIVERY_BACKOFF_BASE * 2 ** (job['attempts'] - 1))
+                job['next_at'] = time.time() + delay
+                job['error'] = str(e)
+                self.stats['retried'] += 1
+                logger.warning(f"Delivery of order {job['order_id']} failed ({e}), retrying in {delay}s.")
+                self._save()
+                return
+            job['sent'] += 1
+            self._save()
+
+        del self._jobs[job['order_id']]
+        self._save()
+        self.stats['delivered'] += 1
+        logger.info(f"Order {job['order_id']} delivered to user {job['chat_id']} in {len(parts)} message(s).")
+
+    async def _send_part(self, job: dict, part) -> None:
+        parse_mode = None if job['plain'] else ParseMode.MARKDOWN
+        if part is None:
+            await self._bot.send_document(
+                job['chat_id'],
+                document=job['content'].encode('utf-8'),
+                filename=f"order_{job['order_id']}.txt",
+                caption=(
+                    f"🎉 **Order #{job['order_id']} Verified and Delivered!** 🎉\n\n"
+                    f"Your *{job['product_name']}* **(x{job['quantity']})** details are in the attached file.\n\n"
+                    f"Thank you for your purchase!"
+                ),
+                parse_mode=parse_mode,
+            )
+        else:
+            await self._bot.send_message(job['chat_id'], part, parse_mode=parse_mode)
+
+    async def _give_up(self, job: dict, status: str, error: str) -> None:
+        job.update(status=status, error=error)
+        self._save()
+        logger.warning(f"Delivery of order {job['order_id']} to {job['chat_id']} is {status}: {error}")
+        reason = "the user has blocked the bot; it is sent when they /start again" if status == 'blocked' else error
+        await self._notify_admin(
+            f"⚠️ Delivery pending: Order {job['order_id']} for user {job['chat_id']} could not be delivered "
+            f"({reason}). The content is kept; use /redeliver {job['order_id']} to send it again."
+        )
+
+    async def _notify_admin(self, text: str) -> None:
+        try:
+            # Plain text: the error message may contain Markdown control characters
+            await self._bot.send_message(ADMIN_ID, text)
+        except TelegramError as e:
+            logger.warning(f"Could not notify the admin about a stuck delivery: {e}")
+
+
+delivery_queue = DeliveryQueue(telegram_send_limiter, DELIVERY_QUEUE_FILE, DELIVERY_WORKERS)
+metrics.register_gauge('bot_deliveries_queued', "Deliveries waiting to be sent or retried", lambda: delivery_queue.count('queued'))
+metrics.register_gauge('bot_deliveries_stuck', "Deliveries blocked or failed, waiting for /start or /redeliver", lambda: len(delivery_queue.undelivered()))
+metrics.register_gauge('bot_deliveries_sent_total', "Deliveries fully sent", lambda: delivery_queue.stats['delivered'])
+
+@admin_only
+async def redeliver(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/redeliver [ORDERID ...] - lists deliveries that did not go out, or queues the given ones again."""
+    order_ids = [part.strip().upper() for arg in context.args for part in arg.split(',') if part.strip()]
+    if order_ids:
+        requeued = delivery_queue.redeliver(order_ids=order_ids)
+        missing = [order_id for order_id in order_ids if order_id not in requeued]
+        text = f"📬 Queued {len(requeued)} deliveries again."
+        if missing:
+            text += "\n\nNot waiting for redelivery: " + ", ".join(f"`{order_id}`" for order_id in missing)
+        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    stuck = delivery_queue.undelivered()
+    if not stuck:
+        await update.message.reply_text(
+            f"✅ No stuck deliveries. {delivery_queue.count('queued')} queued for sending."
+        )
+        return
+    # Plain text, since the stored error messages may contain Markdown control characters
+    lines = [f"📬 UNDELIVERED ORDERS ({len(stuck)})\n"]
+    for job in stuck[:30]:
+        lines.append(f"{job['order_id']} - user {job['chat_id']}, {job['status']}: {job['error'][:80]}")
+    lines.append("\nUse /redeliver ORDERID [ORDERID ...] to send again.")
+    await update.message.reply_text("\n".join(lines))
+
+# --- Bulk Verification ---
+# `/bulkverify ID1 ID2 ...` settles many paid orders at once: units for every order are taken
+# in one pass, all Products rows are marked delivered in one write and all Orders statuses in
+# another, and the deliveries are handed to the delivery queue.
+
+async def _rehold_order_units(order_id: str, product_name: str, units: list, returned: bool = False) -> None:
+    """
+    Reserves its units again for an order left Pending by a failed bulk step. `returned` units
+    were already put back into stock by the failure; if one of them is gone, fresh units are held.
+    """
+    record = order_index.get(order_id) or {}
+    pinned = bool(record.get('ProofID'))
+    if not returned:
+        reservations.hold(order_id, product_name, units, pinned=pinned)
+    elif not reservations.reclaim(order_id, product_name, units, pinned=pinned):
+        if not await reservations.reserve(order_id, product_name, len(units), pinned=pinned):
+            logger.warning(f"Bulk verify: could not re-reserve stock for order {order_id}.")
+
+async def bulk_verify_orders(order_ids: list) -> dict:
+    """Verifies the given orders and queues their deliveries. Returns {'queued', 'no_stock', 'skipped'} lists."""
+    result = {'queued': [], 'no_stock': [], 'skipped': []}
+    async with AsyncExitStack() as stack:
+        # Sorted so two bulk runs can never wait on each other's locks
+        for order_id in sorted(order_ids):
+            await stack.enter_async_context(reservations.order_lock(order_id))
+        await stack.enter_async_context(sheet_rows_gate.shared())
+
+        # 1. Take units for every order (reservation first, then free stock)
+        fulfilled = []  # (order_id, user_id, product_name, quantity, units)
+        status_changes = {}
+        for order_id in order_ids:
+            if reservations.is_settled(order_id):
+                result['skipped'].append(order_id)
+                continue
+            try:
+                _, record = await find_order(order_id)
+                user_id, quantity = int(record['UserID']), int(record['Quantity'])
+            except Exception as e:
+                logger.warning(f"Bulk verify: could not read order {order_id}: {e}")
+                result['skipped'].append(order_id)
+                continue
+            if record.get('Status') != 'Pending':
+                result['skipped'].append(order_id)
+                continue
+            product_name = await order_product_name(order_id, record['SKU'])
+            units = await take_order_units(product_name, quantity, order_id, with_content=False)
+            if units is None:
+                status_changes[order_id] = {'Status': 'Paid - Manual Fail'}
+                result['no_stock'].append(order_id)
+                continue
+            fulfilled.append((order_id, user_id, product_name, quantity, units))
+
+        # Delivery Content for every order's units in one read
+        try:
+            filled = await with_delivery_content([(product_name, units) for _, _, product_name, _, units in fulfilled])
+        except Exception as e:
+            logger.error(f"Bulk verify: could not read delivery content: {e}")
+            # Their units went back to stock; hold them for the orders again, which stay Pending
+            for order_id, _, product_name, _, units in fulfilled:
+                await _rehold_order_units(order_id, product_name, units, returned=True)
+                result['skipped'].append(order_id)
+            filled, fulfilled = [], []
+        completed = []
+        for order, units in zip(fulfilled, filled):
+            if units is None:
+                status_changes[order[0]] = {'Status': 'Paid - Manual Fail'}
+                result['no_stock'].append(order[0])
+            else:
+                completed.append(order[:4] + (units,))
+        fulfilled = completed
+
+        # 2. One Orders write for all statuses, then one Products write for all delivered units.
+        # As in _settle_order the status goes first: an order that reads Paid is never fulfilled
+        # again, even after a restart has emptied the settled set.
+        for order_id, *_ in fulfilled:
+            status_changes[order_id] = {'Status': 'Paid'}
+        if status_changes:
+            try:
+                await update_order_fields(status_changes)
+            except Exception as e:
+                logger.error(f"Bulk verify: could not update the status of {len(status_changes)} orders: {e}")
+                # Nothing was written, so every order stays Pending and keeps its units for a retry
+                for order_id, _, product_name, _, units in fulfilled:
+                    await _rehold_order_units(order_id, product_name, units)
+                result['skipped'].extend(status_changes)
+                result['no_stock'] = []
+                fulfilled = []
+        row_nums = [row_num for *_, units in fulfilled for row_num, _ in units]
+        if row_nums:
+            try:
+                await storage.mark_units_delivered(row_nums)
+            except Exception as e:
+                logger.error(f"Bulk verify: marking {len(row_nums)} units delivered failed: {e}")
+                # Back to Pending for a retry, with their units held for them, not returned to stock
+                for order_id, _, product_name, _, units in fulfilled:
+                    await _rehold_order_units(order_id, product_name, units)
+                    result['skipped'].append(order_id)
+                try:
+                    await update_order_fields({order_id: {'Status': 'Pending'} for order_id, *_ in fulfilled})
+                except Exception as e:
+                    # They read Paid but were never delivered; they cannot be fulfilled twice, the admin must step in
+                    logger.error(f"Bulk verify: could not set {len(fulfilled)} undelivered orders back to Pending: {e}")
+                fulfilled = []
+            else:
+                for order_id, _, _, _, units in fulfilled:
+                    inventory_index.confirm_delivered(units)
+                    reservations.mark_settled(order_id)
+                product_sync.note_delivered(row_nums)
+                catalog_cache.invalidate()
+
+    # 3. The delivery queue sends them in the background, through the shared send limiter
+    for order_id, user_id, product_name, quantity, units in fulfilled:
+        content = "\n\n---\n\n".join(content for _, content in units)
+        delivery_queue.enqueue(order_id, user_id, product_name, quantity, content)
+        result['queued'].append(order_id)
+    return result
+
+@admin_only
+async def bulk_verify(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/bulkverify ID1 ID2 ... - verifies and fulfils several paid orders at once and queues their deliveries."""
+    order_ids = list(dict.fromkeys(
+        part.strip().upper() for arg in context.args for part in arg.split(',') if part.strip()
+    ))
+    if not order_ids:
+        await update.message.reply_text("Usage: /bulkverify ORDERID [ORDERID ...]")
+        return
+
+    started = time.perf_counter()
+    status_message = await update.message.reply_text(f"⏳ Verifying {len(order_ids)} orders...")
+    result = await bulk_verify_orders(order_ids)
+
+    lines = [
+        "📦 **BULK VERIFY REPORT**\n",
+        f"✅ Paid and queued for delivery: {len(result['queued'])}",
+        f"❌ Paid, insufficient stock (Paid - Manual Fail): {len(result['no_stock'])}",
+        f"ℹ️ Skipped (not pending or not found): {len(result['skipped'])}",
+        f"\nTook {time.perf_counter() - started:.1f}s",
+        "Deliveries that cannot be sent are reported separately (see /redeliver).",
+    ]
+    for label, key in (("No stock", 'no_stock'), ("Skipped", 'skipped')):
+        if result[key]:
+            lines.append(f"\n**{label}:** " + ", ".join(f"`{order_id}`" for order_id in result[key]))
+    await status_message.edit_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+@admin_only
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/stats - latency, Sheets usage and cache report for the admin."""
+    await update.message.reply_text(
+        f"📈 **BOT STATS**\n```\n{metrics.summary_text()[:3900]}\n```", parse_mode=ParseMode.MARKDOWN
+    )
+
+async def notify_replication_halted(bot, sheet: str, reason: str) -> None:
+    try:
+        # Plain text: the reason quotes sheet contents
+        await bot.send_message(
+            ADMIN_ID,
+            f"🛑 Mirroring to the '{sheet}' sheet has stopped: its rows no longer match the bot's copy ({reason}).\n\n"
+            f"The bot keeps working from its local copy. Send /resync {sheet} to overwrite the sheet with it "
+            "(hand edits made to that sheet since the last sync are lost).",
+        )
+    except TelegramError as e:
+        logger.warning(f"Could not notify the admin about halted replication: {e}")
+
+@admin_only
+async def resync_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/resync Products|Orders - overwrites a sheet whose replication halted with the bot's local copy."""
+    replicator = getattr(storage, 'replicator', None)
+    if replicator is None:
+        await update.message.reply_text("ℹ️ Sheets are the primary store; there is nothing to resync.")
+        return
+    sheet = context.args[0].capitalize() if context.args else None
+    if sheet not in ("Products", "Orders"):
+        halted = ", ".join(replicator.halted) or "none"
+        await update.message.reply_text(f"Usage: /resync Products|Orders\nHalted sheets: {halted}")
+        return
+
+    status_message = await update.message.reply_text(f"⏳ Rewriting '{sheet}' from the local copy...")
+    try:
+        async with sheet_rows_gate.exclusive(ARCHIVE_GATE_TIMEOUT):
+            rows = await replicator.resync(sheet)
+            if sheet == "Products":
+                product_sync.prime(await storage.product_rows())
+    except asyncio.TimeoutError:
+        await status_message.edit_text("⏳ Deliveries kept the sheets busy, try again in a moment.")
+        return
+    except Exception as e:
+        logger.error(f"Resync of '{sheet}' failed: {e}")
+        await status_message.edit_text(f"⚠️ Resync of '{sheet}' failed, replication stays halted: {e}")
+        return
+    await status_message.edit_text(f"✅ '{sheet}' rewritten ({rows} rows); replication resumed.")
+
+# --- Concurrent Update Processing ---
+# By default the Application handles one update at a time, so an admin verification waiting
+# on Sheets delays every buyer. PerUserUpdateProcessor runs different users in parallel but
+# keeps each user's updates strictly in arrival order, which is what ConversationHandler needs.
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs up to `workers` updates at once, never two from the same user. The base class
+    semaphore (`max_backlog`) bounds how many updates may be queued in total; updates waiting
+    for their user's earlier update do not occupy a worker slot.
+    """
+
+    def __init__(self, workers: int, max_backlog: int):
+        super().__init__(max_backlog)
+        self._workers = asyncio.Semaphore(workers)
+        self._user_locks = {}  # user/chat id -> [asyncio.Lock, number of queued updates]
+        self.stats = {
+            'processed': 0, 'running': 0, 'waiting': 0, 'max_waiting': 0,
+            'total_wait_ms': 0.0, 'max_wait_ms': 0.0,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        logger.info(
+            f"Update processor: {self.stats['processed']} updates, max backlog {self.stats['max_waiting']}, "
+            f"max queue wait {self.stats['max_wait_ms']:.0f} ms."
+        )
+
+    @staticmethod
+    def _ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._ordering_key(update)
+        queued_at = time.perf_counter()
+        self.stats['waiting'] += 1
+        self.stats['max_waiting'] = max(self.stats['max_waiting'], self.stats['waiting'])
+        if self.stats['waiting'] == UPDATE_BACKLOG_WARN:
+            logger.warning(f"{self.stats['waiting']} updates are waiting to be processed.")
+
+        entry = None
+        if key is not None:
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+        try:
+            if entry:
+                await entry[0].acquire()
+            try:
+                async with self._workers:
+                    wait_ms = (time.perf_counter() - queued_at) * 1000
+                    self.stats['waiting'] -= 1
+                    self.stats['running'] += 1
+                    self.stats['total_wait_ms'] += wait_ms
+                    self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], wait_ms)
+                    try:
+                        await coroutine
+                    finally:
+                        self.stats['running'] -= 1
+                        self.stats['processed'] += 1
+            finally:
+                if entry:
+                    entry[0].release()
+        finally:
+            if entry:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[key]
+
+
+update_processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_UPDATE_BACKLOG)
+metrics.register_gauge('bot_updates_processed_total', "Updates handled since start", lambda: update_processor.stats['processed'])
+metrics.register_gauge('bot_updates_waiting', "Updates waiting for a worker or for their user", lambda: update_processor.stats['waiting'])
+metrics.register_gauge('bot_orders_pending', "Orders in Pending status", lambda: len(order_index.with_status('Pending')))
 
 # --- 5. ERROR AND DEBUG SYSTEM ---
 
@@ -834,6 +4741,212 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # --- 6. MAIN FUNCTION ---
 
+# --- Webhook Serving Mode ---
+# Alternative to long polling: Telegram POSTs each update to our HTTPS endpoint. The aiohttp
+# server below checks Telegram's secret token header and hands the update to the Application's
+# update queue, so the handlers behave exactly as in polling mode. It can sit behind a load
+# balancer (GET /healthz) and be exercised locally with `python bot_v7.py fake-update /start`.
+
+class WebhookServer:
+    """
+    Minimal aiohttp server that validates and enqueues Telegram webhook updates. An update
+    counts as in flight from the moment it is accepted until the update processor has finished
+    handling it, so a slow backlog (not just slow request parsing) makes the server shed load.
+    """
+
+    def __init__(self, application: Application, path: str, secret_token: str, max_inflight: int):
+        self._application = application
+        self._processor = application.update_processor
+        self._processed_before = self._processor.stats['processed']
+        self._secret_token = secret_token
+        self._max_inflight = max_inflight
+        self._runner = None
+        self.stats = {'accepted': 0, 'rejected': 0, 'busy': 0, 'invalid': 0}
+
+        self._web_app = web.Application()
+        self._web_app.router.add_post(path, self.handle_update)
+        self._web_app.router.add_get("/healthz", self.handle_health)
+
+    def inflight(self) -> int:
+        """Updates accepted here that the Application has not finished processing yet."""
+        return self.stats['accepted'] - (self._processor.stats['processed'] - self._processed_before)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self._secret_token:
+            self.stats['rejected'] += 1
+            return web.Response(status=403)
+        if self.inflight() >= self._max_inflight:
+            # Telegram retries failed deliveries, so shedding load here is safe
+            self.stats['busy'] += 1
+            return web.Response(status=503)
+
+        try:
+            update = Update.de_json(await request.json(), self._application.bot)
+        except Exception as e:
+            self.stats['invalid'] += 1
+            logger.warning(f"Ignoring malformed webhook payload: {e}")
+            return web.Response(status=400)
+        await self._application.update_queue.put(update)
+        self.stats['accepted'] += 1
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({'ok': self._application.running, 'inflight': self.inflight(), **self.stats})
+
+    async def start(self, host: str, port: int) -> None:
+        self._runner = web.AppRunner(self._web_app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+async def run_webhook(application: Application) -> None:
+    """Runs the Application behind WebhookServer until SIGINT/SIGTERM (mirrors run_polling's lifecycle)."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers; fall back to the process-level handler
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(stop_event.set))
+
+    server = WebhookServer(application, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_INFLIGHT)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            logger.warning("WEBHOOK_URL is not set; not registering the webhook with Telegram (local testing).")
+        await application.start()
+        await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def post_fake_update(text: str, user_id: int = ADMIN_ID) -> None:
+    """Local testing aid: POSTs a Telegram-style message update to our own webhook server."""
+    update_id = int(time.time())
+    payload = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': update_id,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Fake'},
+            'text': text,
+        },
+    }
+    if text.startswith('/'):
+        payload['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    async with ClientSession() as session:
+        async with session.post(url, json=payload, headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET_TOKEN}) as response:
+            logger.info(f"POST {url} -> HTTP {response.status}")
+
+async def post_init(application: Application) -> None:
+    """Warms the caches and schedules background jobs before the first update is handled."""
+    # Rows buffered by a run that crashed before flushing
+    for writer in (orders_writer, users_writer):
+        if writer.load_spill():
+            await writer.flush()
+    await storage.start()
+    if getattr(storage, 'replicator', None):
+        storage.replicator.on_halted = lambda sheet, reason: application.create_task(
+            notify_replication_halted(application.bot, sheet, reason)
+        )
+
+    # Orders are indexed once so verification and the pending list skip full scans
+    try:
+        order_index.load(await storage.order_rows())
+        order_expiry.load()
+        logger.info(f"Indexed {len(order_index)} orders, {len(order_expiry)} pending.")
+    except Exception as e:
+        logger.warning(f"Could not index orders, verification will look them up in storage: {e}")
+
+    await catalog_cache.refresh()
+    try:
+        all_values = await storage.product_rows()
+        inventory_index.build(all_values)
+        product_sync.prime(all_values)
+    except Exception as e:
+        # Not fatal: process_delivery_and_update_stock builds the index on first use.
+        logger.error(f"Could not build inventory index at startup: {e}")
+    application.job_queue.run_repeating(
+        refresh_catalog_job, interval=CATALOG_REFRESH_INTERVAL, first=CATALOG_REFRESH_INTERVAL, name="catalog_refresh"
+    )
+    application.job_queue.run_repeating(
+        expire_reservations_job, interval=RESERVATION_SWEEP_INTERVAL, first=RESERVATION_SWEEP_INTERVAL, name="reservation_expiry"
+    )
+    application.job_queue.run_repeating(
+        product_sync_job, interval=PRODUCT_SYNC_INTERVAL, first=PRODUCT_SYNC_INTERVAL, name="products_sync"
+    )
+    if USERS_TRACK_LAST_SEEN:
+        application.job_queue.run_repeating(
+            flush_last_seen_job, interval=USERS_LAST_SEEN_FLUSH_INTERVAL, first=USERS_LAST_SEEN_FLUSH_INTERVAL, name="users_last_seen"
+        )
+
+    application.job_queue.run_repeating(
+        expire_orders_job, interval=ORDER_EXPIRY_INTERVAL, first=ORDER_EXPIRY_INTERVAL, name="order_expiry"
+    )
+    application.job_queue.run_repeating(
+        evict_sessions_job, interval=SESSION_EVICT_INTERVAL, first=SESSION_EVICT_INTERVAL, name="session_eviction"
+    )
+    application.job_queue.run_repeating(archive_job, interval=ARCHIVE_INTERVAL, first=ARCHIVE_INTERVAL, name="archive")
+    # Rows a crashed run removed from the live sheets but never appended to the archive
+    if archiver.load_spill():
+        await archiver.flush()
+    await restore_session_reservations(application)
+
+    if METRICS_PORT:
+        try:
+            await metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Could not start the metrics endpoint on port {METRICS_PORT}: {e}")
+
+    # A broadcast interrupted by a restart carries on from its saved cursor
+    state = broadcast_engine.load_state()
+    if state and state['status'] == 'running':
+        logger.info("Resuming interrupted broadcast.")
+        broadcast_engine.resume(application.bot)
+
+    # Deliveries not fully sent before a restart go out again, after the parts already sent
+    if delivery_queue.load():
+        logger.info(f"Resuming {delivery_queue.count('queued')} queued deliveries.")
+    delivery_queue.start(application.bot)
+
+async def post_shutdown(application: Application) -> None:
+    """Flushes buffered writes and releases background resources once the bot has stopped."""
+    await broadcast_engine.shutdown()
+    await delivery_queue.stop()
+    await metrics.stop_server()
+    await orders_writer.flush()
+    await users_writer.flush()
+    await archiver.flush()
+    await user_registry.flush_last_seen()
+    await storage.stop()
+    sheets_executor.shutdown()
+
 def main() -> None:
     """Start the bot."""
     try:
@@ -842,7 +4955,21 @@ def main() -> None:
         logger.critical("Bot failed to initialize Google Sheets. Exiting application.")
         return
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    try:
+        init_storage()
+    except RuntimeError:
+        logger.critical("Bot failed to initialize storage. Exiting application.")
+        return
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor)
+        .persistence(SessionPersistence(SESSION_DB_FILE, SESSION_FLUSH_INTERVAL, SESSION_TTL_SECONDS))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # --- Conversation Handler for E-Commerce Flow ---
     ecom_handler = ConversationHandler(
@@ -852,6 +4979,7 @@ def main() -> None:
                 CallbackQueryHandler(show_products, pattern='^shop$'),
                 CallbackQueryHandler(go_to_main_menu, pattern='^main_menu$'),
                 CallbackQueryHandler(quantity_prompt, pattern='^qty_prompt_'),
+                CallbackQueryHandler(show_category_page, pattern='^cat_'),
                 CommandHandler("shop", show_products),
             ],
             CONFIRM_ORDER: [
@@ -867,23 +4995,63 @@ def main() -> None:
         },
         fallbacks=[CommandHandler("start", start)],
         per_user=True,
-        allow_reentry=True
+        allow_reentry=True,
+        name="ecom_conversation",
+        persistent=True
     )
     
+    # --- Conversation Handler for Admin Broadcasts ---
+    # Runs in its own group ahead of ecom_handler: the admin's broadcast message stops there
+    # (ApplicationHandlerStop) so it is not taken as shop input, while any command ends the
+    # broadcast prompt and then still reaches its own handler (/start shows the main menu).
+    broadcast_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(broadcast_prompt, pattern='^admin_broadcast$')],
+        states={
+            ADMIN_BROADCAST: [MessageHandler(~filters.COMMAND, broadcast_preview)],
+            ADMIN_BROADCAST_CONFIRM: [CallbackQueryHandler(broadcast_send, pattern='^broadcast_(send|cancel)$')],
+        },
+        fallbacks=[MessageHandler(filters.COMMAND, broadcast_cancel)],
+        per_user=True,
+        allow_reentry=True
+    )
+
+    application.add_handler(broadcast_handler, group=-1)
     application.add_handler(ecom_handler)
     application.add_handler(CallbackQueryHandler(go_to_main_menu, pattern='^main_menu$'))
+    application.add_handler(InlineQueryHandler(inline_search))
 
     # --- Admin Handlers (Separate) ---
     application.add_handler(CommandHandler("admin", admin_menu))
-    application.add_handler(CallbackQueryHandler(list_pending_orders, pattern='^admin_pending$'))
+    application.add_handler(CommandHandler("pending", list_pending_orders))
+    application.add_handler(CommandHandler("bulkverify", bulk_verify))
+    application.add_handler(CommandHandler("redeliver", redeliver))
+    application.add_handler(CommandHandler("resync", resync_sheet))
+    application.add_handler(CallbackQueryHandler(list_pending_orders, pattern='^admin_pending$|^pending_page_'))
     application.add_handler(CallbackQueryHandler(verify_and_deliver, pattern='^verify_'))
+    application.add_handler(CallbackQueryHandler(broadcast_control, pattern='^broadcast_(stop|resume)$'))
     
+    application.add_handler(CommandHandler("stats", show_stats))
+
+    # Time every handler registered above (see Instrumentation)
+    instrument_handlers(application)
+
     # --- Register Global Error Handler ---
     application.add_error_handler(error_handler)
     
-    logger.info("Bot started successfully and polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_SECRET_TOKEN:
+            logger.critical("FATAL: WEBHOOK_SECRET_TOKEN must be set in webhook mode. Exiting application.")
+            return
+        logger.info("Bot started successfully and serving webhooks...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Bot started successfully and polling...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "fake-update":
+        # Local webhook testing: python bot_v7.py fake-update /start
+        asyncio.run(post_fake_update(" ".join(sys.argv[2:]) or "/start"))
+    else:
+        main()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot_v7 writes bot_logs.log and its state files to the working directory
+os.chdir(tempfile.mkdtemp(prefix="bot_v7_tests_"))
@@ -0,0 +1,39 @@
+import asyncio
+import types
+
+import bot_v7
+
+
+class FakeBot:
+    def __init__(self):
+        self.copied = []
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        self.copied.append(chat_id)
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+def test_resume_skips_sends_finished_above_the_cursor(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_v7, 'user_registry', types.SimpleNamespace(user_ids=lambda: {1, 2, 3, 4, 5, 6}))
+    engine = bot_v7.BroadcastEngine(bot_v7.TokenBucket(1000, 1000), str(tmp_path / 'broadcast.json'), workers=2)
+    # Users 1-2 and 4 were done before the restart; 3 was still in flight
+    engine.state = {
+        'from_chat_id': 1, 'message_id': 10, 'status_chat_id': 1, 'status_message_id': 11,
+        'cursor': 2, 'finished': [4], 'total': 6, 'sent': 3, 'blocked': 0, 'failed': 0,
+        'started_at': 0, 'status': 'running',
+    }
+    bot = FakeBot()
+
+    async def run():
+        engine.resume(bot)
+        await engine._task
+    asyncio.run(run())
+
+    assert sorted(bot.copied) == [3, 5, 6]
+    assert engine.state['total'] == 6
+    assert engine.state['sent'] == 6
+    assert engine.state['cursor'] == 6
+    assert engine.state['finished'] == []
+    assert engine.state['status'] == 'done'
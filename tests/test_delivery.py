@@ -0,0 +1,41 @@
+from telegram.constants import MessageLimit
+
+import bot_v7
+
+SEPARATOR = "\n\n---\n\n"
+
+
+def job(content):
+    return {'order_id': 'ORD-1', 'product_name': 'Key', 'quantity': 1, 'content': content}
+
+
+def test_split_keeps_units_whole_and_within_the_limit():
+    units = ['a' * 40, 'b' * 40, 'c' * 40]
+    chunks = bot_v7.split_delivery_content(SEPARATOR.join(units), 100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert SEPARATOR.join(chunks) == SEPARATOR.join(units)
+
+
+def test_split_cuts_an_oversized_unit_by_lines_and_hard():
+    unit = '\n'.join(['x' * 30] * 5) + '\n' + 'y' * 250
+    chunks = bot_v7.split_delivery_content(unit, 100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert ''.join(chunks).replace('\n', '') == unit.replace('\n', '')
+
+
+def test_short_content_is_one_message():
+    assert len(bot_v7.delivery_parts(job('secret'))) == 1
+
+
+def test_long_content_is_split_within_telegram_limit():
+    content = SEPARATOR.join(['k' * 1000] * 8)
+    parts = bot_v7.delivery_parts(job(content))
+    assert 1 < len(parts) <= bot_v7.DELIVERY_MAX_MESSAGES
+    assert all(len(part) <= MessageLimit.MAX_TEXT_LENGTH for part in parts)
+    assert parts[-1].endswith("Thank you for your purchase!")
+
+
+def test_content_needing_too_many_messages_goes_as_a_document():
+    count = bot_v7.DELIVERY_MAX_MESSAGES + 1
+    content = SEPARATOR.join(['k' * bot_v7.DELIVERY_CHUNK_CHARS] * count)
+    assert bot_v7.delivery_parts(job(content)) == [None]
@@ -0,0 +1,107 @@
+import asyncio
+
+import gspread
+import pytest
+
+import bot_v7
+
+# Columns in a different order than the original sheet (Stock is not D, Delivery Content is not E)
+HEADER = ['Delivery Content', 'Name', 'SKU', 'Price (USD)', 'Stock', 'Category']
+ROWS = [
+    HEADER,
+    ['key-1', 'Alpha', 'A0', '5', '1', 'Games'],
+    ['key-2', 'Alpha', 'A1', '5', '1'],  # Short row: no Category cell at all
+    ['', 'Beta', 'B0', '7', '0', ''],    # Trailing empty cell
+]
+
+
+class FakeProducts:
+    """batch_get of a Products grid the way Sheets answers it: trailing empty cells dropped."""
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+
+    async def batch_get(self, ranges, major_dimension=None):
+        assert major_dimension == gspread.utils.Dimension.cols
+        out = []
+        for a1 in ranges:
+            if a1 == '1:1':
+                out.append([[cell] for cell in self.rows[0]])
+                continue
+            row_num, col = gspread.utils.a1_to_rowcol(a1.split(':')[0])
+            column = [row[col - 1] if col <= len(row) else '' for row in self.rows[row_num - 1:]]
+            while column and column[-1] == '':
+                column.pop()
+            out.append([column] if column else [])
+        return out
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    sheet = FakeProducts(ROWS)
+    monkeypatch.setattr(bot_v7, 'products_sheet', sheet)
+    monkeypatch.setattr(bot_v7, 'products_columns', bot_v7.ColumnMap(HEADER))
+    return sheet
+
+
+def test_column_map_follows_the_header():
+    columns = bot_v7.ColumnMap(HEADER)
+    assert columns.letter('Stock') == 'E'
+    assert columns.cell('Delivery Content', 7) == 'A7'
+    assert columns.column_range('Name') == 'B2:B'
+    assert columns.without('Delivery Content') == ['Name', 'SKU', 'Price (USD)', 'Stock', 'Category']
+    assert bot_v7.ColumnMap(['SKU', 'Name', 'Stock']).missing() == ['Delivery Content']
+
+
+def test_product_rows_reads_named_columns_in_the_order_asked(sheet):
+    rows = asyncio.run(bot_v7.SheetsStorage().product_rows(['Name', 'Stock', 'Category', 'Unknown']))
+    assert rows == [
+        ['Name', 'Stock', 'Category'],
+        ['Alpha', '1', 'Games'],
+        ['Alpha', '1', ''],
+        ['Beta', '0', ''],
+    ]
+
+
+def test_padding_differences_are_not_changes():
+    sync = bot_v7.ProductSheetSync()
+    sync.prime(ROWS)
+    padded = [row + [''] * (len(HEADER) - len(row)) for row in ROWS]
+    assert sync.diff(padded) == {}
+
+
+def test_hand_edits_and_deleted_rows_are_diffed():
+    sync = bot_v7.ProductSheetSync()
+    sync.prime(ROWS)
+    edited = [list(row) for row in ROWS[:3]]
+    edited[2][4] = '0'  # Admin set A1's stock to 0; the Beta row was deleted
+    changes = sync.diff(edited)
+    assert changes == {3: ('key-2', 'Alpha', 'A1', '5', '0'), 4: None}
+
+
+def test_own_delivery_write_is_not_an_edit():
+    sync = bot_v7.ProductSheetSync()
+    sync.prime(ROWS)
+    sync.note_delivered([2])
+    # The sheet has not caught up with the bot's write yet
+    assert sync.diff(ROWS) == {}
+
+
+def test_change_check_passes_an_unchanged_sheet(sheet):
+    sync = bot_v7.ProductSheetSync()
+    sync.prime(ROWS)
+    assert asyncio.run(sync._looks_unchanged())
+
+
+def test_change_check_notices_a_stock_edit(sheet):
+    sync = bot_v7.ProductSheetSync()
+    sync.prime(ROWS)
+    sheet.rows[3][4] = '5'
+    assert not asyncio.run(sync._looks_unchanged())
+
+
+def test_change_check_notices_reordered_headers(sheet):
+    sync = bot_v7.ProductSheetSync()
+    sync.prime(ROWS)
+    sheet.rows = [[row[i] if i < len(row) else '' for i in (1, 0, 2, 3, 4, 5)] for row in ROWS]
+    assert not asyncio.run(sync._looks_unchanged())
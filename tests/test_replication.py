@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import bot_v7
+
+
+HEADER = bot_v7.ORDER_COLUMNS
+
+
+def order_row(order_id, status='Paid'):
+    return [order_id, '2024-01-01 00:00:00', '1', 'buyer', 'A0', '5', '1', status, '']
+
+
+class FakeWorksheet:
+    """Just enough of an AsyncWorksheet for the replicator, backed by a list of rows."""
+
+    title = 'Orders'
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+        self.calls = []
+
+    async def batch_get(self, ranges):
+        self.calls.append('batch_get')
+        out = []
+        for a1 in ranges:
+            row_num = int(a1[1:])
+            row = self.rows[row_num - 1] if row_num <= len(self.rows) else []
+            out.append([[row[0]]] if row else [])
+        return out
+
+    async def batch_update(self, data):
+        self.calls.append('batch_update')
+
+    async def append_rows(self, rows):
+        self.calls.append('append_rows')
+
+    async def clear(self):
+        self.calls.append('clear')
+        self.rows = []
+
+    async def update(self, values, range_name):
+        self.calls.append('update')
+        self.rows = [list(row) for row in values]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = bot_v7.SQLiteStorage(str(tmp_path / 'store.db'))
+    store.import_grid('Orders', [HEADER] + [order_row(f'O{i}') for i in range(1, 5)])
+    yield store
+    store._db.close()
+
+
+def test_refused_delete_halts_replication_of_that_sheet(store):
+    # Someone inserted a row at the top of the sheet by hand, so O1 is now on row 3
+    sheet = FakeWorksheet([HEADER, order_row('HAND')] + [order_row(f'O{i}') for i in range(1, 5)])
+    replicator = bot_v7.SheetsReplicator(store, {'Orders': lambda: sheet})
+    store.replicator = replicator
+    alerts = []
+    replicator.on_halted = lambda name, reason: alerts.append(name)
+
+    asyncio.run(store.delete_rows('Orders', {2: 'O1'}))
+    # Locally O2 moved up to row 2; this update is addressed to that new row number
+    asyncio.run(store.update_orders({2: {'Status': 'Failed'}}))
+
+    assert asyncio.run(replicator.drain())
+    assert replicator.halted.keys() == {'Orders'}
+    assert alerts == ['Orders']
+    # Neither the delete nor the row-addressed update reached the sheet, and both are kept
+    assert 'batch_update' not in sheet.calls
+    assert [op for _, _, op, _ in store.pending_ops(10)] == ['delete', 'update']
+    assert store.pending_ops(10, skip_sheets=replicator.halted) == []
+
+
+def test_resync_rewrites_sheet_and_resumes(store):
+    sheet = FakeWorksheet([HEADER, order_row('HAND')] + [order_row(f'O{i}') for i in range(1, 5)])
+    replicator = bot_v7.SheetsReplicator(store, {'Orders': lambda: sheet})
+    store.replicator = replicator
+    asyncio.run(store.delete_rows('Orders', {2: 'O1'}))
+    asyncio.run(replicator.drain())
+
+    assert asyncio.run(replicator.resync('Orders')) == 4
+    assert sheet.rows == store._rows('Orders')
+    assert [row[0] for row in sheet.rows[1:]] == ['O2', 'O3', 'O4']
+    assert replicator.halted == {}
+    assert store.pending_ops(10) == []
+
+    asyncio.run(store.update_orders({2: {'Status': 'Failed'}}))
+    assert asyncio.run(replicator.drain())
+    assert sheet.calls[-1] == 'batch_update'
+
+
+def test_update_of_a_missing_order_row_changes_nothing(store):
+    with pytest.raises(KeyError):
+        asyncio.run(store.update_orders({3: {'Status': 'Failed'}, 99: {'Status': 'Failed'}}))
+    assert store._row('Orders', 3)[bot_v7.ORDER_COLUMNS.index('Status')] == 'Paid'
+    assert store.pending_ops(10) == []
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import bot_v7
+
+
+PRODUCTS = [
+    ['SKU', 'Name', 'Price (USD)', 'Stock', 'Delivery Content'],
+    ['A0', 'Alpha', '5', '1', 'code-1'],
+    ['A1', 'Alpha', '5', '1', 'code-2'],
+]
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    inventory = bot_v7.InventoryIndex()
+    inventory.build(PRODUCTS)
+    monkeypatch.setattr(bot_v7, 'order_index', bot_v7.OrderIndex())
+    return bot_v7.ReservationManager(inventory, ttl_seconds=60)
+
+
+def pending_order(order_id, proof=''):
+    return dict(zip(bot_v7.ORDER_COLUMNS, [order_id, '', '1', 'buyer', 'A0', '5', '1', 'Pending', proof]))
+
+
+def force_deadline(manager, order_id):
+    manager._reservations[order_id]['expires_at'] = 0
+
+
+def test_unpaid_reservation_expires(manager):
+    assert asyncio.run(manager.reserve('O1', 'Alpha', 2))
+    force_deadline(manager, 'O1')
+
+    assert manager.expire_stale() == 1
+    assert manager._inventory.available('Alpha') == 2
+
+
+def test_pinned_reservation_outlives_ttl(manager):
+    assert asyncio.run(manager.reserve('O1', 'Alpha', 2))
+    assert manager.pin('O1')
+    # A pin clears the deadline; expire_stale must leave the units held
+    assert manager.expire_stale() == 0
+    assert manager._inventory.available('Alpha') == 0
+    assert not asyncio.run(manager.reserve('O2', 'Alpha', 1))
+
+
+def test_order_with_proof_is_not_released(manager):
+    assert asyncio.run(manager.reserve('O1', 'Alpha', 1))
+    bot_v7.order_index.add(pending_order('O1', proof='TX123'), 2)
+    force_deadline(manager, 'O1')
+
+    assert manager.expire_stale() == 0
+    assert manager.is_pinned('O1')
+    assert manager.reserved_name('O1') == 'Alpha'
+
+
+def test_reserve_with_pin_keeps_existing_units(manager):
+    assert asyncio.run(manager.reserve('O1', 'Alpha', 1))
+    units = list(manager._reservations['O1']['units'])
+
+    assert asyncio.run(manager.reserve('O1', 'Alpha', 1, pinned=True))
+    assert manager.is_pinned('O1')
+    assert manager._reservations['O1']['units'] == units
+
+
+class DownStorage:
+    async def delivery_content(self, row_nums):
+        raise bot_v7.SheetsUnavailable('Google Sheets circuit is open')
+
+
+def test_failed_content_read_keeps_the_order_reservation(manager, monkeypatch):
+    monkeypatch.setattr(bot_v7, 'inventory_index', manager._inventory)
+    monkeypatch.setattr(bot_v7, 'reservations', manager)
+    monkeypatch.setattr(bot_v7, 'storage', DownStorage())
+    manager._inventory.build([row[1:4:2] for row in PRODUCTS])  # Name and Stock only; content is read at delivery
+    assert asyncio.run(manager.reserve('O1', 'Alpha', 1, pinned=True))
+    units = list(manager._reservations['O1']['units'])
+
+    with pytest.raises(bot_v7.SheetsUnavailable):
+        asyncio.run(bot_v7.take_order_units('Alpha', 1, 'O1'))
+    # The units are the order's again, not back on sale
+    assert manager.is_pinned('O1')
+    assert [row for row, _ in manager._reservations['O1']['units']] == [row for row, _ in units]
+    assert manager._inventory.available('Alpha') == 1
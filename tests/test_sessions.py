@@ -0,0 +1,65 @@
+import asyncio
+import json
+from datetime import datetime
+
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters
+from telegram.request import BaseRequest
+
+import bot_v7
+
+ASKED = 1
+
+
+class OfflineRequest(BaseRequest):
+    """Answers the getMe call of Application.initialize without a network."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        bot = {'id': 1, 'is_bot': True, 'first_name': 'shop', 'username': 'shopbot'}
+        return 200, json.dumps({'ok': True, 'result': bot}).encode()
+
+
+def message_update(bot, update_id, user_id, text):
+    user = User(user_id, f'u{user_id}', False)
+    entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text))] if text.startswith('/') else None
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text=text, entities=entities)
+    message.set_bot(bot)
+    return Update(update_id, message=message)
+
+
+def test_evicted_users_conversation_restarts_at_start():
+    answers = []
+
+    async def start(update, context):
+        return ASKED
+
+    async def answer(update, context):
+        answers.append(update.effective_user.id)
+        return ASKED
+
+    application = ApplicationBuilder().token('1:test').request(OfflineRequest()).get_updates_request(OfflineRequest()).build()
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler('start', start)],
+        states={ASKED: [MessageHandler(filters.TEXT & ~filters.COMMAND, answer)]},
+        fallbacks=[],
+        per_user=True,
+    ))
+
+    async def run():
+        await application.initialize()
+        for user_id in (1, 2):
+            await application.process_update(message_update(application.bot, user_id, user_id, '/start'))
+        bot_v7.end_conversations(application, [1])
+        for user_id in (1, 2):
+            await application.process_update(message_update(application.bot, 10 + user_id, user_id, 'hello'))
+
+    asyncio.run(run())
+    # User 1 is back outside the conversation; user 2 is still being asked
+    assert answers == [2]
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import types
+
+import pytest
+from gspread.exceptions import APIError
+from requests import Response
+from requests.exceptions import ConnectionError as RequestsConnectionError
+
+import bot_v7
+
+
+def api_error(status):
+    response = Response()
+    response.status_code = status
+    response._content = b'{}'
+    return APIError(response)
+
+
+def open_breaker(cooldown):
+    breaker = bot_v7.CircuitBreaker(threshold=2, cooldown=cooldown)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_threshold_and_refuses_during_cooldown():
+    breaker = bot_v7.CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.opens == 1
+
+
+def test_half_open_breaker_lets_one_trial_through():
+    breaker = open_breaker(cooldown=0)
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()  # The trial is still in flight
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = open_breaker(cooldown=60)
+    breaker._opened_at -= 60
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_cancelled_trial_frees_the_trial_slot():
+    executor = bot_v7.SheetsExecutor(max_workers=1, per_sheet_concurrency=1)
+    executor.breaker = open_breaker(cooldown=0)
+    release = threading.Event()
+
+    def update():
+        release.wait(5)
+
+    async def run():
+        trial = asyncio.ensure_future(executor.run('Orders', update))
+        await asyncio.sleep(0.05)
+        assert not executor.breaker.allow()  # The trial holds the slot
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    try:
+        asyncio.run(run())
+    finally:
+        release.set()
+        executor._pool.shutdown(wait=True)
+    assert executor.breaker.allow()
+
+
+def test_retryable_classification():
+    retryable = bot_v7.SheetsExecutor._retryable
+    assert retryable(api_error(503), 'get')
+    assert retryable(api_error(429), 'append_rows')  # Quota refusals were never applied
+    assert not retryable(api_error(503), 'append_rows')
+    assert not retryable(api_error(400), 'get')
+    assert retryable(RequestsConnectionError(), 'batch_update')
+    assert not retryable(RequestsConnectionError(), 'add_worksheet')
+    assert not retryable(ValueError(), 'get')
+
+
+def test_quota_governor_waits_once_the_window_is_full():
+    quota = bot_v7.QuotaGovernor(reads_per_minute=2, writes_per_minute=1)
+    quota.WINDOW_SECONDS = 0.1
+
+    async def run():
+        for _ in range(3):
+            await quota.acquire('read')
+        await quota.acquire('write')
+
+    asyncio.run(run())
+    assert quota.waits == 1
+    assert 0 < quota.wait_seconds <= 0.1
+
+
+def test_backoff_sleep_does_not_hold_the_worksheet_queue(monkeypatch):
+    monkeypatch.setattr(bot_v7, 'random', types.SimpleNamespace(uniform=lambda low, high: high))
+    monkeypatch.setattr(bot_v7, 'SHEETS_BACKOFF_BASE', 0.2)
+    executor = bot_v7.SheetsExecutor(max_workers=2, per_sheet_concurrency=1)
+    done = []
+    failures = [api_error(503)]
+
+    def update():
+        if failures:
+            raise failures.pop()
+        done.append('update')
+
+    def get():
+        done.append('get')
+
+    async def run():
+        write = asyncio.ensure_future(executor.run('Orders', update))
+        await asyncio.sleep(0.05)  # The write has failed once and is backing off
+        await asyncio.wait_for(executor.run('Orders', get), 0.1)
+        await write
+
+    try:
+        asyncio.run(run())
+    finally:
+        executor._pool.shutdown(wait=True)
+    assert done == ['get', 'update']
+    assert executor.retries == 1
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import bot_v7
+
+
+class Sheet:
+    """A worksheet whose get() blocks until released, counting the calls that reach it."""
+
+    def __init__(self):
+        self.value = 'old'
+        self.gets = 0
+        self.release = threading.Event()
+
+    def get(self, a1):
+        self.gets += 1
+        seen = self.value
+        self.release.wait(5)
+        return seen
+
+    def update(self, value):
+        self.value = value
+
+
+def run_with_executor(scenario):
+    executor = bot_v7.SheetsExecutor(max_workers=4, per_sheet_concurrency=2)
+    try:
+        return asyncio.run(scenario(executor))
+    finally:
+        executor._pool.shutdown(wait=True)
+
+
+def test_concurrent_identical_reads_make_one_call():
+    sheet = Sheet()
+
+    async def scenario(executor):
+        reads = [asyncio.ensure_future(executor.run('Products', sheet.get, 'A1')) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        sheet.release.set()
+        return await asyncio.gather(*reads), executor.reads
+
+    results, reads = run_with_executor(scenario)
+    assert results == ['old'] * 5
+    assert sheet.gets == 1
+    assert (reads.misses, reads.hits) == (1, 4)
+
+
+def test_write_during_a_read_stops_later_reads_joining_it():
+    sheet = Sheet()
+
+    async def scenario(executor):
+        early = asyncio.ensure_future(executor.run('Products', sheet.get, 'A1'))
+        await asyncio.sleep(0.05)  # The read is in flight and has already seen 'old'
+        await executor.run('Products', sheet.update, 'new')
+        late = asyncio.ensure_future(executor.run('Products', sheet.get, 'A1'))
+        await asyncio.sleep(0.05)
+        sheet.release.set()
+        return await early, await late
+
+    early, late = run_with_executor(scenario)
+    assert (early, late) == ('old', 'new')
+    assert sheet.gets == 2
@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import bot_v7
+
+
+def update_from(update_id, user_id):
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=User(user_id, 'u', False), text='x')
+    return Update(update_id, message=message)
+
+
+async def step(events, name, wait=0.0, gate=None):
+    events.append(f'{name} start')
+    if gate is not None:
+        await gate.wait()
+    await asyncio.sleep(wait)
+    events.append(f'{name} end')
+
+
+def test_one_users_updates_run_in_order_while_users_run_concurrently():
+    processor = bot_v7.PerUserUpdateProcessor(workers=4, max_backlog=10)
+    events = []
+
+    async def run():
+        await asyncio.gather(
+            processor.process_update(update_from(1, 1), step(events, 'a1', wait=0.05)),
+            processor.process_update(update_from(2, 1), step(events, 'a2')),
+            processor.process_update(update_from(3, 2), step(events, 'b1', wait=0.02)),
+        )
+
+    asyncio.run(run())
+    # User 1's second update waits for its first; user 2 starts and finishes meanwhile
+    assert events.index('a1 end') < events.index('a2 start')
+    assert events.index('b1 start') < events.index('a1 end')
+    assert events.index('b1 end') < events.index('a1 end')
+    assert processor.stats['processed'] == 3
+    assert processor._user_locks == {}
+
+
+def test_backlog_bounds_the_updates_taken_in():
+    processor = bot_v7.PerUserUpdateProcessor(workers=4, max_backlog=2)
+    events = []
+
+    async def run():
+        gate = asyncio.Event()
+        tasks = [
+            asyncio.ensure_future(processor.process_update(update_from(user_id, user_id), step(events, f'u{user_id}', gate=gate)))
+            for user_id in (1, 2, 3)
+        ]
+        await asyncio.sleep(0.05)
+        started = len(events)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(run()) == 2
+    assert len(events) == 6
@@ -0,0 +1,81 @@
+import asyncio
+
+import bot_v7
+
+
+class Sheet:
+    """append_rows that fails while `down`, and can hold a call open to let rows arrive mid-flush."""
+
+    def __init__(self):
+        self.rows = []
+        self.down = False
+        self.hold = None
+
+    async def append_rows(self, rows):
+        if self.hold is not None:
+            await self.hold.wait()
+        if self.down:
+            raise RuntimeError('Sheets down')
+        first = len(self.rows) + 1
+        self.rows.extend(rows)
+        return {'updates': {'updatedRange': f"Orders!A{first}:B{len(self.rows)}"}}
+
+
+def buffer_for(sheet, spill_path):
+    return bot_v7.WriteBehindBuffer('Orders', lambda: sheet, str(spill_path), max_rows=100, flush_ms=60_000)
+
+
+def test_failed_flush_is_replayed_exactly_once_after_a_restart(tmp_path):
+    spill = tmp_path / 'orders.jsonl'
+    sheet = Sheet()
+
+    async def before_crash():
+        buffer = buffer_for(sheet, spill)
+        await buffer.append(['O1', 'a'])
+        await buffer.append(['O2', 'b'])
+        sheet.down = True
+        await buffer.flush()
+        assert len(buffer) == 2  # Kept for the next try
+
+    async def after_restart():
+        buffer = buffer_for(sheet, spill)
+        assert buffer.load_spill() == 2
+        await buffer.append(['O3', 'c'])
+        sheet.down = False
+        await buffer.flush()
+        await buffer.flush()
+        return buffer
+
+    asyncio.run(before_crash())
+    buffer = asyncio.run(after_restart())
+    assert sheet.rows == [['O1', 'a'], ['O2', 'b'], ['O3', 'c']]
+    assert len(buffer) == 0
+    assert spill.read_text() == ''
+    assert buffer_for(sheet, spill).load_spill() == 0
+
+
+def test_rows_added_during_a_flush_stay_spilled(tmp_path):
+    spill = tmp_path / 'orders.jsonl'
+    sheet = Sheet()
+    flushed = []
+
+    async def run():
+        buffer = buffer_for(sheet, spill)
+        buffer.on_flushed = lambda rows, first_row: flushed.append((len(rows), first_row))
+        await buffer.append(['O1', 'a'])
+        sheet.hold = asyncio.Event()
+        flush = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0)
+        await buffer.append(['O2', 'b'])  # Arrives while O1's append is on its way
+        sheet.hold.set()
+        await flush
+
+    asyncio.run(run())
+    assert sheet.rows == [['O1', 'a']]
+    assert flushed == [(1, 1)]
+    # After a crash now, only O2 would be replayed
+    restarted = Sheet()
+    replay = buffer_for(restarted, spill)
+    assert replay.load_spill() == 1
+    asyncio.run(replay.flush())
+    assert restarted.rows == [['O2', 'b']]